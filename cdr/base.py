@@ -10,7 +10,7 @@ from collections import defaultdict
 from .kwargs import MODEL_INITIALIZATION_KWARGS
 from .formula import *
 from .util import *
-from .data import build_CDR_impulses, corr_cdr, get_first_last_obs_lists
+from .data import build_CDR_impulses, build_CDR_impulses_memmap, LazyCDRImpulses, ExpandedCDRImpulses, CDRInputs, corr_cdr, get_first_last_obs_lists, get_history_lengths, get_t_delta_stats, trim_history
 from .opt import *
 from .plot import *
 
@@ -171,15 +171,13 @@ class Model(object):
             else:
                 for i, df in enumerate(X + [y]):
                     if name in df.columns and not name.lower() == 'rate':
-                        column = df[name].values
+                        column = np.asarray(df[name])
                         # impulse_vectors[name] = column
                         impulse_means[name] = column.mean()
                         impulse_sds[name] = column.std()
-                        quantiles = np.quantile(column, q)
+                        quantiles = np.quantile(column, np.concatenate([q, [0.5, 0.1, 0.9]]))
+                        quantiles, (impulse_medians[name], impulse_lq[name], impulse_uq[name]) = quantiles[:-3], quantiles[-3:]
                         impulse_quantiles[name] = quantiles
-                        impulse_medians[name] = np.quantile(column, 0.5)
-                        impulse_lq[name] = np.quantile(column, 0.1)
-                        impulse_uq[name] = np.quantile(column, 0.9)
                         impulse_min[name] = column.min()
                         impulse_max[name] = column.max()
                         # if name.lower() != 'rate' and False:
@@ -199,15 +197,13 @@ class Model(object):
                                 found = False
                                 break
                         if found:
-                            column = df[impulse_names].product(axis=1)
+                            column = pd.DataFrame({x: np.asarray(df[x]) for x in impulse_names}).product(axis=1)
                             # impulse_vectors[name] = column.values
                             impulse_means[name] = column.mean()
                             impulse_sds[name] = column.std()
-                            quantiles = np.quantile(column, q)
+                            quantiles = np.quantile(column, np.concatenate([q, [0.5, 0.1, 0.9]]))
+                            quantiles, (impulse_medians[name], impulse_lq[name], impulse_uq[name]) = quantiles[:-3], quantiles[-3:]
                             impulse_quantiles[name] = quantiles
-                            impulse_medians[name] = np.quantile(column, 0.5)
-                            impulse_lq[name] = np.quantile(column, 0.1)
-                            impulse_uq[name] = np.quantile(column, 0.9)
                             impulse_min[name] = column.min()
                             impulse_max[name] = column.max()
                             # kde = scipy.stats.gaussian_kde(column)
@@ -253,28 +249,27 @@ class Model(object):
         # self.densities = densities
 
         # Collect stats for temporal features
-        t_deltas = []
-        t_delta_maxes = []
         time_X = []
+        first_obs_stats = []
+        last_obs_stats = []
         first_obs, last_obs = get_first_last_obs_lists(y)
         y_time = y.time.values
         for i, cols in enumerate(zip(first_obs, last_obs)):
             if i in impulse_df_ix_unique or (not impulse_df_ix_unique and i == 0):
                 first_obs_cur, last_obs_cur = cols
-                first_obs_cur = np.array(first_obs_cur, dtype=getattr(np, self.int_type))
-                last_obs_cur = np.array(last_obs_cur, dtype=getattr(np, self.int_type))
-                time_X_cur = np.array(X[i].time, dtype=getattr(np, self.float_type))
-                time_X.append(time_X_cur)
-                for j, (s, e) in enumerate(zip(first_obs_cur, last_obs_cur)):
-                    s = max(s, e - self.history_length)
-                    time_X_slice = time_X_cur[s:e]
-                    t_delta = y_time[j] - time_X_slice
-                    t_deltas.append(t_delta)
-                    t_delta_maxes.append(y_time[j] - time_X_cur[s])
+                first_obs_stats.append(np.array(first_obs_cur, dtype=getattr(np, self.int_type)))
+                last_obs_stats.append(np.array(last_obs_cur, dtype=getattr(np, self.int_type)))
+                time_X.append(np.array(X[i].time, dtype=getattr(np, self.float_type)))
+        t_delta_moments, t_delta_sketch, t_delta_maxes = get_t_delta_stats(
+            time_X,
+            y_time,
+            first_obs_stats,
+            last_obs_stats,
+            self.history_length
+        )
         time_X = np.concatenate(time_X, axis=0)
-        t_deltas = np.concatenate(t_deltas, axis=0)
-        t_delta_maxes = np.array(t_delta_maxes)
-        t_delta_quantiles = np.quantile(t_deltas, q)
+        t_delta_quantiles = t_delta_sketch.quantile(np.concatenate([q, [0.75]]))
+        t_delta_quantiles, t_delta_limit = t_delta_quantiles[:-1], t_delta_quantiles[-1]
 
         # kde = scipy.stats.gaussian_kde(t_deltas)
         # density_support = np.linspace(t_delta_quantiles[0], t_delta_quantiles[-1], 100)
@@ -283,15 +278,16 @@ class Model(object):
         # self.densities[('t_delta',)] = spline
 
         # self.t_delta_vector_train = t_deltas
-        self.t_delta_limit = np.quantile(t_deltas, 0.75)
+        self.t_delta_limit = t_delta_limit
         self.t_delta_quantiles = t_delta_quantiles
-        self.t_delta_max = t_deltas.max()
+        self.t_delta_max = t_delta_moments.max
         self.t_delta_mean_max = t_delta_maxes.mean()
-        self.t_delta_mean = t_deltas.mean()
-        self.t_delta_sd = t_deltas.std()
+        self.t_delta_mean = t_delta_moments.mean
+        self.t_delta_sd = t_delta_moments.sd
 
-        self.time_X_limit = np.quantile(time_X, 0.75)
-        self.time_X_quantiles = np.quantile(time_X, q)
+        time_X_quantiles = np.quantile(time_X, np.concatenate([q, [0.75]]))
+        self.time_X_limit = time_X_quantiles[-1]
+        self.time_X_quantiles = time_X_quantiles[:-1]
         self.time_X_max = time_X.max()
         self.time_X_mean = time_X.mean()
         self.time_X_sd = time_X.std()
@@ -737,15 +733,30 @@ class Model(object):
                 self.X_processed = X_processed
 
                 self.X_batch = X_batch
-                self.time_X = tf.placeholder_with_default(
+
+                # Timestamps and masks are fed with one slot per time base (e.g. per predictor file)
+                # and broadcast to impulses in-graph using the impulse-to-slot index time_X_ix.
+                # By default, slots correspond one-to-one to impulses.
+                self.time_X_compact = tf.placeholder_with_default(
                     tf.zeros([X_batch, self.history_length,  max(n_impulse, 1)], dtype=self.FLOAT_TF),
-                    shape=[None, None, max(n_impulse, 1)],
-                    name='time_X'
+                    shape=[None, None, None],
+                    name='time_X_compact'
                 )
-
-                self.time_X_mask = tf.placeholder_with_default(
-                    tf.ones([X_batch, self.history_length, max(n_impulse, 1)], dtype=self.FLOAT_TF),
-                    shape=[None, None, max(n_impulse, 1)],
+                # Masks are fed as booleans and only cast to float in-graph
+                self.time_X_mask_compact = tf.placeholder_with_default(
+                    tf.ones([X_batch, self.history_length, max(n_impulse, 1)], dtype=tf.bool),
+                    shape=[None, None, None],
+                    name='time_X_mask_compact'
+                )
+                self.time_X_ix = tf.placeholder_with_default(
+                    tf.range(max(n_impulse, 1), dtype=self.INT_TF),
+                    shape=[max(n_impulse, 1)],
+                    name='time_X_ix'
+                )
+                self.time_X = tf.gather(self.time_X_compact, self.time_X_ix, axis=2, name='time_X')
+                self.time_X_mask = tf.cast(
+                    tf.gather(self.time_X_mask_compact, self.time_X_ix, axis=2),
+                    dtype=self.FLOAT_TF,
                     name='time_X_mask'
                 )
 
@@ -770,7 +781,14 @@ class Model(object):
                     name='gf_y'
                 )
 
-                self.max_tdelta_batch = tf.reduce_max(self.t_delta)
+                # Maximum time offset of the untrimmed batch, fed when the history axis of the batch has been
+                # trimmed (see ``trim_history()``), since dropped padding cells still count toward the maximum
+                self.max_tdelta_batch_untrimmed = tf.placeholder_with_default(
+                    tf.constant(-np.inf, dtype=self.FLOAT_TF),
+                    shape=[],
+                    name='max_tdelta_batch_untrimmed'
+                )
+                self.max_tdelta_batch = tf.maximum(tf.reduce_max(self.t_delta), self.max_tdelta_batch_untrimmed)
 
                 # Tensor used for interpolated IRF composition
                 self.interpolation_support = tf.linspace(0., self.max_tdelta_batch, self.n_interp)[..., None]
@@ -2512,6 +2530,34 @@ class Model(object):
 
         return impulse_name in self.non_dirac_impulses
 
+    def _history_trimmable(self):
+        """
+        Check whether the history axis of training minibatches can be trimmed to the longest history they contain (see **n_history_buckets**) without changing the model objective.
+        Centered padding cells are nonzero and still contribute to the convolution, so inputs must not be centered.
+
+        :return: ``bool``; whether histories can be trimmed.
+        """
+
+        return not self.center_inputs
+
+    def _get_impulse_feed(self, X_2d, time_X_2d, time_X_mask, time_X_ix):
+        """
+        Construct the part of a feed dict that supplies expanded impulse data to the model.
+
+        :param X_2d: ``numpy`` array; expanded impulse array, as returned by ``build_CDR_impulses()``.
+        :param time_X_2d: ``numpy`` array; expanded timestamp array in compact format (one slot per time base).
+        :param time_X_mask: ``numpy`` array; expanded boolean mask in compact format.
+        :param time_X_ix: ``numpy`` vector; time slot of each impulse.
+        :return: ``dict``; map from input tensors to data.
+        """
+
+        return {
+            self.X: X_2d,
+            self.time_X_compact: time_X_2d,
+            self.time_X_mask_compact: time_X_mask,
+            self.time_X_ix: time_X_ix
+        }
+
     def fit(self,
             X,
             y,
@@ -2525,7 +2571,7 @@ class Model(object):
         """
         Fit the model.
 
-        :param X: list of ``pandas`` tables; matrices of independent variables, grouped by series and temporally sorted.
+        :param X: list of ``pandas`` tables or ``ImpulseStore``; matrices of independent variables, grouped by series and temporally sorted.
             Each element of **X** must contain the following columns (additional columns are ignored):
 
             * ``time``: Timestamp associated with each observation in **X**
@@ -2569,20 +2615,62 @@ class Model(object):
         y_dv = np.array(y[self.dv], dtype=self.FLOAT_NP)
         gf_y = np.array(y_rangf, dtype=self.INT_NP)
 
-        X_2d, time_X_2d, time_X_mask = build_CDR_impulses(
-            X,
-            first_obs,
-            last_obs,
-            impulse_names,
-            time_y=time_y,
-            history_length=self.history_length,
-            X_response_aligned_predictor_names=X_response_aligned_predictor_names,
-            X_response_aligned_predictors=X_response_aligned_predictors,
-            X_2d_predictor_names=X_2d_predictor_names,
-            X_2d_predictors=X_2d_predictors,
-            int_type=self.int_type,
-            float_type=self.float_type,
-        )
+        if self.memmap_history:
+            impulses = build_CDR_impulses_memmap(
+                X,
+                first_obs,
+                last_obs,
+                impulse_names,
+                self.outdir + '/history',
+                time_y=time_y,
+                history_length=self.history_length,
+                X_response_aligned_predictor_names=X_response_aligned_predictor_names,
+                X_response_aligned_predictors=X_response_aligned_predictors,
+                X_2d_predictor_names=X_2d_predictor_names,
+                X_2d_predictors=X_2d_predictors,
+                int_type=self.int_type,
+                float_type=self.float_type,
+                chunk_size=self.memmap_block_size
+            )
+        elif self.lazy_history_expansion:
+            impulses = LazyCDRImpulses(
+                X,
+                first_obs,
+                last_obs,
+                impulse_names,
+                time_y=time_y,
+                history_length=self.history_length,
+                X_response_aligned_predictor_names=X_response_aligned_predictor_names,
+                X_response_aligned_predictors=X_response_aligned_predictors,
+                X_2d_predictor_names=X_2d_predictor_names,
+                X_2d_predictors=X_2d_predictors,
+                int_type=self.int_type,
+                float_type=self.float_type,
+                compact_time=True
+            )
+        else:
+            impulses = None
+            X_2d, time_X_2d, time_X_mask, time_X_ix = build_CDR_impulses(
+                X,
+                first_obs,
+                last_obs,
+                impulse_names,
+                time_y=time_y,
+                history_length=self.history_length,
+                X_response_aligned_predictor_names=X_response_aligned_predictor_names,
+                X_response_aligned_predictors=X_response_aligned_predictors,
+                X_2d_predictor_names=X_2d_predictor_names,
+                X_2d_predictors=X_2d_predictors,
+                int_type=self.int_type,
+                float_type=self.float_type,
+                compact_time=True
+            )
+
+        # Row indices of training responses, used to look up minibatches when histories are expanded lazily or read from disk
+        train_ix = np.arange(len(y))
+        if self.n_history_buckets:
+            history_lengths = get_history_lengths(first_obs, last_obs, self.history_length)
+        trim_histories = self.n_history_buckets and self._history_trimmable()
 
         if self.use_crossval:
             sel = ~y[self.crossval_factor].isin(self.crossval_folds)
@@ -2591,9 +2679,13 @@ class Model(object):
             time_y = time_y[sel]
             y_dv = y_dv[sel]
             gf_y = gf_y[sel]
-            X_2d = X_2d[sel]
-            time_X_2d = time_X_2d[sel]
-            time_X_mask = time_X_mask[sel]
+            train_ix = train_ix[sel]
+            if self.n_history_buckets:
+                history_lengths = history_lengths[np.asarray(sel)]
+            if impulses is None:
+                X_2d = X_2d[sel]
+                time_X_2d = time_X_2d[sel]
+                time_X_mask = time_X_mask[sel]
 
             n_train = len(y_dv)
         else:
@@ -2608,7 +2700,21 @@ class Model(object):
 
         stderr('Correlation matrix for input variables:\n')
         impulse_names_2d = [x for x in impulse_names if x in X_2d_predictor_names]
-        rho = corr_cdr(X_2d, impulse_names, impulse_names_2d, time_X_2d, time_X_mask)
+        # Subsamples are drawn from a dedicated generator, so that the report does not change the training permutations
+        corr_random_state = np.random.RandomState(0)
+        if impulses is None:
+            rho = corr_cdr(X_2d, impulse_names, impulse_names_2d, time_X_2d, time_X_mask, time_ix=time_X_ix, n_samples=self.corr_n_samples, random_state=corr_random_state)
+        else:
+            # Expanding the full dataset is avoided by default, so correlations are estimated from a sample of responses
+            n_samples = self.corr_n_samples
+            if n_samples is None and np.isfinite(self.eval_minibatch_size):
+                n_samples = self.eval_minibatch_size
+            if n_samples is not None and n_samples < len(train_ix):
+                sample_ix = np.sort(corr_random_state.permutation(train_ix)[:int(n_samples)])
+            else:
+                sample_ix = train_ix
+            X_2d_sample, time_X_2d_sample, time_X_mask_sample, time_X_ix = impulses[sample_ix]
+            rho = corr_cdr(X_2d_sample, impulse_names, impulse_names_2d, time_X_2d_sample, time_X_mask_sample, time_ix=time_X_ix)
         stderr(str(rho) + '\n\n')
 
         if False:
@@ -2640,7 +2746,15 @@ class Model(object):
                         self.save()
 
                     while not self.has_converged() and self.global_step.eval(session=self.sess) < n_iter:
-                        p, p_inv = get_random_permutation(n_train)
+                        if self.memmap_history:
+                            p, p_inv = get_block_permutation(n_train, self.memmap_block_size)
+                            # Sorting each minibatch keeps reads from the memory-mapped inputs sequential
+                            minibatches = [np.sort(p[j:j+minibatch_size]) for j in range(0, n_train, minibatch_size)]
+                        elif self.n_history_buckets:
+                            minibatches = get_bucketed_minibatches(history_lengths, minibatch_size, self.n_history_buckets)
+                        else:
+                            p, p_inv = get_random_permutation(n_train)
+                            minibatches = [p[j:j+minibatch_size] for j in range(0, n_train, minibatch_size)]
                         t0_iter = pytime.time()
                         stderr('-' * 50 + '\n')
                         stderr('Iteration %d\n' % int(self.global_step.eval(session=self.sess) + 1))
@@ -2657,17 +2771,32 @@ class Model(object):
                         if self.loss_filter_n_sds:
                             n_dropped = 0.
 
-                        for j in range(0, n_train, minibatch_size):
-                            indices = p[j:j+minibatch_size]
+                        for j, indices in enumerate(minibatches):
+                            if impulses is None:
+                                X_2d_cur = X_2d[indices]
+                                time_X_2d_cur = time_X_2d[indices]
+                                time_X_mask_cur = time_X_mask[indices]
+                            else:
+                                X_2d_cur, time_X_2d_cur, time_X_mask_cur, time_X_ix = impulses[train_ix[indices]]
                             fd_minibatch = {
-                                self.X: X_2d[indices],
-                                self.time_X: time_X_2d[indices],
-                                self.time_X_mask: time_X_mask[indices],
                                 self.y: y_dv[indices],
                                 self.time_y: time_y[indices],
                                 self.gf_y: gf_y[indices] if len(gf_y > 0) else gf_y,
                                 self.training: not self.predict_mode
                             }
+                            if trim_histories:
+                                # Histories are right-aligned, so cells beyond the longest history in the batch are all padding
+                                n_history = max(history_lengths[indices].max(), 1)
+                                X_2d_cur, time_X_2d_cur, time_X_mask_cur, t_delta_max = trim_history(
+                                    X_2d_cur,
+                                    time_X_2d_cur,
+                                    time_X_mask_cur,
+                                    time_X_ix,
+                                    time_y[indices],
+                                    n_history
+                                )
+                                fd_minibatch[self.max_tdelta_batch_untrimmed] = t_delta_max
+                            fd_minibatch.update(self._get_impulse_feed(X_2d_cur, time_X_2d_cur, time_X_mask_cur, time_X_ix))
 
                             info_dict = self.run_train_step(fd_minibatch)
 
@@ -2693,7 +2822,7 @@ class Model(object):
                                 kl_loss_total += kl_loss_cur
                                 pb_update.append(('kl', kl_loss_cur))
 
-                            pb.update((j/minibatch_size)+1, values=pb_update)
+                            pb.update(j+1, values=pb_update)
 
                             # if self.global_batch_step.eval(session=self.sess) % 1000 == 0:
                             #     self.save()
@@ -2748,6 +2877,19 @@ class Model(object):
 
 
                 if not self.training_complete.eval(session=self.sess) or force_training_evaluation:
+                    # Prepare the training inputs once for both predictions and likelihoods
+                    inputs = self.prepare_inputs(
+                        X,
+                        y.time,
+                        y[self.form.rangf],
+                        first_obs,
+                        last_obs,
+                        X_response_aligned_predictor_names=X_response_aligned_predictor_names,
+                        X_response_aligned_predictors=X_response_aligned_predictors,
+                        X_2d_predictor_names=X_2d_predictor_names,
+                        X_2d_predictors=X_2d_predictors
+                    )
+
                     # Extract and save predictions
                     preds = self.predict(
                         X,
@@ -2758,7 +2900,8 @@ class Model(object):
                         X_response_aligned_predictor_names=X_response_aligned_predictor_names,
                         X_response_aligned_predictors=X_response_aligned_predictors,
                         X_2d_predictor_names=X_2d_predictor_names,
-                        X_2d_predictors=X_2d_predictors
+                        X_2d_predictors=X_2d_predictors,
+                        inputs=inputs
                     )
 
                     with open(self.outdir + '/obs_train.txt', 'w') as o_file:
@@ -2792,6 +2935,7 @@ class Model(object):
                         X_response_aligned_predictors=X_response_aligned_predictors,
                         X_2d_predictor_names=X_2d_predictor_names,
                         X_2d_predictors=X_2d_predictors,
+                        inputs=inputs
                     )
                     with open(self.outdir + '/loglik_train.txt','w') as l_file:
                         for i in range(len(training_logliks)):
@@ -2846,6 +2990,78 @@ class Model(object):
 
                     self.save()
 
+    def prepare_inputs(
+            self,
+            X,
+            y_time,
+            y_rangf,
+            first_obs,
+            last_obs,
+            X_response_aligned_predictor_names=None,
+            X_response_aligned_predictors=None,
+            X_2d_predictor_names=None,
+            X_2d_predictors=None
+    ):
+        """
+        Prepare a dataset for evaluation, i.e. map random grouping factor levels to model indices and expand impulse histories (or set them up for lazy expansion if **lazy_history_expansion** is ``True``).
+        The result can be passed as the **inputs** argument of ``predict()``, ``log_lik()``, ``loss()``, and ``convolve_inputs()`` to avoid repeating this work when evaluating the same data several times.
+
+        :param X: list of ``pandas`` tables; matrices of independent variables, grouped by series and temporally sorted.
+        :param y_time: ``pandas`` ``Series`` or 1D ``numpy`` array; timestamps for the regression targets, grouped by series.
+        :param y_rangf: ``pandas`` ``DataFrame``; random grouping factor values (if applicable).
+        :param first_obs: list of ``pandas`` ``Series`` or 1D ``numpy`` array; row indices in ``X`` of the start of the series associated with the current regression target.
+        :param last_obs: list of ``pandas`` ``Series`` or 1D ``numpy`` array; row indices in ``X`` of the most recent observation in the series associated with the current regression target.
+        :param X_response_aligned_predictor_names: ``list`` or ``None``; List of column names for response-aligned predictors (predictors measured for every response rather than for every input) if applicable, ``None`` otherwise.
+        :param X_response_aligned_predictors: ``pandas`` table; Response-aligned predictors if applicable, ``None`` otherwise.
+        :param X_2d_predictor_names: ``list`` or ``None``; List of column names 2D predictors (predictors whose value depends on properties of the most recent impulse) if applicable, ``None`` otherwise.
+        :param X_2d_predictors: ``pandas`` table; 2D predictors if applicable, ``None`` otherwise.
+        :return: ``CDRInputs``; the prepared inputs.
+        """
+
+        impulse_names = self.impulse_names
+
+        y_rangf = pd.DataFrame(y_rangf).copy()
+        for i in range(len(self.rangf)):
+            c = self.rangf[i]
+            y_rangf[c] = pd.Series(y_rangf[c].astype(str)).map(self.rangf_map[i])
+        time_y = np.array(y_time, dtype=self.FLOAT_NP)
+        gf_y = np.array(y_rangf, dtype=self.INT_NP)
+
+        if self.lazy_history_expansion and np.isfinite(self.eval_minibatch_size):
+            impulses = LazyCDRImpulses(
+                X,
+                first_obs,
+                last_obs,
+                impulse_names,
+                time_y=time_y,
+                history_length=self.history_length,
+                X_response_aligned_predictor_names=X_response_aligned_predictor_names,
+                X_response_aligned_predictors=X_response_aligned_predictors,
+                X_2d_predictor_names=X_2d_predictor_names,
+                X_2d_predictors=X_2d_predictors,
+                int_type=self.int_type,
+                float_type=self.float_type,
+                compact_time=True
+            )
+        else:
+            impulses = ExpandedCDRImpulses(*build_CDR_impulses(
+                X,
+                first_obs,
+                last_obs,
+                impulse_names,
+                time_y=time_y,
+                history_length=self.history_length,
+                X_response_aligned_predictor_names=X_response_aligned_predictor_names,
+                X_response_aligned_predictors=X_response_aligned_predictors,
+                X_2d_predictor_names=X_2d_predictor_names,
+                X_2d_predictors=X_2d_predictors,
+                int_type=self.int_type,
+                float_type=self.float_type,
+                compact_time=True
+            ))
+
+        return CDRInputs(time_y, gf_y, impulses)
+
     def predict(
             self,
             X,
@@ -2860,6 +3076,7 @@ class Model(object):
             n_samples=None,
             algorithm='MAP',
             standardize_response=False,
+            inputs=None,
             verbose=True
     ):
         """
@@ -2888,6 +3105,7 @@ class Model(object):
         :param n_samples: ``int`` or ``None``; number of posterior samples to draw if Bayesian, ignored otherwise. If ``None``, use model defaults.
         :param algorithm: ``str``; algorithm to use for extracting predictions, one of [``MAP``, ``sampling``].
         :param standardize_response: ``bool``; Whether to report response using standard units. Ignored unless model was fitted using ``standardize_response==True``.
+        :param inputs: ``CDRInputs`` or ``None``; inputs prepared by ``prepare_inputs()`` for this dataset, to be reused across calls. If ``None``, prepared from the other arguments.
         :param verbose: ``bool``; Report progress and metrics to standard error.
         :return: 1D ``numpy`` array; mean network predictions for regression targets (same length and sort order as ``y_time``).
         """
@@ -2901,40 +3119,33 @@ class Model(object):
         if verbose:
             stderr('Computing predictions...\n')
 
-        for i in range(len(self.rangf)):
-            c = self.rangf[i]
-            y_rangf[c] = pd.Series(y_rangf[c].astype(str)).map(self.rangf_map[i])
-        time_y = np.array(y_time, dtype=self.FLOAT_NP)
-        gf_y = np.array(y_rangf, dtype=self.INT_NP)
-
-        X_2d, time_X_2d, time_X_mask = build_CDR_impulses(
-            X,
-            first_obs,
-            last_obs,
-            impulse_names,
-            time_y=time_y,
-            history_length=self.history_length,
-            X_response_aligned_predictor_names=X_response_aligned_predictor_names,
-            X_response_aligned_predictors=X_response_aligned_predictors,
-            X_2d_predictor_names=X_2d_predictor_names,
-            X_2d_predictors=X_2d_predictors,
-            int_type=self.int_type,
-            float_type=self.float_type,
-        )
+        if inputs is None:
+            inputs = self.prepare_inputs(
+                X,
+                y_time,
+                y_rangf,
+                first_obs,
+                last_obs,
+                X_response_aligned_predictor_names=X_response_aligned_predictor_names,
+                X_response_aligned_predictors=X_response_aligned_predictors,
+                X_2d_predictor_names=X_2d_predictor_names,
+                X_2d_predictors=X_2d_predictors
+            )
+        time_y = inputs.time_y
+        gf_y = inputs.gf_y
+        impulses = inputs.impulses
 
         with self.sess.as_default():
             with self.sess.graph.as_default():
                 self.set_predict_mode(True)
 
-                fd = {
-                    self.X: X_2d,
-                    self.time_X: time_X_2d,
-                    self.time_y: time_y,
-                    self.gf_y: gf_y,
-                    self.training: not self.predict_mode
-                }
-
                 if not np.isfinite(self.eval_minibatch_size):
+                    fd = {
+                        self.time_y: time_y,
+                        self.gf_y: gf_y,
+                        self.training: not self.predict_mode
+                    }
+                    fd.update(self._get_impulse_feed(*impulses[:]))
                     preds = self.run_predict_op(
                         fd,
                         standardize_response=standardize_response,
@@ -2948,14 +3159,13 @@ class Model(object):
                     for i in range(0, len(y_time), self.eval_minibatch_size):
                         if verbose:
                             stderr('\rMinibatch %d/%d' %((i/self.eval_minibatch_size)+1, n_eval_minibatch))
+                        X_2d_cur, time_X_2d_cur, time_X_mask_cur, time_X_ix = impulses[i:i + self.eval_minibatch_size]
                         fd_minibatch = {
-                            self.X: X_2d[i:i + self.eval_minibatch_size],
-                            self.time_X: time_X_2d[i:i + self.eval_minibatch_size],
-                            self.time_X_mask: time_X_mask[i:i + self.eval_minibatch_size],
                             self.time_y: time_y[i:i + self.eval_minibatch_size],
                             self.gf_y: gf_y[i:i + self.eval_minibatch_size] if len(gf_y) > 0 else gf_y,
                             self.training: not self.predict_mode
                         }
+                        fd_minibatch.update(self._get_impulse_feed(X_2d_cur, time_X_2d_cur, time_X_mask_cur, time_X_ix))
                         preds[i:i + self.eval_minibatch_size] = self.run_predict_op(
                             fd_minibatch,
                             standardize_response=standardize_response,
@@ -2982,6 +3192,7 @@ class Model(object):
             n_samples=None,
             algorithm='MAP',
             standardize_response=False,
+            inputs=None,
             verbose=True
     ):
         """
@@ -3009,6 +3220,7 @@ class Model(object):
         :param n_samples: ``int`` or ``None``; number of posterior samples to draw if Bayesian, ignored otherwise. If ``None``, use model defaults.
         :param algorithm: ``str``; algorithm to use for extracting predictions, one of [``MAP``, ``sampling``].
         :param standardize_response: ``bool``; Whether to report response using standard units. Ignored unless model was fitted using ``standardize_response==True``.
+        :param inputs: ``CDRInputs`` or ``None``; inputs prepared by ``prepare_inputs()`` for this dataset, to be reused across calls. If ``None``, prepared from the other arguments.
         :param verbose: ``bool``; Report progress and metrics to standard error.
         :return: ``numpy`` array of shape [len(X)], log likelihood of each data point.
         """
@@ -3022,30 +3234,23 @@ class Model(object):
         if verbose:
             stderr('Computing likelihoods...\n')
 
-        y_rangf = y[self.rangf]
-        for i in range(len(self.rangf)):
-            c = self.rangf[i]
-            y_rangf[c] = pd.Series(y_rangf[c].astype(str)).map(self.rangf_map[i])
-
-        first_obs, last_obs = get_first_last_obs_lists(y)
-        time_y = np.array(y.time, dtype=self.FLOAT_NP)
+        if inputs is None:
+            first_obs, last_obs = get_first_last_obs_lists(y)
+            inputs = self.prepare_inputs(
+                X,
+                y.time,
+                y[self.rangf],
+                first_obs,
+                last_obs,
+                X_response_aligned_predictor_names=X_response_aligned_predictor_names,
+                X_response_aligned_predictors=X_response_aligned_predictors,
+                X_2d_predictor_names=X_2d_predictor_names,
+                X_2d_predictors=X_2d_predictors
+            )
+        time_y = inputs.time_y
         y_dv = np.array(y[self.dv], dtype=self.FLOAT_NP)
-        gf_y = np.array(y_rangf, dtype=self.INT_NP)
-
-        X_2d, time_X_2d, time_X_mask = build_CDR_impulses(
-            X,
-            first_obs,
-            last_obs,
-            impulse_names,
-            time_y=time_y,
-            history_length=self.history_length,
-            X_response_aligned_predictor_names=X_response_aligned_predictor_names,
-            X_response_aligned_predictors=X_response_aligned_predictors,
-            X_2d_predictor_names=X_2d_predictor_names,
-            X_2d_predictors=X_2d_predictors,
-            int_type=self.int_type,
-            float_type=self.float_type,
-        )
+        gf_y = inputs.gf_y
+        impulses = inputs.impulses
 
         with self.sess.as_default():
             with self.sess.graph.as_default():
@@ -3053,14 +3258,12 @@ class Model(object):
 
                 if not np.isfinite(self.eval_minibatch_size):
                     fd = {
-                        self.X: X_2d,
-                        self.time_X: time_X_2d,
-                        self.time_X_mask: time_X_mask,
                         self.time_y: time_y,
                         self.gf_y: gf_y,
                         self.y: y_dv,
                         self.training: not self.predict_mode
                     }
+                    fd.update(self._get_impulse_feed(*impulses[:]))
                     log_lik = self.run_loglik_op(
                         fd,
                         standardize_response=standardize_response,
@@ -3075,14 +3278,12 @@ class Model(object):
                         if verbose:
                             stderr('\rMinibatch %d/%d' %((i/self.eval_minibatch_size)+1, n_eval_minibatch))
                         fd_minibatch = {
-                            self.X: X_2d[i:i + self.eval_minibatch_size],
-                            self.time_X: time_X_2d[i:i + self.eval_minibatch_size],
-                            self.time_X_mask: time_X_mask[i:i + self.eval_minibatch_size],
                             self.time_y: time_y[i:i + self.eval_minibatch_size],
                             self.gf_y: gf_y[i:i + self.eval_minibatch_size] if len(gf_y) > 0 else gf_y,
                             self.y: y_dv[i:i+self.eval_minibatch_size],
                             self.training: not self.predict_mode
                         }
+                        fd_minibatch.update(self._get_impulse_feed(*impulses[i:i + self.eval_minibatch_size]))
                         log_lik[i:i+self.eval_minibatch_size] = self.run_loglik_op(
                             fd_minibatch,
                             standardize_response=standardize_response,
@@ -3109,6 +3310,7 @@ class Model(object):
             n_samples=None,
             algorithm='MAP',
             training=None,
+            inputs=None,
             verbose=True
     ):
         """
@@ -3136,6 +3338,7 @@ class Model(object):
         :param X_2d_predictors: ``pandas`` table; 2D predictors if applicable, ``None`` otherwise.
         :param n_samples: ``int`` or ``None``; number of posterior samples to draw if Bayesian, ignored otherwise. If ``None``, use model defaults.
         :param algorithm: ``str``; algorithm to use for extracting predictions, one of [``MAP``, ``sampling``].
+        :param inputs: ``CDRInputs`` or ``None``; inputs prepared by ``prepare_inputs()`` for this dataset, to be reused across calls. If ``None``, prepared from the other arguments.
         :param verbose: ``bool``; Report progress and metrics to standard error.
         :return: ``numpy`` array of shape [len(X)], log likelihood of each data point.
         """
@@ -3149,30 +3352,23 @@ class Model(object):
         if verbose:
             stderr('Computing loss using objective function...\n')
 
-        y_rangf = y[self.rangf]
-        for i in range(len(self.rangf)):
-            c = self.rangf[i]
-            y_rangf[c] = pd.Series(y_rangf[c].astype(str)).map(self.rangf_map[i])
-
-        first_obs, last_obs = get_first_last_obs_lists(y)
-        time_y = np.array(y.time, dtype=self.FLOAT_NP)
+        if inputs is None:
+            first_obs, last_obs = get_first_last_obs_lists(y)
+            inputs = self.prepare_inputs(
+                X,
+                y.time,
+                y[self.rangf],
+                first_obs,
+                last_obs,
+                X_response_aligned_predictor_names=X_response_aligned_predictor_names,
+                X_response_aligned_predictors=X_response_aligned_predictors,
+                X_2d_predictor_names=X_2d_predictor_names,
+                X_2d_predictors=X_2d_predictors
+            )
+        time_y = inputs.time_y
         y_dv = np.array(y[self.dv], dtype=self.FLOAT_NP)
-        gf_y = np.array(y_rangf, dtype=self.INT_NP)
-
-        X_2d, time_X_2d, time_X_mask = build_CDR_impulses(
-            X,
-            first_obs,
-            last_obs,
-            impulse_names,
-            time_y=time_y,
-            history_length=self.history_length,
-            X_response_aligned_predictor_names=X_response_aligned_predictor_names,
-            X_response_aligned_predictors=X_response_aligned_predictors,
-            X_2d_predictor_names=X_2d_predictor_names,
-            X_2d_predictors=X_2d_predictors,
-            int_type=self.int_type,
-            float_type=self.float_type,
-        )
+        gf_y = inputs.gf_y
+        impulses = inputs.impulses
 
         with self.sess.as_default():
             with self.sess.graph.as_default():
@@ -3183,14 +3379,12 @@ class Model(object):
 
                 if not np.isfinite(self.minibatch_size):
                     fd = {
-                        self.X: X_2d,
-                        self.time_X: time_X_2d,
-                        self.time_X_mask: time_X_mask,
                         self.time_y: time_y,
                         self.gf_y: gf_y,
                         self.y: y_dv,
                         self.training: training
                     }
+                    fd.update(self._get_impulse_feed(*impulses[:]))
                     loss = self.run_loss_op(
                         fd,
                         n_samples=n_samples,
@@ -3203,15 +3397,14 @@ class Model(object):
                     for i in range(0, n_minibatch):
                         if verbose:
                             stderr('\rMinibatch %d/%d' %(i+1, n_minibatch))
+                        j = i * self.minibatch_size
                         fd_minibatch = {
-                            self.X: X_2d[i:i + self.minibatch_size],
-                            self.time_X: time_X_2d[i:i + self.minibatch_size],
-                            self.time_X_mask: time_X_mask[i:i + self.minibatch_size],
-                            self.time_y: time_y[i:i + self.minibatch_size],
-                            self.gf_y: gf_y[i:i + self.minibatch_size] if len(gf_y) > 0 else gf_y,
-                            self.y: y_dv[i:i+self.minibatch_size],
+                            self.time_y: time_y[j:j + self.minibatch_size],
+                            self.gf_y: gf_y[j:j + self.minibatch_size] if len(gf_y) > 0 else gf_y,
+                            self.y: y_dv[j:j + self.minibatch_size],
                             self.training: training
                         }
+                        fd_minibatch.update(self._get_impulse_feed(*impulses[j:j + self.minibatch_size]))
                         loss[i] = self.run_loss_op(
                             fd_minibatch,
                             n_samples=n_samples,
@@ -3239,6 +3432,7 @@ class Model(object):
             n_samples=None,
             algorithm='MAP',
             standardize_response=False,
+            inputs=None,
             verbose=True
     ):
         """
@@ -3266,6 +3460,7 @@ class Model(object):
         :param n_samples: ``int`` or ``None``; number of posterior samples to draw if Bayesian, ignored otherwise. If ``None``, use model defaults.
         :param algorithm: ``str``; algorithm to use for extracting predictions, one of [``MAP``, ``sampling``].
         :param standardize_response: ``bool``; Whether to report response using standard units. Ignored unless ``scaled==True`` and model was fitted using ``standardize_response==True``.
+        :param inputs: ``CDRInputs`` or ``None``; inputs prepared by ``prepare_inputs()`` for this dataset, to be reused across calls. If ``None``, prepared from the other arguments.
         :param verbose: ``bool``; Report progress and metrics to standard error.
         :return: ``numpy`` array of shape [len(X)], log likelihood of each data point.
         """
@@ -3276,59 +3471,45 @@ class Model(object):
 
         impulse_names  = self.impulse_names
 
-        y_rangf = y[self.rangf]
-        for i in range(len(self.rangf)):
-            c = self.rangf[i]
-            y_rangf[c] = pd.Series(y_rangf[c].astype(str)).map(self.rangf_map[i])
-
-        first_obs, last_obs = get_first_last_obs_lists(y)
-        time_y = np.array(y.time, dtype=self.FLOAT_NP)
-        gf_y = np.array(y_rangf, dtype=self.INT_NP)
-
-        X_2d, time_X_2d, time_X_mask = build_CDR_impulses(
-            X,
-            first_obs,
-            last_obs,
-            impulse_names,
-            time_y=time_y,
-            history_length=self.history_length,
-            X_response_aligned_predictor_names=X_response_aligned_predictor_names,
-            X_response_aligned_predictors=X_response_aligned_predictors,
-            X_2d_predictor_names=X_2d_predictor_names,
-            X_2d_predictors=X_2d_predictors,
-            int_type=self.int_type,
-            float_type=self.float_type,
-        )
+        if inputs is None:
+            first_obs, last_obs = get_first_last_obs_lists(y)
+            inputs = self.prepare_inputs(
+                X,
+                y.time,
+                y[self.rangf],
+                first_obs,
+                last_obs,
+                X_response_aligned_predictor_names=X_response_aligned_predictor_names,
+                X_response_aligned_predictors=X_response_aligned_predictors,
+                X_2d_predictor_names=X_2d_predictor_names,
+                X_2d_predictors=X_2d_predictors
+            )
+        time_y = inputs.time_y
+        gf_y = inputs.gf_y
+        impulses = inputs.impulses
 
         with self.sess.as_default():
             with self.sess.graph.as_default():
                 self.set_predict_mode(True)
 
-                fd = {
-                    self.time_y: time_y,
-                    self.gf_y: gf_y,
-                    self.X: X_2d,
-                    self.time_X: time_X_2d,
-                    self.time_X_mask: time_X_mask,
-                    self.training: not self.predict_mode
-                }
-
                 fd_minibatch = {
-                    self.X: fd[self.X],
-                    self.time_X: fd[self.time_X],
                     self.training: not self.predict_mode
                 }
 
                 X_conv = []
+                X_input = []
+                time_X_input = []
                 n_eval_minibatch = math.ceil(len(y) / self.eval_minibatch_size)
                 for i in range(0, len(y), self.eval_minibatch_size):
                     if verbose:
                         stderr('\rMinibatch %d/%d' % ((i / self.eval_minibatch_size) + 1, n_eval_minibatch))
                     fd_minibatch[self.time_y] = time_y[i:i + self.eval_minibatch_size]
                     fd_minibatch[self.gf_y] = gf_y[i:i + self.eval_minibatch_size]
-                    fd_minibatch[self.X] = X_2d[i:i + self.eval_minibatch_size]
-                    fd_minibatch[self.time_X] = time_X_2d[i:i + self.eval_minibatch_size]
-                    fd_minibatch[self.time_X_mask] = time_X_mask[i:i + self.eval_minibatch_size]
+                    X_2d_cur, time_X_2d_cur, time_X_mask_cur, time_X_ix = impulses[i:i + self.eval_minibatch_size]
+                    # Keep only the most recent timestep for the input correlation summary below
+                    X_input.append(X_2d_cur[:, -1])
+                    time_X_input.append(time_X_2d_cur[:, -1])
+                    fd_minibatch.update(self._get_impulse_feed(X_2d_cur, time_X_2d_cur, time_X_mask_cur, time_X_ix))
                     X_conv_cur = self.run_conv_op(
                         fd_minibatch,
                         scaled=scaled,
@@ -3355,9 +3536,12 @@ class Model(object):
                 convolution_summary += 'Correlation matrix of convolved predictors:\n\n'
                 convolution_summary += corr_conv + '\n\n'
 
-                select = np.where(np.all(np.isclose(time_X_2d[:,-1], time_y[..., None]), axis=-1))[0]
+                X_input = np.concatenate(X_input, axis=0)
+                time_X_input = np.concatenate(time_X_input, axis=0)
+                select = np.where(np.all(np.isclose(time_X_input, time_y[..., None]), axis=-1))[0]
 
-                X_input = X_2d[:,-1,:][select]
+                X_all = X_input
+                X_input = X_input[select]
 
                 extra_cols = []
                 for c in y.columns:
@@ -3370,7 +3554,7 @@ class Model(object):
                     for i in range(len(self.impulse_names)):
                         c = self.impulse_names[i]
                         if c not in out_plus:
-                            out_plus[c] = X_2d[:,-1,i]
+                            out_plus[c] = X_all[:,i]
                     corr_conv = out_plus.iloc[select].corr().to_string()
                     convolution_summary += '-' * 50 + '\n'
                     convolution_summary += 'Full correlation matrix of input and convolved predictors:\n'
@@ -3,7 +3,7 @@ import sys
 import os
 import pandas as pd
 from cdr.config import Config
-from cdr.io import read_data
+from cdr.io import read_data, get_projection, use_projection, get_bundle_path, load_bundle
 from cdr.formula import Formula
 from cdr.data import preprocess_data, filter_invalid_responses
 from cdr.util import load_cdr, filter_models, get_partition_list, paths_from_partition_cliarg, stderr
@@ -54,22 +54,35 @@ if __name__ == '__main__':
             partitions = get_partition_list(p_name)
             partition_str = '-'.join(partitions)
             X_paths, y_paths = paths_from_partition_cliarg(partitions, p)
-            X, y = read_data(
-                X_paths,
-                y_paths,
-                p.series_ids,
-                sep=p.sep,
-                categorical_columns=list(set(p.split_ids + p.series_ids + [v for x in cdr_formula_list for v in x.rangf]))
-            )
-            X, y, select, X_response_aligned_predictor_names, X_response_aligned_predictors, X_2d_predictor_names, X_2d_predictors = preprocess_data(
-                X,
-                y,
-                cdr_formula_list,
-                p.series_ids,
-                filters=p.filters,
-                compute_history=True,
-                history_length=p.history_length
-            )
+            data = load_bundle(get_bundle_path(X_paths, y_paths, p), cdr_formula_list)
+            if data is None:
+                X, y, series_index = read_data(
+                    X_paths,
+                    y_paths,
+                    p.series_ids,
+                    sep=p.sep,
+                    categorical_columns=list(set(p.split_ids + p.series_ids + [v for x in cdr_formula_list for v in x.rangf])),
+                    usecols=get_projection(cdr_formula_list, p) if use_projection(p, cdr_models) else None,
+                    float_type=p.data_float_type,
+                    int_type=p.data_int_type,
+                    filters=p.filters if p.filter_on_read else None,
+                    n_workers=p.n_workers,
+                    cache_dir=p.cache_dir,
+                    return_series_index=True
+                )
+                data = preprocess_data(
+                    X,
+                    y,
+                    cdr_formula_list,
+                    p.series_ids,
+                    filters=p.filters,
+                    compute_history=True,
+                    history_length=p.history_length,
+                    history_window=p.history_window,
+                    n_workers=p.n_workers,
+                    series_index=series_index
+                )
+            X, y, select, X_response_aligned_predictor_names, X_response_aligned_predictors, X_2d_predictor_names, X_2d_predictors = data
             evaluation_sets.append((X, y, select, X_response_aligned_predictor_names, X_response_aligned_predictors,
                                     X_2d_predictor_names, X_2d_predictors))
             evaluation_set_partitions.append(partitions)
@@ -80,22 +93,35 @@ if __name__ == '__main__':
         for i in range(0, len(args.data), 2):
             partition_str = '%d' % (int(i / 2) + 1)
             X_paths, y_paths = args.data[i:i + 2]
-            X, y = read_data(
-                X_paths,
-                y_paths,
-                p.series_ids,
-                sep=p.sep,
-                categorical_columns=list(set(p.split_ids + p.series_ids + [v for x in cdr_formula_list for v in x.rangf]))
-            )
-            X, y, select, X_response_aligned_predictor_names, X_response_aligned_predictors, X_2d_predictor_names, X_2d_predictors = preprocess_data(
-                X,
-                y,
-                cdr_formula_list,
-                p.series_ids,
-                filters=p.filters,
-                compute_history=True,
-                history_length=p.history_length
-            )
+            data = load_bundle(get_bundle_path(X_paths, y_paths, p), cdr_formula_list)
+            if data is None:
+                X, y, series_index = read_data(
+                    X_paths,
+                    y_paths,
+                    p.series_ids,
+                    sep=p.sep,
+                    categorical_columns=list(set(p.split_ids + p.series_ids + [v for x in cdr_formula_list for v in x.rangf])),
+                    usecols=get_projection(cdr_formula_list, p) if use_projection(p, cdr_models) else None,
+                    float_type=p.data_float_type,
+                    int_type=p.data_int_type,
+                    filters=p.filters if p.filter_on_read else None,
+                    n_workers=p.n_workers,
+                    cache_dir=p.cache_dir,
+                    return_series_index=True
+                )
+                data = preprocess_data(
+                    X,
+                    y,
+                    cdr_formula_list,
+                    p.series_ids,
+                    filters=p.filters,
+                    compute_history=True,
+                    history_length=p.history_length,
+                    history_window=p.history_window,
+                    n_workers=p.n_workers,
+                    series_index=series_index
+                )
+            X, y, select, X_response_aligned_predictor_names, X_response_aligned_predictors, X_2d_predictor_names, X_2d_predictors = data
             evaluation_sets.append((X, y, select, X_response_aligned_predictor_names, X_response_aligned_predictors,
                                     X_2d_predictor_names, X_2d_predictors))
             evaluation_set_partitions.append(None)
@@ -9,9 +9,9 @@ import pandas as pd
 pd.options.mode.chained_assignment = None
 
 from cdr.config import Config
-from cdr.io import read_data
+from cdr.io import read_data, get_projection, use_projection, is_cdr_model, get_bundle_path, load_bundle
 from cdr.formula import Formula
-from cdr.data import add_dv, filter_invalid_responses, preprocess_data, compute_splitID, compute_partition, get_first_last_obs_lists, s, c, z
+from cdr.data import add_dv, filter_invalid_responses, preprocess_data, compute_splitID, compute_partition, compute_lags, get_first_last_obs_lists, s, c, z
 from cdr.util import mse, mae, percent_variance_explained
 from cdr.util import load_cdr, filter_models, get_partition_list, paths_from_partition_cliarg, stderr
 from cdr.plot import plot_qq
@@ -131,22 +131,35 @@ if __name__ == '__main__':
         else:
             partition_str = '-'.join(partitions)
             X_paths, y_paths = paths_from_partition_cliarg(partitions, p)
-        X, y = read_data(
-            X_paths,
-            y_paths,
-            p.series_ids,
-            sep=p.sep,
-            categorical_columns=list(set(p.split_ids + p.series_ids + [v for x in cdr_formula_list for v in x.rangf]))
-        )
-        X, y, select, X_response_aligned_predictor_names, X_response_aligned_predictors, X_2d_predictor_names, X_2d_predictors = preprocess_data(
-            X,
-            y,
-            cdr_formula_list,
-            p.series_ids,
-            filters=p.filters,
-            compute_history=run_cdr,
-            history_length=p.history_length
-        )
+        data = load_bundle(get_bundle_path(X_paths, y_paths, p), cdr_formula_list) if all(is_cdr_model(m) for m in models) else None
+        if data is None:
+            X, y, series_index = read_data(
+                X_paths,
+                y_paths,
+                p.series_ids,
+                sep=p.sep,
+                categorical_columns=list(set(p.split_ids + p.series_ids + [v for x in cdr_formula_list for v in x.rangf])),
+                usecols=get_projection(cdr_formula_list, p) if use_projection(p, models) else None,
+                float_type=p.data_float_type,
+                int_type=p.data_int_type,
+                filters=p.filters if p.filter_on_read else None,
+                n_workers=p.n_workers,
+                cache_dir=p.cache_dir,
+                return_series_index=True
+            )
+            data = preprocess_data(
+                X,
+                y,
+                cdr_formula_list,
+                p.series_ids,
+                filters=p.filters,
+                compute_history=run_cdr,
+                history_length=p.history_length,
+                history_window=p.history_window,
+                n_workers=p.n_workers,
+                series_index=series_index
+            )
+        X, y, select, X_response_aligned_predictor_names, X_response_aligned_predictors, X_2d_predictor_names, X_2d_predictors = data
         evaluation_sets.append((X, y, select, X_response_aligned_predictor_names, X_response_aligned_predictors, X_2d_predictor_names, X_2d_predictors))
         evaluation_set_partitions.append(partitions)
         evaluation_set_names.append(partition_str)
@@ -165,6 +178,7 @@ if __name__ == '__main__':
 
             X_baseline = X_cur
 
+            lags = []
             for m in models:
                 if not m in cdr_formula_name_list:
                     p.set_model(m)
@@ -177,8 +191,12 @@ if __name__ == '__main__':
                             x_id = sp.group(2)
                             n = int(sp.group(3))
                             x_id_sp = x_id + 'S' + str(n)
-                            if x_id_sp not in X_baseline.columns:
-                                X_baseline[x_id_sp] = X_baseline.groupby(p.series_ids)[x_id].shift_activations(n, fill_value=0.)
+                            if x_id_sp not in X_baseline.columns and (x_id, n) not in lags:
+                                lags.append((x_id, n))
+            if len(lags) > 0:
+                lagged = compute_lags(X_baseline, p.series_ids, lags)
+                for col in lagged.columns:
+                    X_baseline[col] = lagged[col]
 
             if partitions is not None:
                 part = compute_partition(X_cur, p.modulus, 3)
@@ -385,8 +403,21 @@ if __name__ == '__main__':
                         y_cur = (y_valid[dv] - model_cur.y_train_mean) / model_cur.y_train_sd
                     else:
                         y_cur = y_valid[dv]
+                    # Expand the evaluation data once and share it across prediction, likelihood, and loss
+                    first_obs, last_obs = get_first_last_obs_lists(y_valid)
+                    cdr_inputs = model_cur.prepare_inputs(
+                        X,
+                        y_valid.time,
+                        y_valid[model_cur.form.rangf],
+                        first_obs,
+                        last_obs,
+                        X_response_aligned_predictor_names=X_response_aligned_predictor_names,
+                        X_response_aligned_predictors=X_response_aligned_predictors_valid,
+                        X_2d_predictor_names=X_2d_predictor_names,
+                        X_2d_predictors=X_2d_predictors
+                    )
+
                     if args.mode is None or 'response' in args.mode:
-                        first_obs, last_obs = get_first_last_obs_lists(y_valid)
                         cdr_preds = model_cur.predict(
                             X,
                             y_valid.time,
@@ -399,7 +430,8 @@ if __name__ == '__main__':
                             X_2d_predictors=X_2d_predictors,
                             n_samples=args.nsamples,
                             algorithm=args.algorithm,
-                            standardize_response=args.standardize_response
+                            standardize_response=args.standardize_response,
+                            inputs=cdr_inputs
                         )
 
                         squared_error = np.array(y_cur - cdr_preds) ** 2
@@ -462,7 +494,8 @@ if __name__ == '__main__':
                             X_2d_predictors=X_2d_predictors,
                             n_samples=args.nsamples,
                             algorithm=args.algorithm,
-                            standardize_response=args.standardize_response
+                            standardize_response=args.standardize_response,
+                            inputs=cdr_inputs
                         )
 
                         if args.extra_cols:
@@ -484,7 +517,8 @@ if __name__ == '__main__':
                             X_2d_predictors=X_2d_predictors,
                             n_samples=args.nsamples,
                             algorithm=args.algorithm,
-                            training=args.training_mode
+                            training=args.training_mode,
+                            inputs=cdr_inputs
                         )
 
                     if bayes:
@@ -0,0 +1,68 @@
+import argparse
+import sys
+import os
+import pandas as pd
+from cdr.config import Config
+from cdr.io import read_data, get_projection, use_projection, get_bundle_path, save_bundle
+from cdr.formula import Formula
+from cdr.data import preprocess_data
+from cdr.util import filter_models, get_partition_list, paths_from_partition_cliarg, stderr
+
+pd.options.mode.chained_assignment = None
+
+if __name__ == '__main__':
+
+    argparser = argparse.ArgumentParser('''
+        Preprocesses data for CDR models and saves the result as a reusable bundle in the output directory.
+        Other CDR utilities (e.g. train, predict, convolve) detect and load matching bundles rather than recomputing them.
+    ''')
+    argparser.add_argument('config_paths', nargs='+', help='Path(s) to configuration (*.ini) file')
+    argparser.add_argument('-m', '--models', nargs='*', default=[], help='List of models whose formulae to preprocess data for. If unspecified, preprocesses data for all CDR models in the config file.')
+    argparser.add_argument('-p', '--partition', nargs='+', default=['train'], help='Name of partition(s) to preprocess ("train", "dev", "test", or hyphen-delimited subset of these).')
+    args, unknown = argparser.parse_known_args()
+
+    for path in args.config_paths:
+        p = Config(path)
+
+        models = filter_models(p.model_list, args.models)
+        cdr_models = [m for m in models if (m.startswith('CDR') or m.startswith('DTSR'))]
+        cdr_formula_list = [Formula(p.models[m]['formula']) for m in cdr_models]
+
+        if len(cdr_formula_list) == 0:
+            stderr('No CDR models to preprocess data for in %s. Skipping...\n' % path)
+            continue
+
+        for p_name in args.partition:
+            partitions = get_partition_list(p_name)
+            X_paths, y_paths = paths_from_partition_cliarg(partitions, p)
+            bundle_path = get_bundle_path(X_paths, y_paths, p)
+
+            X, y, series_index = read_data(
+                X_paths,
+                y_paths,
+                p.series_ids,
+                sep=p.sep,
+                categorical_columns=list(set(p.split_ids + p.series_ids + [v for x in cdr_formula_list for v in x.rangf])),
+                usecols=get_projection(cdr_formula_list, p) if use_projection(p, cdr_models) else None,
+                float_type=p.data_float_type,
+                int_type=p.data_int_type,
+                filters=p.filters if p.filter_on_read else None,
+                n_workers=p.n_workers,
+                cache_dir=p.cache_dir,
+                return_series_index=True
+            )
+            data = preprocess_data(
+                X,
+                y,
+                cdr_formula_list,
+                p.series_ids,
+                filters=p.filters,
+                compute_history=True,
+                history_length=p.history_length,
+                history_window=p.history_window,
+                n_workers=p.n_workers,
+                series_index=series_index
+            )
+
+            stderr('Saving preprocessed data for partition "%s" to %s...\n' % ('-'.join(partitions), bundle_path))
+            save_bundle(bundle_path, data, cdr_formula_list)
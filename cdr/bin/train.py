@@ -12,9 +12,9 @@ from cdr.kwargs import MODEL_INITIALIZATION_KWARGS, \
     CDR_INITIALIZATION_KWARGS, CDRMLE_INITIALIZATION_KWARGS, CDRBAYES_INITIALIZATION_KWARGS, \
     CDRNN_INITIALIZATION_KWARGS, CDRNNMLE_INITIALIZATION_KWARGS, CDRNNBAYES_INITIALIZATION_KWARGS
 from cdr.config import Config
-from cdr.io import read_data
+from cdr.io import read_data, get_projection, use_projection, get_bundle_path, load_bundle
 from cdr.formula import Formula
-from cdr.data import add_dv, filter_invalid_responses, preprocess_data, compute_splitID, compute_partition
+from cdr.data import add_dv, filter_invalid_responses, preprocess_data, compute_splitID, compute_partition, compute_lags, save_impulse_store
 from cdr.util import mse, mae, filter_models, get_partition_list, paths_from_partition_cliarg, stderr
 
 
@@ -63,23 +63,36 @@ if __name__ == '__main__':
     #     if m.startswith('CDRNN'):
     #         all_interactions = True
     X_paths, y_paths = paths_from_partition_cliarg(partitions, p)
-    X, y = read_data(
-        X_paths,
-        y_paths,
-        p.series_ids,
-        sep=p.sep,
-        categorical_columns=list(set(p.split_ids + p.series_ids + [v for x in cdr_formula_list for v in x.rangf]))
-    )
-    X, y, select, X_response_aligned_predictor_names, X_response_aligned_predictors, X_2d_predictor_names, X_2d_predictors = preprocess_data(
-        X,
-        y,
-        cdr_formula_list,
-        p.series_ids,
-        filters=p.filters,
-        compute_history=run_cdr,
-        history_length=p.history_length,
-        all_interactions=all_interactions
-    )
+    data = load_bundle(get_bundle_path(X_paths, y_paths, p), cdr_formula_list) if run_cdr and not run_R else None
+    if data is None:
+        X, y, series_index = read_data(
+            X_paths,
+            y_paths,
+            p.series_ids,
+            sep=p.sep,
+            categorical_columns=list(set(p.split_ids + p.series_ids + [v for x in cdr_formula_list for v in x.rangf])),
+            usecols=get_projection(cdr_formula_list, p) if use_projection(p, models) else None,
+            float_type=p.data_float_type,
+            int_type=p.data_int_type,
+            filters=p.filters if p.filter_on_read else None,
+            n_workers=p.n_workers,
+            cache_dir=p.cache_dir,
+            return_series_index=True
+        )
+        data = preprocess_data(
+            X,
+            y,
+            cdr_formula_list,
+            p.series_ids,
+            filters=p.filters,
+            compute_history=run_cdr,
+            history_length=p.history_length,
+            history_window=p.history_window,
+            n_workers=p.n_workers,
+            series_index=series_index,
+            all_interactions=all_interactions
+        )
+    X, y, select, X_response_aligned_predictor_names, X_response_aligned_predictors, X_2d_predictor_names, X_2d_predictors = data
 
     if run_R:
         # from cdr.baselines import py2ri
@@ -98,6 +111,7 @@ if __name__ == '__main__':
 
         X_baseline = X_cur
 
+        lags = []
         for m in models:
             if not m in cdr_formula_name_list:
                 p.set_model(m)
@@ -110,8 +124,12 @@ if __name__ == '__main__':
                         x_id = sp.group(2)
                         n = int(sp.group(3))
                         x_id_sp = x_id + 'S' + str(n)
-                        if x_id_sp not in X_baseline.columns:
-                            X_baseline[x_id_sp] = X_baseline.groupby(p.series_ids)[x_id].shift_activations(n, fill_value=0.)
+                        if x_id_sp not in X_baseline.columns and (x_id, n) not in lags:
+                            lags.append((x_id, n))
+        if len(lags) > 0:
+            lagged = compute_lags(X_baseline, p.series_ids, lags)
+            for col in lagged.columns:
+                X_baseline[col] = lagged[col]
 
         X_baseline = X_baseline[part_select]
         if p.merge_cols is None:
@@ -120,6 +138,13 @@ if __name__ == '__main__':
             merge_cols = p.merge_cols
         X_baseline = pd.merge(X_baseline, y, on=merge_cols, how='inner')
 
+    if run_cdr and p.impulse_store_dir is not None:
+        stderr('Saving impulse data to memory-mapped store in %s...\n' % p.impulse_store_dir)
+        # The stores replace the in-memory tables for model initialization as well as fitting, so the tables
+        # are released and processes training on the same data share one copy of it through the page cache
+        X = [save_impulse_store(x, p.impulse_store_dir, keep_non_numeric=True) for x in X]
+        data = X_cur = None
+
     n_train_sample = len(y)
 
     for m in models:
@@ -6,7 +6,7 @@ import time as pytime
 from .formula import *
 from .kwargs import CDR_INITIALIZATION_KWARGS
 from .util import *
-from .data import build_CDR_impulses, corr_cdr, get_first_last_obs_lists
+from .data import build_CDR_impulses, corr_cdr, get_first_last_obs_lists, compress_history
 from .base import Model
 from .interpolate_spline import interpolate_spline
 from .plot import plot_heatmap
@@ -978,12 +978,115 @@ class CDR(Model):
                     self.FLOAT_TF
                 )
 
+                if self.ragged_history:
+                    self._initialize_ragged_inputs()
+
                 # Initialize regularizers
                 self.irf_regularizer = self._initialize_regularizer(
                     self.irf_regularizer_name,
                     self.irf_regularizer_scale
                 )
 
+    def _initialize_ragged_inputs(self):
+        with self.sess.as_default():
+            with self.sess.graph.as_default():
+                n_impulse = len(self.impulse_names)
+                n_time = max(n_impulse, 1)
+
+                # Ragged history inputs in CSR format: the non-padding history cells of all responses concatenated
+                # along a single row axis, along with the index of the response that each row belongs to.
+                # In ragged mode the dense inputs only contain the final timestep of each history.
+                self.use_ragged = tf.placeholder_with_default(False, shape=[], name='use_ragged')
+                self.X_ragged = tf.placeholder_with_default(
+                    tf.zeros([0, n_impulse], dtype=self.FLOAT_TF),
+                    shape=[None, n_impulse],
+                    name='X_ragged'
+                )
+                self.time_X_ragged_compact = tf.placeholder_with_default(
+                    tf.zeros([0, n_time], dtype=self.FLOAT_TF),
+                    shape=[None, None],
+                    name='time_X_ragged_compact'
+                )
+                self.time_X_mask_ragged_compact = tf.placeholder_with_default(
+                    tf.zeros([0, n_time], dtype=tf.bool),
+                    shape=[None, None],
+                    name='time_X_mask_ragged_compact'
+                )
+                self.X_ragged_segment_ids = tf.placeholder_with_default(
+                    tf.zeros([0], dtype=self.INT_TF),
+                    shape=[None],
+                    name='X_ragged_segment_ids'
+                )
+                # Number of padding cells dropped from the history of each response
+                self.X_ragged_n_pad = tf.placeholder_with_default(
+                    tf.zeros([self.X_batch], dtype=self.FLOAT_TF),
+                    shape=[None],
+                    name='X_ragged_n_pad'
+                )
+
+                X_ragged = self.X_ragged
+                # Padding cells hold zeros, which are centered and rescaled like any other input
+                X_pad = tf.zeros([n_impulse], dtype=self.FLOAT_TF)
+                if self.center_inputs:
+                    X_ragged -= self.impulse_means_arr_expanded[0]
+                    X_pad -= self.impulse_means_arr_expanded[0, 0]
+                if self.rescale_inputs:
+                    scale = self.impulse_sds_arr_expanded[0]
+                    scale = np.where(np.logical_not(np.isclose(scale, 0.)), scale, 1.)
+                    X_ragged /= scale
+                    X_pad /= scale[0]
+                self.X_ragged_pad_processed = X_pad
+
+                def ragged_inputs():
+                    time_X = tf.gather(self.time_X_ragged_compact, self.time_X_ix, axis=1)
+                    time_X_mask = tf.cast(
+                        tf.gather(self.time_X_mask_ragged_compact, self.time_X_ix, axis=1),
+                        dtype=self.FLOAT_TF
+                    )
+                    t_delta = tf.gather(self.time_y, self.X_ragged_segment_ids)[..., None] - time_X
+                    return X_ragged, t_delta, time_X_mask, self.X_ragged_segment_ids
+
+                # Padded inputs (e.g. for plotting) are flattened into the same format
+                def dense_inputs():
+                    n_history = tf.shape(self.X)[1]
+                    segment_ids = tf.reshape(
+                        tf.tile(tf.range(self.X_batch, dtype=self.INT_TF)[..., None], [1, n_history]),
+                        [-1]
+                    )
+                    return tf.reshape(self.X_processed, [-1, n_impulse]), \
+                           tf.reshape(self.t_delta, [-1, n_time]), \
+                           tf.reshape(self.time_X_mask, [-1, n_time]), \
+                           segment_ids
+
+                self.X_ragged_processed, self.t_delta_ragged, self.time_X_mask_ragged, self.segment_ids_ragged = tf.cond(
+                    self.use_ragged,
+                    ragged_inputs,
+                    dense_inputs
+                )
+
+                # The dense time offsets only cover the final timestep in ragged mode, so the maximum offset
+                # of the padded inputs is recovered from the ragged offsets and the dropped padding cells,
+                # whose timestamps are zero. Padded feeds keep the maximum computed from the dense inputs.
+                # Either way, if the history axis of the batch was trimmed, the maximum of the untrimmed batch is fed.
+                def ragged_max_tdelta():
+                    t_delta_pad = tf.where(
+                        self.X_ragged_n_pad > 0,
+                        self.time_y,
+                        tf.fill(tf.shape(self.time_y), tf.constant(-np.inf, dtype=self.FLOAT_TF))
+                    )
+                    return tf.maximum(
+                        tf.maximum(tf.reduce_max(self.t_delta_ragged), tf.reduce_max(t_delta_pad)),
+                        self.max_tdelta_batch_untrimmed
+                    )
+
+                max_tdelta_batch = self.max_tdelta_batch
+                self.max_tdelta_batch = tf.cond(
+                    self.use_ragged,
+                    ragged_max_tdelta,
+                    lambda: max_tdelta_batch
+                )
+                self.interpolation_support = tf.linspace(0., self.max_tdelta_batch, self.n_interp)[..., None]
+
     def _initialize_base_params(self):
         with self.sess.as_default():
             with self.sess.graph.as_default():
@@ -2468,6 +2571,9 @@ class CDR(Model):
     def _initialize_convolutions(self):
         with self.sess.as_default():
             with self.sess.graph.as_default():
+                if self.ragged_history and len(self.irf_by_rangf) > 0:
+                    raise ValueError('Ragged history inputs are not supported for models with random IRF parameters.')
+
                 for name in self.terminal_names:
                     t = self.node_table[name]
                     impulse_name = self.terminal2impulse[name]
@@ -2475,6 +2581,35 @@ class CDR(Model):
 
                     if t.p.family == 'DiracDelta':
                         self.convolutions[name] = self.irf_impulses[name]
+                    elif self.ragged_history:
+                        if t.cont:
+                            raise ValueError('Ragged history inputs are not supported for continuous impulses (%s).' % impulse_name)
+
+                        # Masked cells are not zeroed out, matching the padded convolution below
+                        impulse = self.X_ragged_processed[:, impulse_ix:impulse_ix+1]
+                        t_delta = self.t_delta_ragged[None, :, impulse_ix:impulse_ix+1]
+
+                        irf = self.irf[name]
+                        if len(irf) > 1:
+                            irf = self._compose_irf(irf)
+                        else:
+                            irf = irf[0]
+
+                        # IRF parameters are shared across responses, so all rows are evaluated as a single batch item
+                        irf_seq = irf(t_delta)[0]
+
+                        convolution = tf.unsorted_segment_sum(
+                            impulse * irf_seq,
+                            self.segment_ids_ragged,
+                            num_segments=self.X_batch
+                        )
+                        if self.center_inputs:
+                            # Dropped padding cells still contribute their centered value in the padded convolution,
+                            # at time offset equal to the response timestamp
+                            irf_pad = irf(self.time_y[None, :, None])[0]
+                            convolution += self.X_ragged_n_pad[..., None] * self.X_ragged_pad_processed[impulse_ix] * irf_pad
+
+                        self.convolutions[name] = convolution
                     else:
                         if t.cont:
                             # Create a continuous piecewise linear function
@@ -2916,6 +3051,33 @@ class CDR(Model):
     ######################################################
 
 
+    def _history_trimmable(self):
+        # Continuous impulses interpolate between all history cells, including padding
+        if any(self.node_table[name].cont for name in self.terminal_names):
+            return False
+        return super(CDR, self)._history_trimmable()
+
+    def _get_impulse_feed(self, X_2d, time_X_2d, time_X_mask, time_X_ix):
+        if not self.ragged_history:
+            return super(CDR, self)._get_impulse_feed(X_2d, time_X_2d, time_X_mask, time_X_ix)
+
+        X_rows, time_X_rows, time_X_mask_rows, offsets = compress_history(X_2d, time_X_2d, time_X_mask)
+        segment_ids = np.repeat(np.arange(len(X_2d)), np.diff(offsets))
+
+        # The dense inputs only need the final timestep, which DiracDelta impulses and interactions read from
+        return {
+            self.X: X_2d[:, -1:],
+            self.time_X_compact: time_X_2d[:, -1:],
+            self.time_X_mask_compact: time_X_mask[:, -1:],
+            self.time_X_ix: time_X_ix,
+            self.use_ragged: True,
+            self.X_ragged: X_rows,
+            self.time_X_ragged_compact: time_X_rows,
+            self.time_X_mask_ragged_compact: time_X_mask_rows,
+            self.X_ragged_segment_ids: segment_ids,
+            self.X_ragged_n_pad: X_2d.shape[1] - np.diff(offsets)
+        }
+
     def run_train_step(self, feed_dict, verbose=True):
         with self.sess.as_default():
             with self.sess.graph.as_default():
@@ -77,8 +77,16 @@ class Config(object):
                 v = ' '.join(f[1:])
                 filters[i] = (k, v)
         self.filters = filters
+        self.filter_on_read = data.getboolean('filter_on_read', False)
 
         self.history_length = data.getint('history_length', 128)
+        self.history_window = data.getfloat('history_window', None)
+
+        self.cache_dir = data.get('cache_dir', None)
+        self.impulse_store_dir = data.get('impulse_store_dir', None)
+        self.n_workers = data.getint('n_workers', 1)
+        self.project_columns = data.getboolean('project_columns', False)
+        self.downcast = data.getboolean('downcast', False)
 
         self.merge_cols = data.get('merge_cols', None)
         if self.merge_cols is not None:
@@ -105,6 +113,14 @@ class Config(object):
 
         self.global_cdr_settings = self.build_cdr_settings(cdr_settings, add_defaults=False)
 
+        # Types used to store data tables in memory (``None`` keeps the types inferred at read time)
+        if self.downcast:
+            self.data_float_type = self.global_cdr_settings.get('float_type', 'float32')
+            self.data_int_type = self.global_cdr_settings.get('int_type', 'int32')
+        else:
+            self.data_float_type = None
+            self.data_int_type = None
+
         ############
         # Model(s) #
         ############
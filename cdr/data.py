@@ -1,8 +1,12 @@
 import sys
+import os
 import re
+import shutil
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
-from .util import names2ix, stderr
+from .util import names2ix, stderr, RunningMoments, QuantileSketch
 
 op_finder = re.compile('([^()]+)\((.+)\) *')
 
@@ -96,6 +100,68 @@ def get_first_last_obs_lists(y):
     return first_obs, last_obs
 
 
+def get_history_lengths(first_obs, last_obs, history_length):
+    """
+    Compute the effective history length of each response, i.e. the number of non-padding cells in its expanded history, taking the maximum over predictor files.
+
+    :param first_obs: list of ``pandas`` ``Series``; vector of row indices in **X** of the first impulse in the time series associated with each response.
+    :param last_obs: list of ``pandas`` ``Series``; vector of row indices in **X** of the last preceding impulse in the time series associated with each response.
+    :param history_length: ``int``; maximum number of history observations.
+    :return: ``numpy`` vector; effective history length of each response.
+    """
+
+    if not isinstance(first_obs, list):
+        first_obs = [first_obs]
+    if not isinstance(last_obs, list):
+        last_obs = [last_obs]
+
+    lengths = [np.clip(np.asarray(l) - np.asarray(f), 0, history_length) for f, l in zip(first_obs, last_obs)]
+
+    return np.max(lengths, axis=0)
+
+
+def get_t_delta_stats(time_X, time_y, first_obs, last_obs, history_length, sketch_size=100000, chunk_size=65536):
+    """
+    Compute summary statistics of the temporal offsets (``t_delta``) between each response and the impulses in its history, in a single vectorized pass over chunks of responses.
+    The full set of offsets is never materialized.
+
+    :param time_X: list of ``numpy`` vectors; impulse timestamps for each predictor file.
+    :param time_y: ``numpy`` vector; response timestamps.
+    :param first_obs: list of ``numpy`` vectors; row indices in each predictor file of the first impulse in the time series associated with each response.
+    :param last_obs: list of ``numpy`` vectors; row indices in each predictor file of the last preceding impulse in the time series associated with each response.
+    :param history_length: ``int``; maximum number of history observations.
+    :param sketch_size: ``int``; number of offsets retained by the quantile sketch.
+    :param chunk_size: ``int``; number of responses to process at a time.
+    :return: 3-tuple; ``RunningMoments`` and ``QuantileSketch`` over all offsets, and ``numpy`` vector of the maximum offset of each response in each predictor file.
+    """
+
+    moments = RunningMoments()
+    sketch = QuantileSketch(size=sketch_size)
+    t_delta_maxes = []
+    time_y = np.asarray(time_y)
+
+    for time_X_cur, first_obs_cur, last_obs_cur in zip(time_X, first_obs, last_obs):
+        time_X_cur = np.asarray(time_X_cur)
+        e = np.asarray(last_obs_cur).astype(int)
+        s = np.maximum(np.asarray(first_obs_cur).astype(int), e - history_length)
+        t_delta_maxes.append(time_y - time_X_cur[np.minimum(s, len(time_X_cur) - 1)])
+        for i in range(0, len(time_y), chunk_size):
+            s_cur = s[i:i + chunk_size]
+            lengths = np.maximum(e[i:i + chunk_size] - s_cur, 0)
+            n = lengths.sum()
+            if n == 0:
+                continue
+            # Row index of every history cell, built without padding as a ragged range per response
+            offsets = np.repeat(s_cur - (np.cumsum(lengths) - lengths), lengths)
+            t_delta = np.repeat(time_y[i:i + chunk_size], lengths) - time_X_cur[offsets + np.arange(n)]
+            moments.update(t_delta)
+            sketch.update(t_delta)
+
+    t_delta_maxes = np.concatenate(t_delta_maxes, axis=0) if len(t_delta_maxes) > 0 else np.zeros((0,))
+
+    return moments, sketch, t_delta_maxes
+
+
 def filter_invalid_responses(y, dv, crossval_factor=None, crossval_fold=None):
     """
     Filter out rows with non-finite responses.
@@ -130,11 +196,12 @@ def build_CDR_impulses(
         X_2d_predictors=None,
         int_type='int32',
         float_type='float32',
+        compact_time=False
 ):
     """
     Construct 3D array of shape ``(batch_len, history_length, n_impulses)`` to use as predictor data for CDR fitting.
 
-    :param X: list of ``pandas`` ``DataFrame``; impulse (predictor) data.
+    :param X: list of ``pandas`` ``DataFrame`` or ``ImpulseTable``; impulse (predictor) data.
     :param first_obs: list of ``pandas`` ``Series``; vector of row indices in **X** of the first impulse in the time series associated with each response.
     :param last_obs: list of ``pandas`` ``Series``; vector of row indices in **X** of the last preceding impulse in the time series associated with each response.
     :param impulse_names: ``list`` of ``str``; names of columns in **X** to be used as impulses by the model.
@@ -146,7 +213,8 @@ def build_CDR_impulses(
     :param X_2d_predictors: ``pandas`` ``DataFrame`` or ``None``; table of 2D impulses. If ``None``, no such impulses.
     :param int_type: ``str``; name of int type.
     :param float_type: ``str``; name of float type.
-    :return: 3-tuple of ``numpy`` arrays; the expanded impulse array, the expanded timestamp array, and a boolean mask zeroing out locations of non-existent impulses.
+    :param compact_time: ``bool``; store timestamps and masks once per time base rather than once per impulse. Impulses drawn from the same file of **X** share timestamps, as do all response-aligned predictors, so the timestamp and mask arrays get one slot per time base, and an additional index vector maps each impulse to its slot (i.e. ``time_X_2d[..., time_ix]`` recovers the full timestamp array).
+    :return: 3-tuple of ``numpy`` arrays; the expanded impulse array, the expanded timestamp array, and a boolean mask zeroing out locations of non-existent impulses. If **compact_time** is ``True``, a 4-tuple whose last element is the ``numpy`` vector of time slot indices of each impulse.
     """
 
     if not isinstance(X, list):
@@ -175,6 +243,7 @@ def build_CDR_impulses(
     X_2d_from_1d = []
     time_X_2d = []
     time_mask = []
+    time_ix_1d = []
 
     for i, X_cur in enumerate(X):
         impulse_names_1d_cur = impulse_names_1d_todo.intersection(set(X_cur.columns))
@@ -189,8 +258,11 @@ def build_CDR_impulses(
                 last_obs[i],
                 history_length,
                 int_type=int_type,
-                float_type=float_type
+                float_type=float_type,
+                compact_time=compact_time
             )
+            if compact_time:
+                time_ix_1d += [len(time_X_2d)] * len(impulse_names_1d_cur)
             X_2d_from_1d.append(X_2d_from_1d_cur)
             time_X_2d.append(time_X_2d_cur)
             time_mask.append(time_mask_cur)
@@ -203,18 +275,25 @@ def build_CDR_impulses(
     time_X_2d = np.concatenate(time_X_2d, axis=-1)
     time_mask = np.concatenate(time_mask, axis=-1)
 
+    if compact_time:
+        time_ix_1d = np.array(time_ix_1d)[names2ix(impulse_names_1d, impulse_names_1d_tmp)]
+
     if X_response_aligned_predictors is not None:
         response_aligned_shape = (X_2d.shape[0], X_2d.shape[1], len(X_response_aligned_predictor_names))
         X_response_aligned_predictors_new = np.zeros(response_aligned_shape)
         X_response_aligned_predictors_new[:, -1, :] = X_response_aligned_predictors[X_response_aligned_predictor_names]
         X_2d = np.concatenate([X_2d, X_response_aligned_predictors_new], axis=2)
 
+        if compact_time:
+            # All response-aligned predictors share a single time slot
+            time_ix_1d = np.concatenate([time_ix_1d, np.full(len(X_response_aligned_predictor_names), time_X_2d.shape[-1])])
+            response_aligned_shape = response_aligned_shape[:2] + (1,)
         time_X_2d_new = np.zeros(response_aligned_shape)
         time_X_2d_new[:,-1,:] = time_y[..., None]
         time_X_2d = np.concatenate([time_X_2d, time_X_2d_new], axis=2)
 
-        time_mask_new = np.zeros(response_aligned_shape)
-        time_mask_new[:,-1,:] = 1.
+        time_mask_new = np.zeros(response_aligned_shape, dtype=bool)
+        time_mask_new[:,-1,:] = True
         time_mask = np.concatenate([time_mask, time_mask_new], axis=2)
 
     if X_2d_predictors is not None:
@@ -225,23 +304,415 @@ def build_CDR_impulses(
     impulse_names_cur = impulse_names_1d + X_response_aligned_predictor_names + X_2d_predictor_names
     ix = names2ix(impulse_names, impulse_names_cur)
     X_2d = X_2d[:,:,ix]
-    time_X_2d = time_X_2d[:,:,ix]
-    time_mask = time_mask[:,:,ix]
 
     if intercept_only:
         X_2d = X_2d[..., 0:0]
 
+    if compact_time:
+        return X_2d, time_X_2d, time_mask, time_ix_1d[ix]
+
+    time_X_2d = time_X_2d[:,:,ix]
+    time_mask = time_mask[:,:,ix]
+
     return X_2d, time_X_2d, time_mask
 
 
-def compute_history_intervals(X, y, series_ids, verbose=True):
+
+class LazyCDRImpulses(object):
+    """
+    Lazily expanded CDR predictor data.
+    Holds only the flat impulse columns and the history intervals of each response, and expands the 3D arrays returned by ``build_CDR_impulses()`` on demand for a subset of responses (e.g. a minibatch).
+    Memory usage is therefore proportional to the size of the requested subset, rather than to the full number of responses times **history_length**.
+    Indexing with a slice or an integer array of response indices returns the same tuple that ``build_CDR_impulses()`` would return for those responses.
+
+    :param X: list of ``pandas`` ``DataFrame`` or ``ImpulseTable``; impulse (predictor) data.
+    :param first_obs: list of ``pandas`` ``Series``; vector of row indices in **X** of the first impulse in the time series associated with each response.
+    :param last_obs: list of ``pandas`` ``Series``; vector of row indices in **X** of the last preceding impulse in the time series associated with each response.
+    :param impulse_names: ``list`` of ``str``; names of columns in **X** to be used as impulses by the model.
+    :param time_y: ``numpy`` 1D array; vector of response timestamps. Needed to timestamp any response-aligned predictors (ignored if none in model).
+    :param history_length: ``int``; maximum number of history observations.
+    :param X_response_aligned_predictor_names: ``list`` of ``str``; names of predictors measured synchronously with the response rather than the impulses. If ``None``, no such impulses.
+    :param X_response_aligned_predictors: ``pandas`` ``DataFrame`` or ``None``; table of predictors measured synchronously with the response rather than the impulses. If ``None``, no such impulses.
+    :param X_2d_predictor_names: ``list`` of ``str``; names of 2D impulses (impulses whose value depends on properties of the most recent impulse). If ``None``, no such impulses.
+    :param X_2d_predictors: ``pandas`` ``DataFrame`` or ``None``; table of 2D impulses. If ``None``, no such impulses.
+    :param int_type: ``str``; name of int type.
+    :param float_type: ``str``; name of float type.
+    :param compact_time: ``bool``; return timestamps and masks with one slot per time base, along with the slot index of each impulse (see ``build_CDR_impulses()``).
+    """
+
+    def __init__(
+            self,
+            X,
+            first_obs,
+            last_obs,
+            impulse_names,
+            time_y=None,
+            history_length=128,
+            X_response_aligned_predictor_names=None,
+            X_response_aligned_predictors=None,
+            X_2d_predictor_names=None,
+            X_2d_predictors=None,
+            int_type='int32',
+            float_type='float32',
+            compact_time=False
+    ):
+        if not isinstance(X, list):
+            X = [X]
+        if not isinstance(first_obs, list):
+            first_obs = [first_obs]
+        if not isinstance(last_obs, list):
+            last_obs = [last_obs]
+
+        # Extract the needed columns once, so that expanding a subset never touches the rest of the table
+        X_new = []
+        for X_cur in X:
+            if not isinstance(X_cur, ImpulseTable):
+                cols = [col for col in X_cur.columns if col in impulse_names or col == 'time']
+                X_cur = ImpulseTable({col: np.asarray(X_cur[col]) for col in cols})
+            X_new.append(X_cur)
+
+        self.X = X_new
+        self.first_obs = [np.asarray(x) for x in first_obs]
+        self.last_obs = [np.asarray(x) for x in last_obs]
+        self.impulse_names = impulse_names
+        self.time_y = None if time_y is None else np.asarray(time_y)
+        self.history_length = history_length
+        self.X_response_aligned_predictor_names = X_response_aligned_predictor_names
+        if X_response_aligned_predictors is not None:
+            X_response_aligned_predictors = X_response_aligned_predictors.reset_index(drop=True)
+        self.X_response_aligned_predictors = X_response_aligned_predictors
+        self.X_2d_predictor_names = X_2d_predictor_names
+        self.X_2d_predictors = X_2d_predictors
+        self.int_type = int_type
+        self.float_type = float_type
+        self.compact_time = compact_time
+
+    def __len__(self):
+        return len(self.first_obs[0])
+
+    def __getitem__(self, ix):
+        if isinstance(ix, slice):
+            ix = np.arange(len(self))[ix]
+        return build_CDR_impulses(
+            self.X,
+            [x[ix] for x in self.first_obs],
+            [x[ix] for x in self.last_obs],
+            self.impulse_names,
+            time_y=None if self.time_y is None else self.time_y[ix],
+            history_length=self.history_length,
+            X_response_aligned_predictor_names=self.X_response_aligned_predictor_names,
+            X_response_aligned_predictors=None if self.X_response_aligned_predictors is None else self.X_response_aligned_predictors.iloc[ix],
+            X_2d_predictor_names=self.X_2d_predictor_names,
+            X_2d_predictors=None if self.X_2d_predictors is None else self.X_2d_predictors[ix],
+            int_type=self.int_type,
+            float_type=self.float_type,
+            compact_time=self.compact_time
+        )
+
+
+class ExpandedCDRImpulses(object):
+    """
+    Pre-expanded CDR predictor data, with the same indexing interface as ``LazyCDRImpulses``.
+    Used to wrap expanded arrays held in memory or stored on disk as memory maps (in which case indexing only reads the requested responses).
+
+    :param X_2d: ``numpy`` array; expanded impulse array, as returned by ``build_CDR_impulses()``.
+    :param time_X_2d: ``numpy`` array; expanded timestamp array in compact format (one slot per time base).
+    :param time_X_mask: ``numpy`` array; expanded boolean mask in compact format.
+    :param time_ix: ``numpy`` vector; time slot of each impulse.
+    """
+
+    def __init__(self, X_2d, time_X_2d, time_X_mask, time_ix):
+        self.X_2d = X_2d
+        self.time_X_2d = time_X_2d
+        self.time_X_mask = time_X_mask
+        self.time_ix = time_ix
+
+    def __len__(self):
+        return len(self.X_2d)
+
+    def __getitem__(self, ix):
+        return self.X_2d[ix], self.time_X_2d[ix], self.time_X_mask[ix], self.time_ix
+
+
+class CDRInputs(object):
+    """
+    Model inputs prepared once for a dataset by ``Model.prepare_inputs()``, so that several evaluation methods (prediction, likelihood, loss, convolution) can reuse the same expanded impulse histories and random effects indices instead of rebuilding them on every call.
+
+    :param time_y: ``numpy`` vector; response timestamps.
+    :param gf_y: ``numpy`` array; random grouping factor level indices of each response.
+    :param impulses: ``LazyCDRImpulses`` or ``ExpandedCDRImpulses``; impulse data, indexable by response.
+    """
+
+    def __init__(self, time_y, gf_y, impulses):
+        self.time_y = time_y
+        self.gf_y = gf_y
+        self.impulses = impulses
+
+    def __len__(self):
+        return len(self.time_y)
+
+
+def build_CDR_impulses_memmap(
+        X,
+        first_obs,
+        last_obs,
+        impulse_names,
+        path,
+        time_y=None,
+        history_length=128,
+        X_response_aligned_predictor_names=None,
+        X_response_aligned_predictors=None,
+        X_2d_predictor_names=None,
+        X_2d_predictors=None,
+        int_type='int32',
+        float_type='float32',
+        chunk_size=65536,
+        verbose=True
+):
+    """
+    Construct the same arrays as ``build_CDR_impulses()`` with ``compact_time=True``, but write them chunk by chunk to ``.npy`` files and return read-only memory maps of them.
+    Peak memory usage is therefore bounded by **chunk_size** rather than by the size of the expanded data, which can exceed available RAM.
+    The arrays are placed in a subdirectory of **path** named by a hash of the inputs, so an existing copy (e.g. from an earlier run of a resumed model) is reused rather than rewritten.
+    Only the most recent copy is kept: copies for other inputs in **path** are deleted once the arrays have been written.
+
+    :param X: list of ``pandas`` ``DataFrame`` or ``ImpulseTable``; impulse (predictor) data.
+    :param first_obs: list of ``pandas`` ``Series``; vector of row indices in **X** of the first impulse in the time series associated with each response.
+    :param last_obs: list of ``pandas`` ``Series``; vector of row indices in **X** of the last preceding impulse in the time series associated with each response.
+    :param impulse_names: ``list`` of ``str``; names of columns in **X** to be used as impulses by the model.
+    :param path: ``str``; directory in which to save the arrays.
+    :param time_y: ``numpy`` 1D array; vector of response timestamps. Needed to timestamp any response-aligned predictors (ignored if none in model).
+    :param history_length: ``int``; maximum number of history observations.
+    :param X_response_aligned_predictor_names: ``list`` of ``str``; names of predictors measured synchronously with the response rather than the impulses. If ``None``, no such impulses.
+    :param X_response_aligned_predictors: ``pandas`` ``DataFrame`` or ``None``; table of predictors measured synchronously with the response rather than the impulses. If ``None``, no such impulses.
+    :param X_2d_predictor_names: ``list`` of ``str``; names of 2D impulses (impulses whose value depends on properties of the most recent impulse). If ``None``, no such impulses.
+    :param X_2d_predictors: ``pandas`` ``DataFrame`` or ``None``; table of 2D impulses. If ``None``, no such impulses.
+    :param int_type: ``str``; name of int type.
+    :param float_type: ``str``; name of float type.
+    :param chunk_size: ``int``; number of responses to expand at a time.
+    :param verbose: ``bool``; whether to report progress to stderr
+    :return: ``ExpandedCDRImpulses``; the memory-mapped arrays.
+    """
+
+    if not isinstance(X, list):
+        X = [X]
+    if not isinstance(first_obs, list):
+        first_obs = [first_obs]
+    if not isinstance(last_obs, list):
+        last_obs = [last_obs]
+
+    def update_key(key, arr):
+        arr = np.asarray(arr)
+        key.update(repr((arr.dtype.str, arr.shape)).encode('utf-8'))
+        if arr.dtype == object:
+            arr = pd.util.hash_array(arr.ravel())
+        key.update(np.ascontiguousarray(arr).tobytes())
+
+    key = hashlib.md5(repr((
+        list(impulse_names),
+        history_length,
+        X_response_aligned_predictor_names,
+        X_2d_predictor_names,
+        int_type,
+        float_type
+    )).encode('utf-8'))
+    for X_cur, first_obs_cur, last_obs_cur in zip(X, first_obs, last_obs):
+        columns = [col for col in ['time'] + list(impulse_names) if col in X_cur.columns]
+        key.update(repr(columns).encode('utf-8'))
+        for col in columns:
+            update_key(key, X_cur[col])
+        update_key(key, first_obs_cur)
+        update_key(key, last_obs_cur)
+    for arr in (time_y, X_response_aligned_predictors, X_2d_predictors):
+        if arr is not None:
+            update_key(key, arr)
+    key = 'history_%s' % key.hexdigest()
+    out_path = os.path.join(path, key)
+
+    names = ['X', 'time_X', 'time_X_mask', 'time_ix']
+
+    if os.path.exists(os.path.join(out_path, 'time_ix.npy')):
+        if verbose:
+            stderr('Loading expanded impulse data from %s...\n' % out_path)
+    else:
+        impulses = LazyCDRImpulses(
+            X,
+            first_obs,
+            last_obs,
+            impulse_names,
+            time_y=time_y,
+            history_length=history_length,
+            X_response_aligned_predictor_names=X_response_aligned_predictor_names,
+            X_response_aligned_predictors=X_response_aligned_predictors,
+            X_2d_predictor_names=X_2d_predictor_names,
+            X_2d_predictors=X_2d_predictors,
+            int_type=int_type,
+            float_type=float_type,
+            compact_time=True
+        )
+        n = len(impulses)
+
+        if verbose:
+            stderr('Writing expanded impulse data to %s...\n' % out_path)
+
+        # Write to a temporary directory first so that an interrupted run never leaves partial arrays behind
+        tmp_path = out_path + '.%d.tmp' % os.getpid()
+        if not os.path.exists(tmp_path):
+            os.makedirs(tmp_path)
+
+        out = None
+        time_ix = None
+        for i in range(0, max(n, 1), chunk_size):
+            arrays = impulses[i:i + chunk_size]
+            if out is None:
+                out = [
+                    np.lib.format.open_memmap(
+                        os.path.join(tmp_path, '%s.npy' % name),
+                        mode='w+',
+                        dtype=arr.dtype,
+                        shape=(n,) + arr.shape[1:]
+                    ) for name, arr in zip(names[:3], arrays[:3])
+                ]
+                time_ix = arrays[3]
+            for arr_out, arr in zip(out, arrays[:3]):
+                arr_out[i:i + len(arr)] = arr
+        for arr_out in out:
+            arr_out.flush()
+        del out
+        # Written last, so that its presence marks a complete set of arrays
+        np.save(os.path.join(tmp_path, 'time_ix.npy'), time_ix)
+
+        try:
+            os.rename(tmp_path, out_path)
+        except OSError:
+            shutil.rmtree(tmp_path)
+
+        # Expanded histories can be large, so copies for earlier inputs are removed
+        for name in os.listdir(path):
+            if name != key and re.match('^history_[0-9a-f]{32}$', name):
+                shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+    X_2d, time_X_2d, time_X_mask = [np.load(os.path.join(out_path, '%s.npy' % name), mmap_mode='r') for name in names[:3]]
+    time_ix = np.load(os.path.join(out_path, 'time_ix.npy'))
+
+    return ExpandedCDRImpulses(X_2d, time_X_2d, time_X_mask, time_ix)
+
+
+def compute_series_index(df, series_ids):
+    """
+    Compute the row range occupied by each time series in **df**, which must be grouped by series (as guaranteed by ``read_data()``).
+
+    :param df: ``pandas`` ``DataFrame``; impulse or response data.
+    :param series_ids: ``list`` of ``str``; column names whose jointly unique values define unique time series.
+    :return: ``dict``; map from tuples of series id values to ``(start, end)`` row ranges, in table order.
+    """
+
+    n = len(df)
+    if n == 0:
+        return {}
+    new_series = np.zeros(n, dtype=bool)
+    new_series[0] = True
+    for col in series_ids:
+        # Compare integer codes rather than raw values, so that missing values form a single series
+        vals = pd.factorize(df[col])[0]
+        new_series[1:] |= vals[1:] != vals[:-1]
+    starts = np.where(new_series)[0]
+    ends = np.append(starts[1:], n)
+    keys = df[series_ids].iloc[starts].itertuples(index=False, name=None)
+
+    out = {}
+    for key, start, end in zip(keys, starts, ends):
+        if key in out:
+            raise ValueError('Data are not grouped by series: series %s occurs in multiple non-contiguous blocks.' % str(key))
+        out[key] = (int(start), int(end))
+
+    return out
+
+
+def compute_lags(X, series_ids, lags, fill_value=0., series_index=None):
+    """
+    Compute lagged copies of columns of **X** within each time series (e.g. spillover predictors ``xS1``, ``xS2``, ...).
+    Equivalent to calling ``X.groupby(series_ids)[col].shift(n, fill_value=fill_value)`` for each requested lag, but series boundaries are computed once and each lag is a vectorized shift of the whole column with the first **n** rows of each series masked.
+    **X** must be grouped by series (as guaranteed by ``read_data()``).
+
+    :param X: ``pandas`` ``DataFrame``; impulse data.
+    :param series_ids: ``list`` of ``str``; column names whose jointly unique values define unique time series.
+    :param lags: ``list`` of 2-tuples ``(col, n)``; names of columns to lag and number of steps by which to lag them.
+    :param fill_value: value to use for steps that precede the start of a series.
+    :param series_index: ``dict`` or ``None``; series index of **X** (see ``compute_series_index()``). If ``None``, computed from **X**.
+    :return: ``pandas`` ``DataFrame``; lagged columns, named ``col + 'S' + str(n)``, with the same index as **X**.
+    """
+
+    n_rows = len(X)
+    if series_index is None:
+        series_index = compute_series_index(X, series_ids)
+    starts = np.sort(np.array([start for start, _ in series_index.values()], dtype=int))
+    # Position of each row within its series
+    pos = np.arange(n_rows) - np.repeat(starts, np.diff(np.append(starts, n_rows)))
+
+    out = {}
+    for col, n in lags:
+        vals = X[col].values
+        lagged = np.full(n_rows, fill_value, dtype=np.result_type(vals.dtype, np.asarray(fill_value).dtype))
+        if n < n_rows:
+            lagged[n:] = vals[:n_rows - n]
+        lagged[pos < n] = fill_value
+        out['%sS%d' % (col, n)] = lagged
+
+    return pd.DataFrame(out, index=X.index)
+
+
+def compute_history_intervals_shard(time_X, time_y, blocks, X_offset, m, history_window=None):
+    """
+    Compute history intervals for a contiguous shard of response data.
+    Used by ``compute_history_intervals()``, possibly in a worker process.
+
+    :param time_X: ``numpy`` vector; timestamps of the impulses spanned by the shard.
+    :param time_y: ``numpy`` vector; timestamps of the responses in the shard.
+    :param blocks: ``list`` of 4-tuples; ``(y_start, y_end, X_start, X_end)`` row ranges in **time_y** and **time_X** (respectively) of each time series in the shard that occurs in the impulse data.
+    :param X_offset: ``int``; row index in the full impulse table of the first element of **time_X**.
+    :param m: ``int``; number of rows in the full impulse table, used as the (empty) interval for responses whose time series does not occur in the impulse data.
+    :param history_window: ``float`` or ``None``; maximum time offset of impulses in each history window. If ``None``, histories extend to the start of the time series.
+    :return: 2-tuple of ``numpy`` vectors; first and last impulse observations (respectively) for each response in the shard, as row indices in the full impulse table.
+    """
+
+    epsilon = np.finfo(np.float32).eps
+
+    first_obs = np.full((len(time_y),), m, dtype='int32')
+    last_obs = np.full((len(time_y),), m, dtype='int32')
+
+    for y_start, y_end, X_start, X_end in blocks:
+        if history_window is None:
+            first_obs[y_start:y_end] = X_offset + X_start
+        else:
+            first_obs[y_start:y_end] = X_offset + X_start + np.searchsorted(
+                time_X[X_start:X_end],
+                time_y[y_start:y_end] - history_window - epsilon,
+                side='left'
+            )
+        last_obs[y_start:y_end] = X_offset + X_start + np.searchsorted(
+            time_X[X_start:X_end],
+            time_y[y_start:y_end] + epsilon,
+            side='right'
+        )
+
+    return first_obs, last_obs
+
+
+def compute_history_intervals(X, y, series_ids, verbose=True, n_workers=1, X_index=None, y_index=None, history_window=None):
     """
     Compute row indices in **X** of initial and final impulses for each element of **y**.
+    **X** and **y** must both be sorted by **series_ids** and time (as guaranteed by ``read_data()``).
+    For each response, the first impulse is the start of its time series in **X** (or, if **history_window** is given, the first impulse in the series at most **history_window** time units before the response), and the final impulse is the last impulse in the series with a timestamp no later than the response (up to floating point tolerance).
+    Responses whose time series does not occur in **X** are assigned an empty interval at the end of **X**.
 
     :param X: ``pandas`` ``DataFrame``; impulse (predictor) data.
     :param y: ``pandas`` ``DataFrame``; response data.
     :param series_ids: ``list`` of ``str``; column names whose jointly unique values define unique time series.
     :param verbose: ``bool``; whether to report progress to stderr
+    :param n_workers: ``int``; number of worker processes. If greater than ``1``, time series are divided into shards that are processed in parallel. Output does not depend on this setting.
+    :param X_index: ``dict`` or ``None``; series index of **X** (see ``compute_series_index()``). If ``None``, computed from **X**.
+    :param y_index: ``dict`` or ``None``; series index of **y** (see ``compute_series_index()``). If ``None``, computed from **y**.
+    :param history_window: ``float`` or ``None``; maximum time offset of impulses in each history window. If ``None``, histories extend to the start of the time series.
     :return: 2-tuple of ``numpy`` vectors; first and last impulse observations (respectively) for each response in **y**
     """
 
@@ -251,61 +722,48 @@ def compute_history_intervals(X, y, series_ids, verbose=True):
     time_X = np.array(X.time)
     time_y = np.array(y.time)
 
-    id_vectors_X = []
-    id_vectors_y = []
+    if X_index is None:
+        X_index = compute_series_index(X, series_ids)
+    if y_index is None:
+        y_index = compute_series_index(y, series_ids)
+
+    blocks = []
+    for key, (y_start, y_end) in y_index.items():
+        if key in X_index:
+            X_start, X_end = X_index[key]
+            blocks.append((y_start, y_end, X_start, X_end))
+
+    if n_workers <= 1 or len(blocks) < 2:
+        return compute_history_intervals_shard(time_X, time_y, blocks, 0, m, history_window=history_window)
+
+    # Split series into shards with roughly equal numbers of responses, several per worker for load balancing
+    n_shards = min(n_workers * 4, len(blocks))
+    y_counts = np.cumsum([y_end - y_start for y_start, y_end, _, _ in blocks])
+    bounds = np.searchsorted(y_counts, np.arange(1, n_shards) * y_counts[-1] / n_shards, side='right')
+    bounds = [0] + sorted(set(int(b) for b in bounds if 0 < b < len(blocks))) + [len(blocks)]
+
+    jobs = []
+    for b0, b1 in zip(bounds[:-1], bounds[1:]):
+        shard = blocks[b0:b1]
+        y_lo, y_hi = shard[0][0], shard[-1][1]
+        X_lo, X_hi = shard[0][2], shard[-1][3]
+        shard = [(y_start - y_lo, y_end - y_lo, X_start - X_lo, X_end - X_lo) for y_start, y_end, X_start, X_end in shard]
+        jobs.append((y_lo, y_hi, time_X[X_lo:X_hi], time_y[y_lo:y_hi], shard, X_lo))
 
-    for i in range(len(series_ids)):
-        col = series_ids[i]
-        id_vectors_X.append(np.array(X[col]))
-        id_vectors_y.append(np.array(y[col]))
-    id_vectors_X = np.stack(id_vectors_X, axis=1)
-    id_vectors_y = np.stack(id_vectors_y, axis=1)
-
-    y_cur_ids = id_vectors_y[0]
+    if verbose:
+        stderr('Computing history intervals for %d time series in %d shards using %d workers...\n' % (len(blocks), len(jobs), n_workers))
 
-    first_obs = np.zeros(len(y)).astype('int32')
-    last_obs = np.zeros(len(y)).astype('int32')
+    first_obs = np.full((n,), m, dtype='int32')
+    last_obs = np.full((n,), m, dtype='int32')
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = [(y_lo, y_hi, pool.submit(compute_history_intervals_shard, time_X_cur, time_y_cur, shard, X_lo, m, history_window)) for y_lo, y_hi, time_X_cur, time_y_cur, shard, X_lo in jobs]
+        for y_lo, y_hi, future in futures:
+            first_obs[y_lo:y_hi], last_obs[y_lo:y_hi] = future.result()
 
-    # i iterates y
-    i = 0
-    # j iterates X
-    j = 0
-    start = 0
-    end = 0
-    epsilon = np.finfo(np.float32).eps
-    while i < n:
-        if verbose and i == 0 or i % 1000 == 999 or i == n-1:
-            stderr('\r%d/%d' %(i+1, n))
-
-        # Check if we've entered a new series in y
-        if (id_vectors_y[i] != y_cur_ids).any():
-            start = end = j
-            X_cur_ids = id_vectors_X[j]
-            y_cur_ids = id_vectors_y[i]
-
-        # Move the X pointer forward until we are either in the same series as y or at the end of the table.
-        # However, if we are already at the end of the current time series, stay put in case there are subsequent observations of the response.
-        if j == 0 or (j > 0 and (id_vectors_X[j-1] != y_cur_ids).any()):
-            while j < m and (id_vectors_X[j] != y_cur_ids).any():
-                j += 1
-                start = end = j
-
-        # Move the X pointer forward until we are either at the end of the series or have moved later in time than y
-        while j < m and time_X[j] <= (time_y[i] + epsilon) and (id_vectors_X[j] == y_cur_ids).all():
-            j += 1
-            end = j
-
-        first_obs[i] = start
-        last_obs[i] = end
-
-        i += 1
-
-    stderr('\n')
-    
     return first_obs, last_obs
 
 
-def corr_cdr(X_2d, impulse_names, impulse_names_2d, time, time_mask):
+def corr_cdr(X_2d, impulse_names, impulse_names_2d, time, time_mask, time_ix=None, n_samples=None, random_state=None):
     """
     Compute correlation matrix, including correlations across time where necessitated by 2D predictors.
 
@@ -314,105 +772,229 @@ def corr_cdr(X_2d, impulse_names, impulse_names_2d, time, time_mask):
     :param impulse_names_2d: ``list`` of ``str``; names of columns in **X_2d** that designate to 2D predictors.
     :param time: 3D ``numpy`` array; array of timestamps for each event in **X_2d**.
     :param time_mask: 3D ``numpy`` array; array of masks over padding events in **X_2d**.
+    :param time_ix: ``numpy`` vector or ``None``; time slot of each impulse in **time** and **time_mask**, if these are in the compact format returned by ``build_CDR_impulses()`` with ``compact_time=True``. If ``None``, slots correspond one-to-one to impulses.
+    :param n_samples: ``int`` or ``None``; if not ``None`` and smaller than the number of rows in **X_2d**, estimate correlations from a random subsample of **n_samples** rows, in which case the result is approximate. If ``None``, use all rows.
+    :param random_state: ``numpy`` ``RandomState`` or ``None``; random number generator used for subsampling. If ``None``, a generator with a fixed seed is used, so that subsampling is reproducible and does not advance the global ``numpy`` random state.
     :return: ``pandas`` ``DataFrame``; the correlation matrix.
     """
 
-    rho = pd.DataFrame(np.zeros((len(impulse_names), len(impulse_names))), index=impulse_names, columns=impulse_names)
+    if time_ix is None:
+        time_ix = np.arange(len(impulse_names))
+
+    if n_samples is not None and n_samples < len(X_2d):
+        if random_state is None:
+            random_state = np.random.RandomState(0)
+        sample_ix = np.sort(random_state.permutation(len(X_2d))[:int(n_samples)])
+        X_2d = X_2d[sample_ix]
+        time = time[sample_ix]
+        time_mask = time_mask[sample_ix]
+
+    n_impulse = len(impulse_names)
+    rho = np.zeros((n_impulse, n_impulse))
+    is_2d = np.array([x in impulse_names_2d for x in impulse_names], dtype=bool)
+
+    # Pairs of 1D predictors are only correlated at the most recent timestep, which can be done in one call
+    ix_1d = np.where(~is_2d)[0]
+    if len(ix_1d) > 0:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rho[np.ix_(ix_1d, ix_1d)] = np.corrcoef(X_2d[:, -1, ix_1d], rowvar=False).reshape(len(ix_1d), len(ix_1d))
+
+    # Pairs involving a 2D predictor are correlated over all aligned timesteps.
+    # Alignment masks depend only on the pair of time slots, so they are shared across impulses.
+    aligned_cache = {}
+    for i in range(n_impulse):
+        for j in range(i, n_impulse):
+            if is_2d[i] or is_2d[j]:
+                t_i = time_ix[i]
+                t_j = time_ix[j]
+                if (t_i, t_j) not in aligned_cache:
+                    aligned = np.isclose(time[:, :, t_i], time[:, :, t_j])
+                    aligned &= time_mask[:, :, t_i].astype(bool)
+                    aligned &= time_mask[:, :, t_j].astype(bool)
+                    aligned_cache[(t_i, t_j)] = aligned
+                aligned = aligned_cache[(t_i, t_j)]
 
-    for i in range(len(impulse_names)):
-        for j in range(i, len(impulse_names)):
-            if impulse_names[i] in impulse_names_2d or impulse_names[j] in impulse_names_2d:
                 x1 = X_2d[..., i]
                 x2 = X_2d[..., j]
-
-                aligned = np.logical_and(np.logical_and(np.isclose(time[:,:,i], time[:,:,j]), time_mask[:,:,i]), time_mask[:,:,j])
                 n = aligned.sum()
-                x1_mean = x1.sum() / n
-                x2_mean = x2.sum() / n
-                cor = ((x1 - x1_mean) * (x2 - x2_mean) * aligned).sum() / \
-                      np.sqrt(((x1 - x1_mean) ** 2 * aligned).sum() * (
-                              (x2 - x2_mean) ** 2 * aligned).sum())
-            else:
-                x1 = X_2d[:, -1, i]
-                x2 = X_2d[:, -1, j]
-
-                n = X_2d.shape[0]
-                x1_mean = x1.sum() / n
-                x2_mean = x2.sum() / n
-                cor = ((x1 - x1_mean) * (x2 - x2_mean)).sum() / \
-                      np.sqrt(((x1 - x1_mean) ** 2).sum() * ((x2 - x2_mean) ** 2).sum())
-
-            rho.loc[impulse_names[i], impulse_names[j]] = cor
-            if i != j:
-                rho.loc[impulse_names[j], impulse_names[i]] = cor
+                # Pairs with no aligned timesteps have undefined correlation (NaN)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    x1_c = np.where(aligned, x1 - x1.sum() / n, 0.)
+                    x2_c = np.where(aligned, x2 - x2.sum() / n, 0.)
+                    cor = (x1_c * x2_c).sum() / np.sqrt((x1_c ** 2).sum() * (x2_c ** 2).sum())
+
+                rho[i, j] = cor
+                rho[j, i] = cor
+
+    rho = pd.DataFrame(rho, index=impulse_names, columns=impulse_names)
 
     return rho
 
 
+FILTER_OPS = ['<=', '>=', '==', '!=', '<', '>']
+
+
+class FilterPlan(object):
+    """
+    Response filters compiled into a reusable predicate plan.
+    Filtering conditions are parsed once at construction, and ``compute()`` evaluates the whole plan over a table into a single boolean mask.
+    Unique-count (``nunique``) filters are evaluated as grouped counts over the rows that pass all preceding filters.
+    The row-wise prefix of the plan (see ``row_plan()``) can be applied to chunks of response data as they are read.
+
+    :param filters: ``list``, ``FilterPlan``, or ``None``; list of key-value pairs mapping column names to filtering criteria for their values. If ``None``, no filtering.
+    """
+
+    def __init__(self, filters=None):
+        if isinstance(filters, FilterPlan):
+            filters = filters.filters
+        if filters is None:
+            filters = []
+        self.filters = list(filters)
+        self.steps = []
+        for field, cond in self.filters:
+            op, var = parse_filter_condition(cond)
+            # Whether a non-numeric comparison value names a column is resolved against each table, unless bound
+            self.steps.append((field, op, var, field.lower().endswith('nunique'), None))
+
+    def __len__(self):
+        return len(self.steps)
+
+    def row_plan(self):
+        """
+        Get the plan for the row-wise prefix of the filters (see ``get_row_filters()``).
+
+        :return: ``FilterPlan``; the row-wise plan.
+        """
+
+        out = FilterPlan(get_row_filters(self.filters))
+        out.steps = self.steps[:len(out.steps)]
+
+        return out
+
+    def comparison_columns(self, columns):
+        """
+        Get the filtered fields whose comparison values name one of **columns**, and whose values are therefore needed to decide whether to compare against that column (see ``bind()``).
+
+        :param columns: ``list`` of ``str``; column names of the table to be filtered.
+        :return: ``list`` of ``str``; names of the filtered fields.
+        """
+
+        columns = set(columns)
+        out = []
+        for field, op, var, nunique, var_is_column in self.steps:
+            if isinstance(var, str) and var in columns and field in columns and field not in out:
+                out.append(field)
+
+        return out
+
+    def bind(self, y, columns=None):
+        """
+        Resolve once whether each non-numeric comparison value names a column of the table to be filtered or is a literal value, so that the plan gives the same decision on every chunk of a table read in parts.
+        Values are treated as column names if they name a column of the table and do not occur as values of the filtered field in **y** (as in ``compute_filter()``).
+
+        :param y: ``pandas`` ``DataFrame``; values of the table to be filtered. Must contain the full values of the fields returned by ``comparison_columns()``, but may otherwise be empty (e.g. only a header).
+        :param columns: ``list`` of ``str`` or ``None``; column names of the table to be filtered. If ``None``, the columns of **y**.
+        :return: ``FilterPlan``; the bound plan.
+        """
+
+        if columns is None:
+            columns = y.columns
+        columns = set(columns)
+        out = FilterPlan(self.filters)
+        out.steps = []
+        for field, op, var, nunique, var_is_column in self.steps:
+            if isinstance(var, str):
+                var_is_column = var in columns and not (field in y.columns and (y[field] == var).any())
+            out.steps.append((field, op, var, nunique, var_is_column))
+
+        return out
+
+    def compute(self, y, verbose=True):
+        """
+        Evaluate the plan over a table.
+        Filters on columns missing from **y** are skipped.
+
+        :param y: ``pandas`` ``DataFrame``; response data.
+        :param verbose: ``bool``; whether to report skipped filters to stderr.
+        :return: ``numpy`` vector; boolean mask to use for ``pandas`` subsetting operations.
+        """
+
+        select = np.ones(len(y), dtype=bool)
+        for field, op, var, nunique, var_is_column in self.steps:
+            if field in y.columns:
+                select &= compute_filter(y, field, (op, var), var_is_column=var_is_column)
+            elif nunique:
+                name = field[:-7]
+                if name in y.columns:
+                    # Count each value among the rows selected so far, then broadcast counts back to rows.
+                    # Missing values are counted as a value of their own.
+                    codes, uniques = pd.factorize(y[name])
+                    codes = np.where(codes < 0, len(uniques), codes)
+                    counts = np.bincount(codes[select], minlength=len(uniques) + 1)[codes]
+                    # Values that occur in no selected row have no count
+                    if len(counts) > 0 and (counts > 0).all():
+                        y[field] = counts.astype('int64')
+                    else:
+                        y[field] = np.where(counts > 0, counts, np.nan)
+                    select &= compute_filter(y, field, (op, var), var_is_column=var_is_column)
+                elif verbose:
+                    stderr('Skipping unique-counts filter for column "%s", which was not found in the data...\n' % name)
+            elif verbose:
+                stderr('Skipping filter for column "%s", which was not found in the data...\n' % field)
+
+        return select
+
+
 def compute_filters(y, filters=None):
     """
     Compute filters given a filter map.
 
     :param y: ``pandas`` ``DataFrame``; response data.
-    :param filters: ``list``; list of key-value pairs mapping column names to filtering criteria for their values.
+    :param filters: ``list`` or ``FilterPlan``; list of key-value pairs mapping column names to filtering criteria for their values, or a compiled plan of them.
     :return: ``numpy`` vector; boolean mask to use for ``pandas`` subsetting operations.
     """
 
     if filters is None:
         return y
-    select = np.ones(len(y), dtype=bool)
+    return FilterPlan(filters).compute(y)
+
+
+def get_row_filters(filters):
+    """
+    Get the leading filters that can be evaluated independently for each row, and can therefore be applied to chunks of response data as they are read.
+    Unique-count (``nunique``) filters depend on the whole table, and the counts they compute depend on the filters that precede them, so only filters preceding the first unique-count filter are returned.
+
+    :param filters: ``list`` or ``FilterPlan``; list of key-value pairs mapping column names to filtering criteria for their values.
+    :return: ``list``; the row-wise prefix of **filters**.
+    """
+
+    if isinstance(filters, FilterPlan):
+        filters = filters.filters
+    if filters is None:
+        return []
+    out = []
     for f in filters:
-        field = f[0]
-        cond = f[1]
-        if field in y.columns:
-            select &= compute_filter(y, field, cond)
-        elif field.lower().endswith('nunique'):
-            name = field[:-7]
-            if name in y.columns:
-                vals, counts = np.unique(y[name][select], return_counts=True)
-                count_map = {}
-                for v, c in zip(vals, counts):
-                    count_map[v] = c
-                y[field] = y[name].map(count_map)
-                select &= compute_filter(y, field, cond)
-            else:
-                stderr('Skipping unique-counts filter for column "%s", which was not found in the data...\n' % name)
-        else:
-            stderr('Skipping filter for column "%s", which was not found in the data...\n' % field)
-    return select
+        if f[0].lower().endswith('nunique'):
+            break
+        out.append(f)
+    return out
 
 
-def compute_filter(y, field, cond):
+def parse_filter_condition(cond):
     """
-    Compute filter given a field and condition
+    Parse a filtering condition (e.g. ``'<= 5'``) into a comparator and a comparison value.
 
-    :param y: ``pandas`` ``DataFrame``; response data.
-    :param field: ``str``; name of column on whose values to filter.
     :param cond: ``str``; string representation of condition to use for filtering.
-    :return: ``numpy`` vector; boolean mask to use for ``pandas`` subsetting operations.
+    :return: 2-tuple; comparator (one of ``FILTER_OPS``) and comparison value (``float`` if numeric, otherwise ``str``).
     """
 
     assert isinstance(cond, str), 'Argument ``cond`` must be of type ``str``.'
 
     cond = cond.strip()
-    if cond.startswith('<='):
-        op = '<='
-        var = cond[2:].strip()
-    elif cond.startswith('>='):
-        op = '<='
-        var = cond[2:].strip()
-    elif cond.startswith('<'):
-        op = '<'
-        var = cond[1:].strip()
-    elif cond.startswith('>'):
-        op = '>'
-        var = cond[1:].strip()
-    elif cond.startswith('=='):
-        op = '=='
-        var = cond[2:].strip()
-    elif cond.startswith('!='):
-        op = '!='
-        var = cond[2:].strip()
+    for op in FILTER_OPS:
+        if cond.startswith(op):
+            var = cond[len(op):].strip()
+            break
     else:
         raise ValueError('Unrecognized filtering condition: %s' % cond)
 
@@ -422,28 +1004,57 @@ def compute_filter(y, field, cond):
         try:
             var = float(var)
         except ValueError:
-            if var in y and not var in y[field].unique():
-                var = y[var]
+            pass
+
+    return op, var
+
+
+def compute_filter(y, field, cond, var_is_column=None):
+    """
+    Compute filter given a field and condition
+
+    :param y: ``pandas`` ``DataFrame``; response data.
+    :param field: ``str``; name of column on whose values to filter.
+    :param cond: ``str``, or 2-tuple as returned by ``parse_filter_condition()``; condition to use for filtering.
+    :param var_is_column: ``bool`` or ``None``; whether a non-numeric comparison value names a column of **y** to compare against. If ``None``, it does if it names a column of **y** and does not occur as a value of **field**.
+    :return: ``numpy`` vector; boolean mask to use for ``pandas`` subsetting operations.
+    """
+
+    if isinstance(cond, str):
+        op, var = parse_filter_condition(cond)
+    else:
+        op, var = cond
+
+    col = y[field]
+    if isinstance(var, str):
+        if var_is_column is None:
+            # Non-numeric values name another column to compare against, unless they occur as values of this one
+            var_is_column = var in y and not (col == var).any()
+        if var_is_column:
+            var = y[var]
 
     if op == '<=':
-        return ~pd.isna(y[field]) & (y[field] <= var)
-    if cond.startswith('>='):
-        return ~pd.isna(y[field]) & (y[field] >= var)
-    if cond.startswith('<'):
-        return ~pd.isna(y[field]) & (y[field] < var)
-    if cond.startswith('>'):
-        return ~pd.isna(y[field]) & (y[field] > var)
-    if cond.startswith('=='):
+        out = col <= var
+    elif op == '>=':
+        out = col >= var
+    elif op == '<':
+        out = col < var
+    elif op == '>':
+        out = col > var
+    elif op == '==':
         try:
-            return ~pd.isna(y[field]) & (y[field] == var)
+            out = col == var
         except:
-            return ~pd.isna(y[field]) & (y[field].astype('str') == var)
-    if cond.startswith('!='):
+            out = col.astype('str') == var
+    elif op == '!=':
         try:
-            return ~pd.isna(y[field]) & (y[field] != var)
+            out = col != var
         except:
-            return ~pd.isna(y[field]) & (y[field].astype('str') != var)
-    raise ValueError('Unsupported comparator in filter "%s"' %cond)
+            out = col.astype('str') != var
+    else:
+        raise ValueError('Unsupported comparator in filter "%s"' % op)
+
+    return np.asarray(~pd.isna(col) & out, dtype=bool)
 
 
 def compute_splitID(y, split_fields):
@@ -477,11 +1088,158 @@ def compute_partition(y, modulus, n):
     return partition
 
 
-def expand_history(X, X_time, first_obs, last_obs, history_length, int_type='int32', float_type='float32', fill=0.):
+class ImpulseTable(object):
     """
-    Expand out impulse stream in **X** for each response in the target data.
+    Column-oriented impulse table, held as one array per column.
+    Supports the subset of the ``pandas`` ``DataFrame`` interface used by ``build_CDR_impulses()``, and allows impulse histories to be expanded by gathering rows from each column, without first copying the full table into a single array.
+
+    :param arrays: ``dict``; map from column names to 1D ``numpy`` arrays of equal length.
+    :param columns: ``list`` of ``str`` or ``None``; names of columns to expose. If ``None``, expose all columns in **arrays**.
+    """
+
+    def __init__(self, arrays, columns=None):
+        if columns is None:
+            columns = list(arrays.keys())
+        for col in columns:
+            assert col in arrays, 'Column "%s" not found in impulse table.' % col
+        self.arrays = arrays
+        self.columns = list(columns)
+
+    def __len__(self):
+        return len(self.time)
+
+    def __contains__(self, key):
+        return key in self.columns
+
+    def __getitem__(self, key):
+        if isinstance(key, list):
+            return ImpulseTable(self.arrays, columns=key)
+        assert key in self.columns, 'Column "%s" not found in impulse table.' % key
+        return self.arrays[key]
+
+    @property
+    def time(self):
+        return self['time']
+
+
+class ImpulseStore(ImpulseTable):
+    """
+    Read-only impulse table stored on disk as one contiguous memory-mapped array per column.
+    Slices of the store are views onto the page cache, so impulse data can be expanded without copying the full table into memory, and processes that open the same store share a single copy of the data.
+    Stores are created with ``save_impulse_store()``.
+
+    :param path: ``str``; path to store directory.
+    :param columns: ``list`` of ``str`` or ``None``; names of columns to expose. If ``None``, expose all columns in the store.
+    :param arrays: ``dict`` or ``None``; already opened memory maps, shared between views of the same store. If ``None``, columns are opened on first access.
+    """
+
+    def __init__(self, path, columns=None, arrays=None):
+        self.path = path
+        with open(os.path.join(path, 'columns.txt'), 'r') as f:
+            self.column_ix = {col: i for i, col in enumerate(f.read().splitlines())}
+        if columns is None:
+            columns = sorted(self.column_ix, key=lambda col: self.column_ix[col])
+        for col in columns:
+            assert col in self.column_ix, 'Column "%s" not found in impulse store at %s.' % (col, path)
+        self.columns = list(columns)
+        if arrays is None:
+            arrays = {}
+        self.arrays = arrays
+
+    def __getitem__(self, key):
+        if isinstance(key, list):
+            return ImpulseStore(self.path, columns=key, arrays=self.arrays)
+        assert key in self.columns, 'Column "%s" not found in impulse store at %s.' % (key, self.path)
+        if key not in self.arrays:
+            self.arrays[key] = np.load(os.path.join(self.path, '%d.npy' % self.column_ix[key]), mmap_mode='r')
+        return self.arrays[key]
+
+
+def save_impulse_store(X, store_dir, keep_non_numeric=False):
+    """
+    Save the numeric columns of an impulse table as an ``ImpulseStore``.
+    The store is placed in a subdirectory of **store_dir** named by a hash of the table contents, so identical tables (e.g. from different training processes using the same data) share a single store, and an existing store is reused rather than rewritten.
 
     :param X: ``pandas`` ``DataFrame``; impulse (predictor) data.
+    :param store_dir: ``str``; path to directory in which to save the store.
+    :param keep_non_numeric: ``bool``; if ``True``, return an ``ImpulseTable`` exposing all columns of **X**, with numeric columns read from the store and copies of non-numeric columns (e.g. series ids, which are small when categorical) held in memory. The result can then stand in for **X** (e.g. for model initialization as well as fitting), so that **X** itself can be released.
+    :return: ``ImpulseStore`` (or ``ImpulseTable`` if **keep_non_numeric** is ``True``); memory-mapped view of the saved table.
+    """
+
+    columns = [col for col in X.columns if pd.api.types.is_numeric_dtype(X[col]) and not isinstance(X[col].dtype, pd.CategoricalDtype)]
+    assert 'time' in columns, 'Impulse data must contain a numeric "time" column.'
+
+    key = hashlib.md5(repr(columns).encode('utf-8'))
+    key.update(pd.util.hash_pandas_object(X[columns], index=False).values.tobytes())
+    path = os.path.join(store_dir, 'X_%s' % key.hexdigest())
+
+    if not os.path.exists(os.path.join(path, 'columns.txt')):
+        # Write to a temporary directory first so that concurrent processes never see a partial store
+        tmp_path = path + '.%d.tmp' % os.getpid()
+        if not os.path.exists(tmp_path):
+            os.makedirs(tmp_path)
+        for i, col in enumerate(columns):
+            np.save(os.path.join(tmp_path, '%d.npy' % i), np.ascontiguousarray(X[col].values))
+        with open(os.path.join(tmp_path, 'columns.txt'), 'w') as f:
+            f.write('\n'.join(columns))
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process finished writing the same store first
+            shutil.rmtree(tmp_path)
+
+    store = ImpulseStore(path)
+    if keep_non_numeric:
+        arrays = {col: X[col].copy() for col in X.columns if col not in store.columns}
+        arrays.update({col: store[col] for col in store.columns})
+        return ImpulseTable(arrays, columns=list(X.columns))
+
+    return store
+
+
+def get_history_indices(first_obs, last_obs, history_length):
+    """
+    Compute the rows in the impulse data that fill each cell of the expanded history window of each response.
+    Histories are right-aligned, so cell ``k`` of response ``i`` corresponds to impulse row ``last_obs[i] - history_length + k``, and cells preceding **first_obs** are padding.
+
+    :param first_obs: ``numpy`` vector; row indices of the first impulse in the history window of each response (already truncated to **history_length**).
+    :param last_obs: ``numpy`` vector; row indices of the last preceding impulse of each response.
+    :param history_length: ``int``; maximum number of history observations.
+    :return: 2-tuple of ``numpy`` arrays of shape ``(len(first_obs), history_length)``; impulse row indices and boolean mask of non-padding cells.
+    """
+
+    ix = last_obs[..., None] + np.arange(-history_length, 0)[None, ...]
+    valid = ix >= first_obs[..., None]
+
+    return ix, valid
+
+
+def trim_history(X_2d, time_X_2d, time_X_mask, time_X_ix, time_y, n_history):
+    """
+    Trim the history axis of expanded impulse data to its last **n_history** cells.
+    Histories are right-aligned, so if no response has more than **n_history** impulses in its history, only padding cells are dropped.
+    Padding cells still determine the maximum time offset of the batch (their timestamps are zero, so their offset is the response timestamp), which the model uses to scale interpolated IRFs, so this maximum is computed before trimming.
+
+    :param X_2d: ``numpy`` array; expanded impulse array, as returned by ``build_CDR_impulses()``.
+    :param time_X_2d: ``numpy`` array; expanded timestamp array in compact format (one slot per time base).
+    :param time_X_mask: ``numpy`` array; expanded boolean mask in compact format.
+    :param time_X_ix: ``numpy`` vector; time slot of each impulse.
+    :param time_y: ``numpy`` vector; response timestamps.
+    :param n_history: ``int``; number of history cells to keep.
+    :return: 4-tuple; the trimmed impulse, timestamp, and mask arrays, and the maximum time offset of the untrimmed data (``-inf`` if there are no impulses).
+    """
+
+    t_delta = time_y[:, None, None] - time_X_2d[..., time_X_ix]
+    t_delta_max = t_delta.max() if t_delta.size > 0 else -np.inf
+
+    return X_2d[:, -n_history:], time_X_2d[:, -n_history:], time_X_mask[:, -n_history:], t_delta_max
+
+
+def expand_history(X, X_time, first_obs, last_obs, history_length, int_type='int32', float_type='float32', fill=0., chunk_size=65536, compact_time=False):
+    """
+    Expand out impulse stream in **X** for each response in the target data.
+
+    :param X: ``pandas`` ``DataFrame`` or ``ImpulseTable``; impulse (predictor) data.
     :param X_time: ``pandas`` ``Series``; timestamps associated with each impulse in **X**.
     :param first_obs: ``pandas`` ``Series``; vector of row indices in **X** of the first impulse in the time series associated with each response.
     :param last_obs: ``pandas`` ``Series``; vector of row indices in **X** of the last preceding impulse in the time series associated with each response.
@@ -489,27 +1247,39 @@ def expand_history(X, X_time, first_obs, last_obs, history_length, int_type='int
     :param int_type: ``str``; name of int type.
     :param float_type: ``str``; name of float type.
     :param fill: ``float``; fill value for padding cells.
-    :return: 3-tuple of ``numpy`` arrays; the expanded impulse array, the expanded timestamp array, and a boolean mask zeroing out locations of non-existent impulses.
+    :param chunk_size: ``int``; number of responses to expand at a time (bounds the size of intermediate index arrays).
+    :param compact_time: ``bool``; return a single timestamp/mask slice of shape ``(batch_len, history_length, 1)`` rather than one copy per column of **X**, since all columns share the same timestamps.
+    :return: 3-tuple of ``numpy`` arrays; the expanded impulse array, the expanded timestamp array, and a boolean mask (of ``bool`` dtype) zeroing out locations of non-existent impulses.
     """
 
     INT_NP = getattr(np, int_type)
     FLOAT_NP = getattr(np, float_type)
     last_obs = np.array(last_obs, dtype=INT_NP)
     first_obs = np.maximum(np.array(first_obs, dtype=INT_NP), last_obs - history_length)
-    X_time = np.array(X_time, dtype=FLOAT_NP)
-    X = np.array(X)
-
-    X_2d = np.full((first_obs.shape[0], history_length, X.shape[1]), fill, dtype=FLOAT_NP)
-    time_X_2d = np.zeros_like(X_2d)
-    time_mask = np.zeros_like(X_2d)
-
-    for i, first, last in zip(np.arange(first_obs.shape[0]), first_obs, last_obs):
-        if first < last:
-            sX = X[first:last]
-            sXt = X_time[first:last]
-            X_2d[i, -sX.shape[0]:] = sX
-            time_X_2d[i][-len(sXt):] = sXt[..., None]
-            time_mask[i][-len(sXt):] = 1
+    X_time = np.asarray(X_time, dtype=FLOAT_NP)
+    if isinstance(X, ImpulseTable):
+        # Gather from each column directly rather than copying the full table into a single array
+        X_cols = [X[col] for col in X.columns]
+        n_col = len(X_cols)
+    else:
+        X_cols = None
+        X = np.asarray(X)
+        n_col = X.shape[1]
+
+    X_2d = np.full((first_obs.shape[0], history_length, n_col), fill, dtype=FLOAT_NP)
+    time_X_2d = np.zeros((first_obs.shape[0], history_length, 1 if compact_time else n_col), dtype=FLOAT_NP)
+    time_mask = np.zeros(time_X_2d.shape, dtype=bool)
+
+    for i in range(0, first_obs.shape[0], chunk_size):
+        ix, valid = get_history_indices(first_obs[i:i + chunk_size], last_obs[i:i + chunk_size], history_length)
+        ix = ix[valid]
+        if X_cols is None:
+            X_2d[i:i + chunk_size][valid] = X[ix]
+        else:
+            for j, col in enumerate(X_cols):
+                X_2d[i:i + chunk_size, :, j][valid] = col[ix]
+        time_X_2d[i:i + chunk_size][valid] = X_time[ix][..., None]
+        time_mask[i:i + chunk_size][valid] = True
 
     return X_2d, time_X_2d, time_mask
 
@@ -528,18 +1298,32 @@ def compute_time_mask(X_time, first_obs, last_obs, history_length, int_type='int
     """
 
     INT_NP = getattr(np, int_type)
-    FLOAT_NP = getattr(np, float_type)
     last_obs = np.array(last_obs, dtype=INT_NP)
     first_obs = np.maximum(np.array(first_obs, dtype=INT_NP), last_obs - history_length)
-    X_time = np.array(X_time, dtype=FLOAT_NP)
 
-    time_mask = np.zeros((first_obs.shape[0], history_length), dtype=FLOAT_NP)
+    _, valid = get_history_indices(first_obs, last_obs, history_length)
+    # Responses with empty histories are unmasked everywhere, for consistency with previous behavior
+    valid |= (last_obs <= first_obs)[..., None]
+
+    return valid
+
+
+def compress_history(X_2d, time_X_2d, time_X_mask):
+    """
+    Convert expanded impulse data to a ragged representation in compressed sparse row (CSR) format.
+    History cells that are padding for every impulse are dropped, and the remaining cells of all responses are concatenated along a single row axis.
+
+    :param X_2d: ``numpy`` array; expanded impulse array of shape ``(batch_len, history_length, n_impulses)``, as returned by ``build_CDR_impulses()``.
+    :param time_X_2d: ``numpy`` array; expanded timestamp array, possibly in compact format (one slot per time base).
+    :param time_X_mask: ``numpy`` array; expanded boolean mask, in the same format as **time_X_2d**.
+    :return: 4-tuple of ``numpy`` arrays; the impulse rows, the timestamp rows, the mask rows, and a vector of row offsets of length ``batch_len + 1`` (the rows of response ``i`` are ``offsets[i]:offsets[i + 1]``).
+    """
 
-    for i, first, last in zip(np.arange(first_obs.shape[0]), first_obs, last_obs):
-        sXt = X_time[first:last]
-        time_mask[i][-len(sXt):] = 1
+    keep = time_X_mask.any(axis=-1)
+    offsets = np.zeros(len(keep) + 1, dtype=int)
+    offsets[1:] = np.cumsum(keep.sum(axis=1))
 
-    return time_mask
+    return X_2d[keep], time_X_2d[keep], time_X_mask[keep], offsets
 
 
 def preprocess_data(
@@ -550,7 +1334,10 @@ def preprocess_data(
         filters=None,
         compute_history=True,
         history_length=128,
+        history_window=None,
         all_interactions=False,
+        n_workers=1,
+        series_index=None,
         verbose=True,
         debug=False
 ):
@@ -561,10 +1348,13 @@ def preprocess_data(
     :param y: ``pandas`` ``DataFrame``; response data.
     :param formula_list: ``list`` of ``Formula``; CDR formula for which to preprocess data.
     :param series_ids: ``list`` of ``str``; column names whose jointly unique values define unique time series.
-    :param filters: ``list``; list of key-value pairs mapping column names to filtering criteria for their values.
+    :param filters: ``list`` or ``FilterPlan``; list of key-value pairs mapping column names to filtering criteria for their values, or a compiled plan of them.
     :param compute_history: ``bool``; compute history intervals for each regression target.
     :param history_length: ``int``; maximum number of history observations.
+    :param history_window: ``float`` or ``None``; maximum time offset (in the time units of the data) of history observations. If ``None``, histories are limited only by **history_length**.
     :param all_interactions: ``bool``; add powerset of all conformable interactions.
+    :param n_workers: ``int``; number of worker processes to use for computing history intervals.
+    :param series_index: 2-tuple or ``None``; series indices of **X** and **y** as returned by ``read_data()`` with ``return_series_index=True`` (list of impulse series indices, response series index). If ``None``, series indices are computed from the data.
     :param verbose: ``bool``; whether to report progress to stderr
     :param debug: ``bool``; print debugging information
     :return: 7-tuple; predictor data, response data, filtering mask, response-aligned predictor names, response-aligned predictors, 2D predictor names, and 2D predictors
@@ -576,11 +1366,21 @@ def preprocess_data(
     if not isinstance(X, list):
         X = [X]
 
+    if series_index is None:
+        X_index = [None] * len(X)
+        y_index = None
+    else:
+        X_index, y_index = series_index
+
     if filters is None:
         select = np.full((len(y),), True, dtype='bool')
     else:
         select = compute_filters(y, filters)
         y = y[select]
+        if y_index is not None:
+            # Filtering preserves row order, so series ranges shrink to the number of selected rows they contain
+            n_selected = np.concatenate([[0], np.cumsum(select)])
+            y_index = {key: (int(n_selected[start]), int(n_selected[end])) for key, (start, end) in y_index.items() if n_selected[end] > n_selected[start]}
 
     X_response_aligned_predictor_names = None
     X_response_aligned_predictors = None
@@ -589,11 +1389,22 @@ def preprocess_data(
 
     if compute_history:
         X_new = []
+        if y_index is None:
+            y_index = compute_series_index(y, series_ids)
         for i in range(len(X)):
             X_cur = X[i]
             if verbose:
                 stderr('Computing history intervals for each regression target in predictor file %d...\n' % (i+1))
-            first_obs, last_obs = compute_history_intervals(X_cur, y, series_ids)
+            first_obs, last_obs = compute_history_intervals(
+                X_cur,
+                y,
+                series_ids,
+                verbose=verbose,
+                n_workers=n_workers,
+                X_index=X_index[i],
+                y_index=y_index,
+                history_window=history_window
+            )
             y['first_obs_%d' % i] = first_obs
             y['last_obs_%d' % i] = last_obs
 
@@ -611,6 +1422,8 @@ def preprocess_data(
                     print(X_cur[['subject', 'docid', 'word', 'time']][row.first_obs:row.last_obs])
             X_new.append(X_cur)
 
+        # Transforms shared across formulas (e.g. in ablation sets) are computed once
+        transform_cache = {}
         for x in formula_list:
             X_new, y, X_response_aligned_predictor_names, X_response_aligned_predictors, X_2d_predictor_names, X_2d_predictors = x.apply_formula(
                 X_new,
@@ -621,7 +1434,9 @@ def preprocess_data(
                 X_response_aligned_predictors=X_response_aligned_predictors,
                 history_length=history_length,
                 all_interactions=all_interactions,
-                series_ids=series_ids
+                series_ids=series_ids,
+                series_index=X_index,
+                transform_cache=transform_cache
             )
     else:
         X_new = X
@@ -5,7 +5,7 @@ import ast
 import itertools
 import numpy as np
 
-from .data import z, c, s, compute_time_mask, expand_history
+from .data import z, c, s, compute_time_mask, expand_history, compute_lags
 from .util import names2ix, sn, stderr
 
 interact = re.compile('([^ ]+):([^ ]+)')
@@ -960,12 +960,12 @@ class Formula(object):
         Apply op **op** to array **arr**.
 
         :param op: ``str``; name of op.
-        :param arr: ``numpy`` or ``pandas`` array; source data.
+        :param arr: ``pandas`` ``Series``; source data. Not modified.
         :return: ``numpy`` array; transformed data.
         """
 
-        arr.fillna(0, inplace=True)
-        arr[arr == np.inf] = 0
+        arr = arr.fillna(0)
+        arr = arr.where(arr != np.inf, 0)
         if op in ['c', 'c.']:
             out = c(arr)
         elif op in ['z', 'z.']:
@@ -982,12 +982,46 @@ class Formula(object):
             raise ValueError('Unrecognized op: "%s".' % op)
         return out
 
-    def apply_ops(self, impulse, X):
+    def apply_op_chain(self, col, ops, X, transform_cache=None):
+        """
+        Apply a sequence of ops to a column of **X**.
+        If **ops** is non-empty, NaN and inf values in the base column are replaced with 0 in **X** itself.
+        If **transform_cache** is provided, the result of each prefix of **ops** is looked up in it (or stored in it if missing), keyed by table, base column, and op chain, so that transforms shared by several impulses or formulas (e.g. ``log`` in ``log(x)`` and ``z.(log(x))``) are only computed once per table.
+
+        :param col: ``str``; name of the base column.
+        :param ops: ``list`` of ``str``; names of ops to apply, in order.
+        :param X: ``pandas`` table; table containing the base column.
+        :param transform_cache: ``dict`` or ``None``; cache of transformed columns. If ``None``, no caching.
+        :return: ``pandas`` ``Series``; transformed data.
+        """
+
+        if ops and not (transform_cache is not None and (id(X), col, tuple(ops[:1])) in transform_cache):
+            # Ops see NaN and inf as 0, so scrub the base column in the table too, keeping raw impulses
+            # on the same column (e.g. x alongside log(x)) consistent with their transforms
+            scrub = X[col].isna() | (X[col] == np.inf)
+            if scrub.any():
+                X[col] = X[col].where(~scrub, 0)
+
+        new_col = X[col]
+        for j in range(len(ops)):
+            key = (id(X), col, tuple(ops[:j + 1]))
+            # The cache holds a reference to each table, so a matching id always refers to the same table
+            if transform_cache is not None and key in transform_cache and transform_cache[key][0] is X:
+                new_col = transform_cache[key][1]
+            else:
+                new_col = self.apply_op(ops[j], new_col)
+                if transform_cache is not None:
+                    transform_cache[key] = (X, new_col)
+
+        return new_col
+
+    def apply_ops(self, impulse, X, transform_cache=None):
         """
         Apply all ops defined for an impulse
 
         :param impulse: ``Impulse`` object; the impulse.
         :param X: list of ``pandas`` tables; table containing the impulse data.
+        :param transform_cache: ``dict`` or ``None``; cache of transformed columns shared across calls (see ``apply_op_chain()``). If ``None``, no caching.
         :return: ``pandas`` table; table augmented with transformed impulse.
         """
 
@@ -1007,9 +1041,9 @@ class Formula(object):
                     X_cur, expanded_impulses, expanded_atomic_impulses = impulse.expand_categorical(X_cur)
                     for x in expanded_atomic_impulses:
                         for a in x:
-                            X_cur = self.apply_ops(a, X_cur)
+                            X_cur = self.apply_ops(a, X_cur, transform_cache=transform_cache)
                     for x in expanded_impulses:
-                        if x.name() not in X_cur.columns:
+                        if x.name() not in X_cur.columns and x.id not in X_cur.columns:
                             X_cur[x.id] = X_cur[[y.name() for y in x.atomic_impulses]].product(axis=1)
             else:
                 if type(impulse).__name__ == 'ImpulseInteraction':
@@ -1020,11 +1054,7 @@ class Formula(object):
             if expanded_impulses is not None:
                 for x in expanded_impulses:
                     if x.name() not in X_cur.columns:
-                        new_col = X_cur[x.id]
-                        for j in range(len(ops)):
-                            op = ops[j]
-                            new_col = self.apply_op(op, new_col)
-                        X_cur[x.name()] = new_col
+                        X_cur[x.name()] = self.apply_op_chain(x.id, ops, X_cur, transform_cache=transform_cache)
 
             X[i] = X_cur
 
@@ -1182,7 +1212,9 @@ class Formula(object):
             X_2d_predictors=None,
             history_length=128,
             all_interactions=False,
-            series_ids=None
+            series_ids=None,
+            series_index=None,
+            transform_cache=None
     ):
         """
         Extract all data and compute all transforms required by the model formula.
@@ -1196,13 +1228,15 @@ class Formula(object):
         :param history_length: ``int``; maximum number of timesteps in the history dimension.
         :param all_interactions: ``bool``; add powerset of all conformable interactions.
         :param series_ids: ``list`` of ``str`` or ``None``; list of ids to use as grouping factors for lagged effects. If ``None``, lagging will not be attempted.
+        :param series_index: ``list`` or ``None``; series index of each table in **X** (see ``compute_series_index()``), used for lagging. If ``None``, computed from **X** as needed.
+        :param transform_cache: ``dict`` or ``None``; cache of transformed columns, which can be shared across formulas applied to the same data to avoid recomputing common transforms (see ``apply_op_chain()``). If ``None``, no caching.
         :return: 6-tuple; transformed **X**, transformed **y**, transformed response-aligned predictor names, transformed response-aligned predictors, transformed 2D predictor names, transformed 2D predictors
         """
         if not isinstance(X, list):
             X = [X]
 
         if self.dv not in y.columns:
-            y = self.apply_ops(self.dv_term, y)
+            y = self.apply_ops(self.dv_term, y, transform_cache=transform_cache)
         impulses = self.t.impulses(include_interactions=True)
 
         if all_interactions:
@@ -1233,6 +1267,35 @@ class Formula(object):
             for c in X_cur.columns:
                 X_columns.add(c)
 
+        # Compute all spillover (lagged) predictors missing from the data, in a single pass per predictor table
+        if series_ids is not None:
+            lags = [[] for _ in X]
+            for impulse in impulses:
+                if type(impulse).__name__ == 'ImpulseInteraction':
+                    to_process = impulse.impulses()
+                else:
+                    to_process = [impulse]
+                for x in to_process:
+                    sp = spillover.match(x.id)
+                    if not x.is_2d and x.id not in X_columns and sp and sp.group(1) in X_columns:
+                        lag = (sp.group(1), int(sp.group(2)), x.id)
+                        for i in range(len(X)):
+                            if lag[0] in X[i].columns:
+                                if lag not in lags[i]:
+                                    lags[i].append(lag)
+                                break
+            for i in range(len(X)):
+                if len(lags[i]) > 0:
+                    lagged = compute_lags(
+                        X[i],
+                        series_ids,
+                        [(x_id, n) for x_id, n, _ in lags[i]],
+                        series_index=None if series_index is None else series_index[i]
+                    )
+                    for x_id, n, name in lags[i]:
+                        X[i][name] = lagged['%sS%d' % (x_id, n)]
+                        X_columns.add(name)
+
         for impulse in impulses:
             if type(impulse).__name__ == 'ImpulseInteraction':
                 to_process = impulse.impulses()
@@ -1271,32 +1334,20 @@ class Formula(object):
                     )
 
                 elif x.id not in X_columns:
-                    sp = spillover.match(x.id)
-                    if sp and sp.group(1) in X_columns and series_ids is not None:
-                        x_id = sp.group(1)
-                        n = int(sp.group(2))
-                        for i in range(len(X)):
-                            X_cur = X[i]
-                            if x_id in X_cur.columns:
-                                X_cur[x_id] = X_cur.groupby(series_ids)[x_id].shift_activations(n, fill_value=0.)
-                                X_cur = self.apply_ops(x, X_cur)
-                                X[i] = X_cur
-                                break
-                    else:
-                        y = self.apply_ops(x, y)
-                        if x.name() not in X_response_aligned_predictor_names:
-                            X_response_aligned_predictor_names.append(x.name())
+                    y = self.apply_ops(x, y, transform_cache=transform_cache)
+                    if x.name() not in X_response_aligned_predictor_names:
+                        X_response_aligned_predictor_names.append(x.name())
 
-                            if X_response_aligned_predictors is None:
-                                X_response_aligned_predictors = y[[x.id]]
-                            else:
-                                X_response_aligned_predictors[[x.id]] = y[[x.id]]
-                            X_response_aligned_predictors = self.apply_ops(x, X_response_aligned_predictors)
+                        if X_response_aligned_predictors is None:
+                            X_response_aligned_predictors = y[[x.id]]
+                        else:
+                            X_response_aligned_predictors[[x.id]] = y[[x.id]]
+                        X_response_aligned_predictors = self.apply_ops(x, X_response_aligned_predictors, transform_cache=transform_cache)
                 else:
                     for i in range(len(X)):
                         X_cur = X[i]
                         if x.id in X_cur.columns:
-                            X_cur = self.apply_ops(x, X_cur)
+                            X_cur = self.apply_ops(x, X_cur, transform_cache=transform_cache)
                             X[i] = X_cur
                             break
 
@@ -1309,7 +1360,7 @@ class Formula(object):
                 if response_aligned:
                     if impulse.name() not in X_response_aligned_predictor_names:
                         X_response_aligned_predictor_names.append(impulse.name())
-                        X_response_aligned_predictors = self.apply_ops(impulse, X_response_aligned_predictors)
+                        X_response_aligned_predictors = self.apply_ops(impulse, X_response_aligned_predictors, transform_cache=transform_cache)
                 else:
                     found = False
                     for i in range(len(X)):
@@ -1319,7 +1370,7 @@ class Formula(object):
                             if atom.id not in X_cur.columns:
                                 in_X = False
                         if in_X:
-                            X_cur = self.apply_ops(impulse, X_cur)
+                            X_cur = self.apply_ops(impulse, X_cur, transform_cache=transform_cache)
                             X[i] = X_cur
                             found = True
                             break
@@ -1339,6 +1390,34 @@ class Formula(object):
 
         return X, y, X_response_aligned_predictor_names, X_response_aligned_predictors, X_2d_predictor_names, X_2d_predictors
 
+    def source_columns(self):
+        """
+        Get names of the columns in the source data needed to apply the formula.
+        Transformed terms (e.g. ``z.(x)``) resolve to their base column (``x``), and spillover terms (e.g. ``xS1``) resolve to both the spillover name and its base column, since the spillover may be either precomputed or derived at preprocessing time.
+        Returns ``None`` if the model contains 2D predictors, whose inputs (embedding dimensions) are not named in the formula.
+
+        :return: ``set`` of ``str`` or ``None``; column names.
+        """
+
+        out = {self.dv_term.id}
+        for impulse in self.t.impulses(include_interactions=True):
+            if type(impulse).__name__ == 'ImpulseInteraction':
+                atoms = impulse.impulses()
+            else:
+                atoms = [impulse]
+            for x in atoms:
+                if x.is_2d:
+                    return None
+                out.add(x.id)
+                sp = spillover.match(x.id)
+                if sp:
+                    out.add(sp.group(1))
+        for gf in self.rangf:
+            for col in gf.split(':'):
+                out.add(col)
+
+        return out
+
     def ablate_impulses(self, impulse_ids):
         """
         Remove impulses in **impulse_ids** from fixed effects (retaining in any random effects).
@@ -1,9 +1,347 @@
 import sys
+import os
+import hashlib
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 
+from .data import FilterPlan, get_row_filters, compute_series_index, parse_filter_condition
 from .util import stderr
 
-def read_data(X_paths, y_paths, series_ids, categorical_columns=None, sep=' '):
+CACHE_VERSION = 3
+BUNDLE_VERSION = 1
+
+
+def hash_file(path, block_size=2**20):
+    """
+    Compute a content hash of a file.
+
+    :param path: ``str``; path to file.
+    :param block_size: ``int``; number of bytes to read at a time.
+    :return: ``str``; hexadecimal MD5 digest of the file contents.
+    """
+
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        block = f.read(block_size)
+        while block:
+            h.update(block)
+            block = f.read(block_size)
+    return h.hexdigest()
+
+
+def parallel_map(fn, items, n_workers=1):
+    """
+    Apply **fn** to each element of **items** using a pool of worker threads, preserving input order.
+    Threads (rather than processes) are used because parsing and sorting in ``pandas`` release the GIL for most of their work and because the resulting tables would otherwise need to be serialized back to the parent process.
+
+    :param fn: callable; function to apply.
+    :param items: ``list``; inputs to **fn**.
+    :param n_workers: ``int``; maximum number of worker threads. If ``1``, **fn** is applied serially.
+    :return: ``list``; outputs of **fn**, in the same order as **items**.
+    """
+
+    n_workers = min(n_workers, len(items))
+    if n_workers <= 1:
+        return [fn(x) for x in items]
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        return list(pool.map(fn, items))
+
+
+def plan_dtypes(df, float_type='float32', int_type='int32', exclude=None):
+    """
+    Compute a compact dtype for each numeric column of a table.
+    Float columns are downcast to **float_type** and integer columns to **int_type**, unless doing so would overflow the target type, in which case the column keeps its original dtype.
+    Columns listed in **exclude** are left unchanged.
+
+    :param df: ``pandas`` DataFrame; table to plan dtypes for.
+    :param float_type: ``str``; target type for float columns.
+    :param int_type: ``str``; target type for integer columns.
+    :param exclude: ``list`` of ``str`` or ``None``; names of columns to leave unchanged.
+    :return: ``dict``; map from column names to target dtypes, containing only the columns whose dtype changes.
+    """
+
+    if exclude is None:
+        exclude = []
+    exclude = set(exclude)
+    float_type = np.dtype(float_type)
+    int_type = np.dtype(int_type)
+
+    out = {}
+    for col in df.columns:
+        if col in exclude:
+            continue
+        dtype = df[col].dtype
+        if pd.api.types.is_bool_dtype(dtype) or not pd.api.types.is_numeric_dtype(dtype) or isinstance(dtype, pd.CategoricalDtype):
+            continue
+        if pd.api.types.is_float_dtype(dtype):
+            if dtype.itemsize <= float_type.itemsize:
+                continue
+            vals = df[col].values
+            vals = np.abs(vals[np.isfinite(vals)])
+            if len(vals) == 0 or vals.max() <= np.finfo(float_type).max:
+                out[col] = float_type
+        elif pd.api.types.is_integer_dtype(dtype):
+            if dtype.itemsize <= int_type.itemsize:
+                continue
+            info = np.iinfo(int_type)
+            if len(df) == 0 or (df[col].min() >= info.min and df[col].max() <= info.max):
+                out[col] = int_type
+
+    return out
+
+
+def get_sort_key(df, keys):
+    """
+    Compute a single integer key whose order matches the lexicographic order of the columns **keys** of **df**.
+
+    :param df: ``pandas`` DataFrame; table to compute the key for.
+    :param keys: ``list`` of ``str``; names of columns to sort by, in order of priority.
+    :return: ``numpy`` array or ``None``; ``int64`` sort key with one element per row, or ``None`` if the key cannot be computed (missing values, unorderable values, or too many unique value combinations to fit into 64 bits).
+    """
+
+    key = np.zeros(len(df), dtype='int64')
+    n_combinations = 1
+    for col in keys:
+        try:
+            codes, uniques = pd.factorize(df[col], sort=True)
+        except TypeError:
+            return None
+        if (codes < 0).any():
+            return None
+        n_combinations *= max(len(uniques), 1)
+        if n_combinations > np.iinfo('int64').max:
+            return None
+        key = key * len(uniques) + codes
+
+    return key
+
+
+def is_sorted(key):
+    """
+    Check whether an array is in non-decreasing order.
+
+    :param key: ``numpy`` array; array to check.
+    :return: ``bool``; whether **key** is sorted.
+    """
+
+    return bool(np.all(key[1:] >= key[:-1]))
+
+
+def merge_sorted(tables, keys):
+    """
+    Concatenate tables and sort the result by **keys**.
+    Sorting is skipped when the concatenated table is already in order, and tables that are individually sorted are combined by merging rather than re-sorting, using a stable sort over a single integer key (which runs in near-linear time on pre-sorted runs).
+    A full sort is only performed when some table is out of order.
+    In all cases, the result is identical to ``pd.concat(tables).sort_values(keys).reset_index(drop=True)``.
+
+    :param tables: ``list`` of ``pandas`` DataFrame; tables to combine.
+    :param keys: ``list`` of ``str``; names of columns to sort by, in order of priority.
+    :return: ``pandas`` DataFrame; sorted table.
+    """
+
+    df = pd.concat(tables, axis=0).reset_index(drop=True)
+    key = get_sort_key(df, keys)
+    if key is None:
+        return df.sort_values(keys).reset_index(drop=True)
+    if is_sorted(key):
+        return df
+
+    start = 0
+    for table in tables:
+        end = start + len(table)
+        if not is_sorted(key[start:end]):
+            return df.sort_values(keys).reset_index(drop=True)
+        start = end
+
+    return df.take(np.argsort(key, kind='stable')).reset_index(drop=True)
+
+
+def get_projection(formula_list, config):
+    """
+    Compute the set of source columns needed to fit or evaluate the models in **formula_list** under the data settings in **config**.
+    The result can be passed as the **usecols** argument of ``read_data()`` in order to skip loading columns that no model uses.
+
+    :param formula_list: ``list`` of ``Formula``; model formulae.
+    :param config: ``Config``; experiment configuration, used for its series ids, split ids, filters, and cross-validation factors.
+    :return: ``list`` of ``str`` or ``None``; sorted column names, or ``None`` if the required columns cannot be determined from the formulae (in which case all columns should be loaded).
+    """
+
+    out = {'time'}
+    out |= set(config.series_ids)
+    out |= set(config.split_ids)
+
+    for field, cond in config.filters:
+        if field.lower().endswith('nunique'):
+            out.add(field[:-7])
+        out.add(field)
+        # Filter conditions can compare against other columns, named by non-numeric, unquoted values
+        _, var = parse_filter_condition(cond)
+        if isinstance(var, str) and var and var[0] not in '\'"':
+            out.add(var)
+
+    for model_name in config.models:
+        crossval_factor = config.models[model_name].get('crossval_factor', None)
+        if crossval_factor:
+            out.add(crossval_factor)
+
+    for form in formula_list:
+        cols = form.source_columns()
+        if cols is None:
+            return None
+        out |= cols
+
+    return sorted(out)
+
+
+def is_cdr_model(model_name):
+    """
+    Check whether **model_name** names a CDR model (rather than a baseline model like an LM or GAM).
+
+    :param model_name: ``str``; name of model as given in the config file.
+    :return: ``bool``; whether the model is a CDR model.
+    """
+
+    return model_name.startswith('CDR') or model_name.startswith('DTSR')
+
+
+def use_projection(config, model_names):
+    """
+    Check whether data for **model_names** should be loaded with column projection (see ``get_projection()``).
+    Projection is only used when enabled in **config** and all models are CDR models, since baseline models may use arbitrary columns.
+
+    :param config: ``Config``; experiment configuration.
+    :param model_names: ``list`` of ``str``; names of the models to be run on the loaded data.
+    :return: ``bool``; whether to project columns on load.
+    """
+
+    return bool(config.project_columns) and len(model_names) > 0 and all(is_cdr_model(m) for m in model_names)
+
+
+def get_cache_key(X_paths, y_paths, series_ids, categorical_columns=None, sep=' ', usecols=None, float_type=None, int_type=None, filters=None):
+    """
+    Compute the key under which the output of ``read_data()`` is cached.
+    The key depends on the contents (not the names) of all source files, as well as on all settings that affect the loaded tables.
+
+    :param X_paths: ``list`` of ``str``; path(s) to impulse (predictor) data, as passed to ``read_data()``.
+    :param y_paths: ``list`` of ``str``; path(s) to response data, as passed to ``read_data()``.
+    :param series_ids: ``list`` of ``str``; column names whose jointly unique values define unique time series.
+    :param categorical_columns: ``list`` of ``str``; column names that should be treated as categorical.
+    :param sep: ``str``; string representation of field delimiter in input data.
+    :param usecols: ``list`` of ``str`` or ``None``; column names to load, as passed to ``read_data()``.
+    :param float_type: ``str`` or ``None``; target type for float columns, as passed to ``read_data()``.
+    :param int_type: ``str`` or ``None``; target type for integer columns, as passed to ``read_data()``.
+    :param filters: ``list`` or ``None``; response filters, as passed to ``read_data()``.
+    :return: ``str``; cache key.
+    """
+
+    X_hashes = [[hash_file(x) for x in path.split(';')] for path in X_paths]
+    y_hashes = [hash_file(path) for path in y_paths]
+    if categorical_columns is None:
+        categorical_columns = []
+    settings = (
+        CACHE_VERSION,
+        X_hashes,
+        y_hashes,
+        list(series_ids),
+        sorted(categorical_columns),
+        sep,
+        None if usecols is None else sorted(usecols),
+        float_type,
+        int_type,
+        get_row_filters(filters)
+    )
+
+    return hashlib.md5(repr(settings).encode('utf-8')).hexdigest()
+
+
+def get_bundle_path(X_paths, y_paths, config):
+    """
+    Get the path of the preprocessed data bundle for a given dataset and configuration.
+    The path depends on the contents of the source files and on all data settings in **config** that affect preprocessing, so bundles are never reused after the data or the settings change.
+
+    :param X_paths: ``list`` of ``str``; path(s) to impulse (predictor) data, as passed to ``read_data()``.
+    :param y_paths: ``list`` of ``str``; path(s) to response data, as passed to ``read_data()``.
+    :param config: ``Config``; experiment configuration.
+    :return: ``str``; path to bundle file.
+    """
+
+    if not isinstance(X_paths, list):
+        X_paths = [X_paths]
+    if not isinstance(y_paths, list):
+        y_paths = [y_paths]
+
+    settings = (
+        BUNDLE_VERSION,
+        [[hash_file(x) for x in path.split(';')] for path in X_paths],
+        [hash_file(path) for path in y_paths],
+        config.series_ids,
+        config.split_ids,
+        config.sep,
+        config.filters,
+        config.filter_on_read,
+        config.history_length,
+        config.history_window,
+        config.project_columns,
+        config.data_float_type,
+        config.data_int_type
+    )
+    key = hashlib.md5(repr(settings).encode('utf-8')).hexdigest()
+
+    return os.path.join(config.outdir, 'preprocessed', 'data_%s.obj' % key)
+
+
+def save_bundle(path, data, formula_list):
+    """
+    Save the output of ``preprocess_data()`` as a preprocessed data bundle.
+
+    :param path: ``str``; path to bundle file, as computed by ``get_bundle_path()``.
+    :param data: ``tuple``; output of ``preprocess_data()``.
+    :param formula_list: ``list`` of ``Formula``; model formulae used to preprocess **data**.
+    :return: ``None``
+    """
+
+    bundle = {
+        'version': BUNDLE_VERSION,
+        'formulae': sorted(set(str(f) for f in formula_list)),
+        'data': data
+    }
+    bundle_dir = os.path.dirname(path)
+    if not os.path.exists(bundle_dir):
+        os.makedirs(bundle_dir)
+    tmp_path = path + '.%d.tmp' % os.getpid()
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(bundle, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def load_bundle(path, formula_list):
+    """
+    Load a preprocessed data bundle, if one exists that covers all formulae in **formula_list**.
+
+    :param path: ``str``; path to bundle file, as computed by ``get_bundle_path()``.
+    :param formula_list: ``list`` of ``Formula``; model formulae for which preprocessed data are needed.
+    :return: ``tuple`` or ``None``; output of ``preprocess_data()`` stored in the bundle, or ``None`` if no usable bundle exists.
+    """
+
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        bundle = pickle.load(f)
+    if bundle.get('version', None) != BUNDLE_VERSION:
+        stderr('Ignoring preprocessed data bundle %s, which was created by an incompatible version of CDR.\n' % path)
+        return None
+    missing = set(str(f) for f in formula_list) - set(bundle['formulae'])
+    if missing:
+        stderr('Ignoring preprocessed data bundle %s, which does not cover formula(e): %s\n' % (path, ', '.join(sorted(missing))))
+        return None
+    stderr('Loading preprocessed data from %s...\n' % path)
+
+    return bundle['data']
+
+
+def read_data(X_paths, y_paths, series_ids, categorical_columns=None, sep=' ', usecols=None, float_type=None, int_type=None, filters=None, chunksize=65536, n_workers=1, cache_dir=None, return_series_index=False):
     """
     Read impulse and response data into pandas dataframes and perform basic pre-processing.
 
@@ -12,7 +350,15 @@ def read_data(X_paths, y_paths, series_ids, categorical_columns=None, sep=' '):
     :param series_ids: ``list`` of ``str``; column names whose jointly unique values define unique time series.
     :param categorical_columns: ``list`` of ``str``; column names that should be treated as categorical.
     :param sep: ``str``; string representation of field delimiter in input data.
-    :return: (list(``pandas`` DataFrame), ``pandas`` DataFrame); (impulse data, response data). Impulse data has one element for each dataset in X_paths, each containing the column-wise concatenation of all column files in the path.
+    :param usecols: ``list`` of ``str`` or ``None``; names of columns to load (columns absent from a given file are ignored). Can be computed from the model formulae using ``get_projection()``. If ``None``, load all columns.
+    :param float_type: ``str`` or ``None``; if specified, downcast float columns to this type as they are read (see ``plan_dtypes()``). Timestamps are always kept at full precision. If ``None``, keep the types inferred by ``pandas``.
+    :param int_type: ``str`` or ``None``; if specified, downcast integer columns to this type as they are read (see ``plan_dtypes()``). If ``None``, keep the types inferred by ``pandas``.
+    :param filters: ``list``, ``FilterPlan``, or ``None``; list of key-value pairs mapping column names to filtering criteria for their values (see ``preprocess_data()``), or a compiled plan of them. If specified, response data are read in chunks and rows rejected by the filters are discarded as each chunk is read. Only the filters preceding the first unique-count (``nunique``) filter are applied here; the full set of filters must still be applied downstream by ``preprocess_data()``. If ``None``, all response rows are loaded.
+    :param chunksize: ``int``; number of rows per chunk when reading response data with **filters**.
+    :param n_workers: ``int``; number of worker threads used to read and sort the source tables. Output does not depend on this setting.
+    :param cache_dir: ``str`` or ``None``; directory in which to cache the loaded tables in binary form, keyed by the contents of the source files and the loading settings. Subsequent calls with identical inputs load from the cache rather than re-parsing the source files. If ``None``, no caching. Series indices are cached along with the data.
+    :param return_series_index: ``bool``; whether to also return the series index (see ``compute_series_index()``) of each table.
+    :return: (list(``pandas`` DataFrame), ``pandas`` DataFrame); (impulse data, response data). Impulse data has one element for each dataset in X_paths, each containing the column-wise concatenation of all column files in the path. If **return_series_index** is ``True``, a third element is returned containing the pair (list of impulse series indices, response series index).
     """
 
     if not isinstance(X_paths, list):
@@ -20,18 +366,89 @@ def read_data(X_paths, y_paths, series_ids, categorical_columns=None, sep=' '):
     if not isinstance(y_paths, list):
         y_paths = [y_paths]
 
-    stderr('Loading data...\n')
-    X = []
-    y = []
+    if cache_dir is not None:
+        cache_key = get_cache_key(
+            X_paths,
+            y_paths,
+            series_ids,
+            categorical_columns=categorical_columns,
+            sep=sep,
+            usecols=usecols,
+            float_type=float_type,
+            int_type=int_type,
+            filters=filters
+        )
+        cache_path = os.path.join(cache_dir, 'data_%s.obj' % cache_key)
+        if os.path.exists(cache_path):
+            stderr('Loading cached data from %s...\n' % cache_path)
+            with open(cache_path, 'rb') as f:
+                X, y, series_index = pickle.load(f)
+            if return_series_index:
+                return X, y, series_index
+            return X, y
+
+    if usecols is None:
+        usecols_fn = None
+    else:
+        usecols = set(usecols)
+        usecols_fn = lambda col: col in usecols
+
+    if categorical_columns is None:
+        categorical_columns = []
+    # Categorical columns are converted after concatenation, and timestamps must retain full precision
+    # for history interval computation
+    dtype_exclude = ['time'] + series_ids + [col for t in categorical_columns for col in t.split(':')]
 
-    for path in X_paths:
-        x_paths = []
-        for x in path.split(';'):
-            x_paths.append(pd.read_csv(x, sep=sep, skipinitialspace=True))
-        X.append(x_paths)
+    # Filters are compiled once and their row-wise prefix is applied to each chunk
+    row_filters = FilterPlan(filters).row_plan()
 
-    for path in y_paths:
-        y.append(pd.read_csv(path, sep=sep, skipinitialspace=True))
+    def read_table(path):
+        df = pd.read_csv(path, sep=sep, skipinitialspace=True, usecols=usecols_fn)
+        return plan_table(df)
+
+    def read_filtered_table(path):
+        # Decide once per file whether comparison values name columns, so that all chunks are filtered alike
+        header = pd.read_csv(path, sep=sep, skipinitialspace=True, usecols=usecols_fn, nrows=0)
+        fields = row_filters.comparison_columns(header.columns)
+        if fields:
+            plan = row_filters.bind(pd.read_csv(path, sep=sep, skipinitialspace=True, usecols=fields), columns=header.columns)
+        else:
+            plan = row_filters.bind(header)
+        chunks = []
+        for chunk in pd.read_csv(path, sep=sep, skipinitialspace=True, usecols=usecols_fn, chunksize=chunksize):
+            chunks.append(chunk[plan.compute(chunk, verbose=False)])
+        if chunks:
+            df = pd.concat(chunks, axis=0).reset_index(drop=True)
+        else:
+            df = header
+        return plan_table(df)
+
+    def plan_table(df):
+        if float_type is not None or int_type is not None:
+            dtypes = plan_dtypes(
+                df,
+                float_type=float_type if float_type is not None else 'float64',
+                int_type=int_type if int_type is not None else 'int64',
+                exclude=dtype_exclude
+            )
+            if dtypes:
+                df = df.astype(dtypes)
+        return df
+
+    def sort_table(tables):
+        return merge_sorted(tables, series_ids + ['time'])
+
+    stderr('Loading data...\n')
+    X_split = [path.split(';') for path in X_paths]
+    # Read all source files in one pool, then regroup the results by dataset
+    tables = [(read_table, x) for x_paths in X_split for x in x_paths]
+    tables += [(read_filtered_table if len(row_filters) > 0 else read_table, path) for path in y_paths]
+    tables = parallel_map(lambda x: x[0](x[1]), tables, n_workers=n_workers)
+    X = []
+    for x_paths in X_split:
+        X.append(tables[:len(x_paths)])
+        tables = tables[len(x_paths):]
+    y = tables
 
     X_new = []
     # Loop through datasets
@@ -40,35 +457,52 @@ def read_data(X_paths, y_paths, series_ids, categorical_columns=None, sep=' '):
             while j >= len(X_new):
                 X_new.append([])
             X_new[j].append(X[i][j])
-    X = []
-    # Loop through column files
-    for x in X_new:
-        X.append(pd.concat(x, axis=0))
-    y = pd.concat(y, axis=0)
 
     stderr('Ensuring sort order...\n')
-    for i, x in enumerate(X):
-        X[i] = x.sort_values(series_ids + ['time']).reset_index(drop=True)
-    y = y.sort_values(series_ids + ['time']).reset_index(drop=True)
-
-    if categorical_columns is not None:
-        for t in categorical_columns:
-            for col in t.split(':'):
-                for x in X:
-                    if col in x.columns:
-                        x[col] = x[col].astype('category')
-                if col in y.columns:
-                    y[col] = y[col].astype('category')
-
-    for x in X:
+    # Loop through column files
+    tables = parallel_map(sort_table, X_new + [y], n_workers=n_workers)
+    X = tables[:-1]
+    y = tables[-1]
+
+    for t in categorical_columns:
+        for col in t.split(':'):
+            for x in X:
+                if col in x.columns:
+                    x[col] = x[col].astype('category')
+            if col in y.columns:
+                y[col] = y[col].astype('category')
+
+    series_index = ([compute_series_index(x, series_ids) for x in X], compute_series_index(y, series_ids))
+
+    for x, x_index in zip(X, series_index[0]):
         assert not 'rate' in x.columns, '"rate" is a reserved column name in CDR. Rename your input column...'
-        x['rate'] = 1.
+        if float_type is None:
+            x['rate'] = 1.
+        else:
+            x['rate'] = np.ones(len(x), dtype=float_type)
         if 'trial' not in x.columns:
-            x['trial'] = x.groupby(series_ids).rate.cumsum()
+            # 1-based position of each row within its series
+            starts = np.zeros(len(x), dtype=int)
+            for start, end in x_index.values():
+                starts[start:end] = start
+            x['trial'] = (np.arange(len(x)) - starts + 1).astype(x['rate'].dtype)
     # X_groups = X.groupby(series_ids)
     # X['percentTrialsComplete'] = X_groups['trial'].apply(lambda x: x / max(x))
     # X['percentTimeComplete'] = X_groups['time'].apply(lambda x: x / max(x))
     # X_groups = X.groupby(series_ids + ['sentid'])
     # X['percentSentComplete'] = X_groups['sentpos'].apply(lambda x: x / max(x))
     # X._get_numeric_data().fillna(value=0, inplace=True)
+
+    if cache_dir is not None:
+        stderr('Caching data to %s...\n' % cache_path)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # Write to a temporary file first so that concurrent jobs never see a partial cache
+        tmp_path = cache_path + '.%d.tmp' % os.getpid()
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((X, y, series_index), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+
+    if return_series_index:
+        return X, y, series_index
     return X, y
@@ -345,6 +345,12 @@ MODEL_INITIALIZATION_KWARGS = [
         [int, None],
         "Size of minibatches to use for fitting (full-batch if ``None``)."
     ),
+    Kwarg(
+        'n_history_buckets',
+        None,
+        [int, None],
+        "Number of history length buckets to use when sampling training minibatches. If ``None``, minibatches are drawn uniformly at random. Otherwise, each minibatch is drawn from responses with similar history lengths (number of preceding impulses, up to **history_length**), and its time dimension is trimmed to the longest history it contains, reducing computation when many histories are shorter than **history_length**. Trimming is skipped if **center_inputs** is ``True`` or the model has continuous impulses, since the convolution then depends on padding cells. Minibatch composition and order remain random."
+    ),
     Kwarg(
         'eval_minibatch_size',
         100000,
@@ -352,6 +358,30 @@ MODEL_INITIALIZATION_KWARGS = [
         "Size of minibatches to use for prediction/evaluation (full-batch if ``None``).",
         default_value_cdrnn=10000
     ),
+    Kwarg(
+        'corr_n_samples',
+        None,
+        [int, None],
+        "Number of responses to sample when reporting the correlation matrix of the input variables before fitting. If ``None``, correlations are computed exactly over all training responses, except with **lazy_history_expansion** or **memmap_history**, where **eval_minibatch_size** responses are sampled to avoid expanding the full dataset. When responses are sampled, the reported correlations are approximate. Samples are drawn with a fixed seed and do not affect the random state used for training."
+    ),
+    Kwarg(
+        'lazy_history_expansion',
+        False,
+        bool,
+        "Whether to expand impulse histories one minibatch at a time during fitting and prediction, rather than constructing the full ``(n, history_length, n_impulse)`` input arrays up front. Reduces memory usage for large datasets at the cost of repeating the expansion for each minibatch."
+    ),
+    Kwarg(
+        'memmap_history',
+        False,
+        bool,
+        "Whether to write the expanded impulse histories used for fitting to memory-mapped files in the model output directory and read training minibatches from disk, for datasets whose expanded inputs do not fit in memory. Training minibatches are then drawn by block-wise shuffling (see **memmap_block_size**) rather than by history-length bucketing, and **lazy_history_expansion** is ignored during fitting. The files take as much disk space as the expanded inputs would take in memory (roughly ``n_responses * history_length * n_impulses`` floats); they are reused when fitting resumes on unchanged data, replaced when the data change, and otherwise left in place until the output directory is deleted."
+    ),
+    Kwarg(
+        'memmap_block_size',
+        65536,
+        int,
+        "Number of consecutive responses per shuffling block when **memmap_history** is ``True``. Blocks are visited in random order and responses are shuffled within each block, so that reads from disk stay mostly sequential. Larger blocks give more thorough shuffling at the cost of less sequential reads."
+    ),
     Kwarg(
         'n_samples_eval',
         1000,
@@ -745,6 +775,14 @@ MODEL_INITIALIZATION_KWARGS = [
 
 
 CDR_INITIALIZATION_KWARGS = [
+    # DATA SETTINGS
+    Kwarg(
+        'ragged_history',
+        False,
+        bool,
+        "Whether to feed impulse histories to the model in a ragged format (impulse rows concatenated across responses, with padding removed) rather than padded out to **history_length**, computing convolutions with a segment sum over rows. Reduces computation and memory usage when many histories are shorter than **history_length** (e.g. near the start of each time series). Not supported for models with continuous (interpolated) impulses or random IRF parameters."
+    ),
+
     # REGULARIZATION
     Kwarg(
         'irf_regularizer_name',
@@ -85,6 +85,163 @@ def get_random_permutation(n):
     return p, p_inv
 
 
+def get_block_permutation(n, block_size):
+    """
+    Draw a block-wise random permutation of integers 0 to **n**.
+    Contiguous blocks of **block_size** integers are visited in random order, and integers are shuffled within each block.
+    Used to shuffle data stored on disk, since consecutive elements of the permutation fall in the same block, keeping reads mostly sequential.
+
+    :param n: maximum value
+    :param block_size: ``int``; number of integers per block
+    :return: 2-tuple of ``numpy`` arrays; the permutation and its inverse
+    """
+
+    starts = np.random.permutation(np.arange(0, n, block_size))
+    p = [start + np.random.permutation(min(block_size, n - start)) for start in starts]
+    p = np.concatenate(p) if len(p) > 0 else np.zeros((0,), dtype=int)
+    p_inv = np.zeros_like(p)
+    p_inv[p] = np.arange(n)
+    return p, p_inv
+
+
+def get_bucketed_minibatches(history_lengths, minibatch_size, n_buckets):
+    """
+    Draw a random partition of integers 0 to ``len(history_lengths)`` into minibatches of similar history length.
+    Indices are assigned to **n_buckets** buckets by quantiles of **history_lengths**, shuffled within each bucket, and cut into minibatches in bucket order, and the order of the minibatches is then shuffled.
+    Minibatch composition therefore still varies randomly across calls, but each minibatch spans a narrow range of history lengths and can be trimmed to the longest of them.
+
+    :param history_lengths: ``numpy`` vector; effective history length of each data point.
+    :param minibatch_size: ``int``; size of each minibatch (the last may be smaller).
+    :param n_buckets: ``int``; number of history length buckets.
+    :return: ``list`` of ``numpy`` vectors; the indices in each minibatch
+    """
+
+    history_lengths = np.asarray(history_lengths)
+    n = len(history_lengths)
+    edges = np.unique(np.quantile(history_lengths, np.linspace(0, 1, n_buckets + 1)[1:-1])) if n > 0 else []
+    bucket = np.searchsorted(edges, history_lengths, side='right')
+    p = np.lexsort((np.random.random(n), bucket))
+    minibatches = [p[i:i + minibatch_size] for i in range(0, n, minibatch_size)]
+    order = np.random.permutation(len(minibatches))
+
+    return [minibatches[i] for i in order]
+
+
+class RunningMoments(object):
+    """
+    Streaming accumulator for the count, mean, standard deviation, minimum, and maximum of a sequence of values.
+    Batches of values are combined using the parallel update of Chan et al. (1979), so accumulators computed over different parts of the data can also be merged.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, x):
+        """
+        Add a batch of values.
+
+        :param x: ``numpy`` array; values to add.
+        :return: ``None``
+        """
+
+        x = np.asarray(x, dtype=np.float64).ravel()
+        if len(x) == 0:
+            return
+        other = RunningMoments()
+        other.n = len(x)
+        other.mean = x.mean()
+        other.m2 = ((x - other.mean) ** 2).sum()
+        other.min = x.min()
+        other.max = x.max()
+        self.merge(other)
+
+    def merge(self, other):
+        """
+        Merge another accumulator into this one.
+
+        :param other: ``RunningMoments``; accumulator to merge.
+        :return: ``None``
+        """
+
+        n = self.n + other.n
+        if n == 0:
+            return
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.n / n
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.n * other.n / n
+        self.n = n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def sd(self):
+        return np.sqrt(self.m2 / self.n) if self.n > 0 else np.nan
+
+
+class QuantileSketch(object):
+    """
+    Mergeable quantile sketch based on bottom-k sampling.
+    Each value receives a random key and the **size** values with the smallest keys are retained, which yields a uniform random sample of all values seen so far.
+    Quantiles are exact as long as no more than **size** values have been added.
+    Keys are drawn from the sketch's own random number generator, so the sketch is reproducible and does not advance the global ``numpy`` random state.
+
+    :param size: ``int``; maximum number of values to retain.
+    :param seed: ``int``; seed of the random number generator used to draw keys.
+    """
+
+    def __init__(self, size=100000, seed=0):
+        self.size = size
+        self.values = np.zeros((0,))
+        self.keys = np.zeros((0,))
+        self.random_state = np.random.RandomState(seed)
+
+    def update(self, x):
+        """
+        Add a batch of values.
+
+        :param x: ``numpy`` array; values to add.
+        :return: ``None``
+        """
+
+        x = np.asarray(x, dtype=np.float64).ravel()
+        self._add(x, self.random_state.random_sample(len(x)))
+
+    def merge(self, other):
+        """
+        Merge another sketch into this one.
+        The sketches must have been built with different seeds, since identical keys would bias the retained sample.
+
+        :param other: ``QuantileSketch``; sketch to merge.
+        :return: ``None``
+        """
+
+        self._add(other.values, other.keys)
+
+    def _add(self, values, keys):
+        values = np.concatenate([self.values, values])
+        keys = np.concatenate([self.keys, keys])
+        if len(keys) > self.size:
+            keep = np.argpartition(keys, self.size)[:self.size]
+            values = values[keep]
+            keys = keys[keep]
+        self.values = values
+        self.keys = keys
+
+    def quantile(self, q):
+        """
+        Estimate quantiles of the values seen so far.
+
+        :param q: ``float`` or ``numpy`` vector; quantile(s) to compute, in [0, 1].
+        :return: ``float`` or ``numpy`` vector; the estimated quantile(s).
+        """
+
+        return np.quantile(self.values, q)
+
+
 def sn(string):
     """
     Compute a Tensorboard-compatible version of a string.
@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def make_data(seed=0, n_subjects=3, n_docs=2, n_words=40, shuffle=True):
+    """
+    Generate a small synthetic reading-times dataset in the format expected by ``read_data()``: a word-level predictor table, a second predictor table with its own timestamps, and a response table.
+
+    :param seed: ``int``; random seed.
+    :param n_subjects: ``int``; number of subjects.
+    :param n_docs: ``int``; number of documents read by each subject.
+    :param n_words: ``int``; number of words per document.
+    :param shuffle: ``bool``; whether to shuffle the rows of each table.
+    :return: 3-tuple of ``pandas`` ``DataFrame``; word-level predictors, second predictor table, and responses.
+    """
+
+    rng = np.random.RandomState(seed)
+    X1 = []
+    X2 = []
+    y = []
+    for s in range(n_subjects):
+        for d in range(n_docs):
+            time = np.cumsum(rng.uniform(0.1, 0.5, n_words))
+            X1.append(pd.DataFrame({
+                'subject': 's%d' % s,
+                'docid': 'd%d' % d,
+                'time': time,
+                'wlen': rng.randint(1, 12, n_words),
+                'sentpos': np.arange(n_words) % 8 + 1,
+                'surp': rng.gamma(2., 2., n_words)
+            }))
+            time_2 = np.sort(rng.uniform(0, time[-1], n_words // 2))
+            X2.append(pd.DataFrame({
+                'subject': 's%d' % s,
+                'docid': 'd%d' % d,
+                'time': time_2,
+                'pupil': rng.normal(size=n_words // 2)
+            }))
+            # Responses are measured at a subset of word onsets
+            sel = np.sort(rng.choice(n_words, n_words * 3 // 4, replace=False))
+            y.append(pd.DataFrame({
+                'subject': 's%d' % s,
+                'docid': 'd%d' % d,
+                'time': time[sel],
+                'fdur': rng.gamma(5., 50., len(sel)).round(),
+                'sentpos': (sel % 8 + 1)
+            }))
+
+    out = []
+    for df in (X1, X2, y):
+        df = pd.concat(df, axis=0).reset_index(drop=True)
+        if shuffle:
+            df = df.iloc[rng.permutation(len(df))].reset_index(drop=True)
+        out.append(df)
+
+    return tuple(out)
+
+
+@pytest.fixture(scope='session')
+def data_paths(tmp_path_factory):
+    """
+    Paths to a synthetic dataset written to disk: ``(X1, X2, y)``.
+    """
+
+    path = tmp_path_factory.mktemp('data')
+    out = []
+    for name, df in zip(('X1', 'X2', 'y'), make_data()):
+        p = str(path / ('%s.txt' % name))
+        df.to_csv(p, sep=' ', index=False)
+        out.append(p)
+
+    return tuple(out)
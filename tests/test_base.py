@@ -0,0 +1,127 @@
+from types import SimpleNamespace
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+
+from cdr.base import Model
+from cdr.cdrmle import CDRMLE
+from cdr.formula import Formula
+from cdr.data import build_CDR_impulses, CDRInputs, preprocess_data, get_first_last_obs_lists, get_history_lengths, \
+    trim_history
+from test_data import get_impulse_inputs, load, SERIES_IDS
+
+
+def make_model(lazy_history_expansion, history_length):
+    return SimpleNamespace(
+        impulse_names=['pupil', 'sentpos', 'surp', 'wlen'],
+        rangf=['subject'],
+        rangf_map=[{'s0': 0, 's1': 1, 's2': 2}],
+        FLOAT_NP=np.float32,
+        INT_NP=np.int32,
+        int_type='int32',
+        float_type='float32',
+        lazy_history_expansion=lazy_history_expansion,
+        eval_minibatch_size=17,
+        history_length=history_length
+    )
+
+
+def test_prepare_inputs(data_paths):
+    X, y, first_obs, last_obs, names, kwargs = get_impulse_inputs(data_paths)
+    # Original preparation steps in Model.predict(), Model.log_lik(), Model.loss() and Model.convolve_inputs()
+    y_rangf = y[['subject']].copy()
+    y_rangf['subject'] = y_rangf['subject'].astype(str).map({'s0': 0, 's1': 1, 's2': 2})
+    gf_y = np.array(y_rangf, dtype=np.int32)
+    kwargs['time_y'] = np.array(y.time, dtype=np.float32)
+    X_2d, time_X_2d, time_X_mask = build_CDR_impulses(X, first_obs, last_obs, names, **kwargs)
+    subject = y.subject.copy()
+
+    for lazy_history_expansion in [False, True]:
+        model = make_model(lazy_history_expansion, kwargs['history_length'])
+        inputs = Model.prepare_inputs(
+            model,
+            X,
+            y.time,
+            y[['subject']],
+            first_obs,
+            last_obs,
+            X_response_aligned_predictor_names=kwargs['X_response_aligned_predictor_names'],
+            X_response_aligned_predictors=kwargs['X_response_aligned_predictors']
+        )
+        assert isinstance(inputs, CDRInputs)
+        assert len(inputs) == len(y)
+        np.testing.assert_array_equal(inputs.gf_y, gf_y)
+        np.testing.assert_array_equal(inputs.time_y, y.time.values.astype(np.float32))
+        # The input table is not modified
+        assert y.subject.equals(subject)
+        for ix in [slice(None), slice(0, 17), np.array([5, 0, 60])]:
+            X_2d_cur, time_X_2d_cur, time_X_mask_cur, time_ix = inputs.impulses[ix]
+            np.testing.assert_array_equal(X_2d_cur, X_2d[ix])
+            np.testing.assert_array_equal(time_X_2d_cur[..., time_ix], time_X_2d[ix])
+            np.testing.assert_array_equal(time_X_mask_cur[..., time_ix], time_X_mask[ix])
+
+
+def make_cdr(data_paths, formula, outdir):
+    X, y = load(data_paths)
+    X, y = preprocess_data(X, y, [Formula(formula)], SERIES_IDS, history_length=8, verbose=False)[:2]
+    model = CDRMLE(
+        formula,
+        X,
+        y,
+        outdir=outdir,
+        history_length=8,
+        crossval_factor=None,
+        crossval_fold=[],
+        irf_name_map={}
+    )
+
+    return model, X, y
+
+
+def test_trimmed_history_loss(data_paths, tmp_path):
+    model, X, y = make_cdr(data_paths, 'fdur ~ C(wlen + surp, Exp(Normal()))', str(tmp_path / 'composed'))
+    assert model._history_trimmable()
+    first_obs, last_obs = get_first_last_obs_lists(y)
+    time_y = np.array(y.time, dtype=np.float32)
+    X_2d, time_X_2d, time_X_mask, time_X_ix = build_CDR_impulses(
+        X,
+        first_obs,
+        last_obs,
+        model.impulse_names,
+        time_y=time_y,
+        history_length=8,
+        compact_time=True
+    )
+    history_lengths = get_history_lengths(first_obs, last_obs, 8)
+
+    # Batches of equal history length contain no padding once trimmed, so trimming changes their maximum time offset
+    for n in np.unique(history_lengths[history_lengths < 8]):
+        indices = np.where(history_lengths == n)[0]
+        fd = {
+            model.y: y.fdur.values[indices],
+            model.time_y: time_y[indices],
+            model.gf_y: np.zeros((len(indices), 0), dtype=np.int32)
+        }
+        fd_full = dict(fd)
+        fd_full.update(model._get_impulse_feed(X_2d[indices], time_X_2d[indices], time_X_mask[indices], time_X_ix))
+        X_cur, time_X_cur, mask_cur, t_delta_max = trim_history(
+            X_2d[indices],
+            time_X_2d[indices],
+            time_X_mask[indices],
+            time_X_ix,
+            time_y[indices],
+            max(n, 1)
+        )
+        fd_trimmed = dict(fd)
+        fd_trimmed.update(model._get_impulse_feed(X_cur, time_X_cur, mask_cur, time_X_ix))
+        fd_trimmed[model.max_tdelta_batch_untrimmed] = t_delta_max
+
+        expected = model.sess.run([model.max_tdelta_batch, model.loss_func], feed_dict=fd_full)
+        out = model.sess.run([model.max_tdelta_batch, model.loss_func], feed_dict=fd_trimmed)
+        assert out[0] == expected[0]
+        np.testing.assert_allclose(out[1], expected[1], rtol=1e-5)
+
+    # Continuous impulses interpolate between padding cells, so their histories are never trimmed
+    model, _, _ = make_cdr(data_paths, 'fdur ~ C(wlen, Gamma(cont=T))', str(tmp_path / 'cont'))
+    assert not model._history_trimmable()
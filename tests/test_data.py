@@ -0,0 +1,683 @@
+import gc
+import os
+import weakref
+import numpy as np
+import pandas as pd
+import pytest
+
+from cdr.formula import Formula
+from cdr.io import read_data
+from cdr.data import build_CDR_impulses, compute_history_intervals, save_impulse_store, ImpulseStore, \
+    compute_series_index, preprocess_data, expand_history, compute_time_mask, LazyCDRImpulses, \
+    compress_history, get_history_lengths, build_CDR_impulses_memmap, corr_cdr, \
+    get_t_delta_stats, compute_lags, compute_filters, FilterPlan, trim_history
+
+
+SERIES_IDS = ['subject', 'docid']
+
+
+def load(data_paths, **kwargs):
+    X1, X2, y = data_paths
+    return read_data(['%s;%s' % (X1, X2)], [y], SERIES_IDS, **kwargs)
+
+
+def get_intervals(X, y, **kwargs):
+    first_obs = []
+    last_obs = []
+    for x in X:
+        f, l = compute_history_intervals(x, y, SERIES_IDS, verbose=False, **kwargs)
+        first_obs.append(f)
+        last_obs.append(l)
+
+    return first_obs, last_obs
+
+
+def test_impulse_store(data_paths, tmp_path):
+    X, y = load(data_paths)
+    store = save_impulse_store(X[0], str(tmp_path))
+    assert isinstance(store, ImpulseStore)
+    # Non-numeric columns are not stored
+    assert 'subject' not in store.columns
+    for col in store.columns:
+        np.testing.assert_array_equal(store[col], X[0][col].values)
+
+    # Identical tables share a store
+    assert save_impulse_store(X[0].copy(), str(tmp_path)).path == store.path
+    assert len(os.listdir(str(tmp_path))) == 1
+
+    first_obs, last_obs = get_intervals(X[:1], y)
+    names = ['wlen', 'surp']
+    expected = build_CDR_impulses(X[0], first_obs[0], last_obs[0], names, history_length=8)
+    out = build_CDR_impulses(store, first_obs[0], last_obs[0], names, history_length=8)
+    for a, b in zip(out, expected):
+        np.testing.assert_array_equal(a, b)
+
+
+def test_impulse_store_table(data_paths, tmp_path):
+    X, y = load(data_paths)
+    x = X[0]
+    table = save_impulse_store(x, str(tmp_path), keep_non_numeric=True)
+    assert table.columns == list(x.columns)
+    assert 'subject' in table and 'wlen' in table and 'missing' not in table
+    for col in x.columns:
+        if col in ['subject', 'docid']:
+            pd.testing.assert_series_equal(table[col], x[col])
+        else:
+            assert isinstance(table[col], np.memmap)
+            np.testing.assert_array_equal(table[col], x[col].values)
+
+    formula = Formula('fdur ~ C(wlen + surp, Gamma()) + (1 | subject)')
+    assert str(formula.categorical_transform([table])) == str(formula.categorical_transform([x]))
+    first_obs, last_obs = get_intervals(X[:1], y)
+    expected = build_CDR_impulses(x, first_obs[0], last_obs[0], ['wlen', 'surp'], history_length=8)
+
+    # The table does not keep the source table alive
+    ref = weakref.ref(x)
+    del x, X
+    gc.collect()
+    assert ref() is None
+    out = build_CDR_impulses(table, first_obs[0], last_obs[0], ['wlen', 'surp'], history_length=8)
+    for a, b in zip(out, expected):
+        np.testing.assert_array_equal(a, b)
+
+
+def test_compute_series_index(data_paths):
+    X, y = load(data_paths)
+    for df in X + [y]:
+        index = compute_series_index(df, SERIES_IDS)
+        expected = {}
+        for key, rows in df.groupby(SERIES_IDS, observed=True, sort=False).indices.items():
+            expected[key] = (int(rows.min()), int(rows.max()) + 1)
+            assert len(rows) == rows.max() - rows.min() + 1
+        assert index == expected
+        assert list(index.values()) == sorted(index.values())
+
+    with pytest.raises(ValueError):
+        compute_series_index(pd.DataFrame({'subject': ['a', 'b', 'a'], 'docid': 'd'}), SERIES_IDS)
+
+
+def test_preprocess_data_series_index(data_paths):
+    formula = Formula('fdur ~ C(wlen + surp + wlenS1 + pupil, Gamma()) + (1 | subject)')
+    for filters in [None, [('fdur', '> 200'), ('subject', '!= s1')]]:
+        X, y, series_index = load(data_paths, return_series_index=True)
+        expected = preprocess_data([x.copy() for x in X], y.copy(), [formula], SERIES_IDS, filters=filters, history_length=8, verbose=False)
+        out = preprocess_data(X, y, [formula], SERIES_IDS, filters=filters, history_length=8, series_index=series_index, verbose=False)
+        for x_a, x_b in zip(out[0], expected[0]):
+            pd.testing.assert_frame_equal(x_a, x_b)
+        pd.testing.assert_frame_equal(out[1], expected[1])
+        np.testing.assert_array_equal(out[2], expected[2])
+
+
+def compute_history_intervals_reference(X, y, series_ids):
+    # Original implementation of compute_history_intervals(), a single merge-like pass over both tables
+    m = len(X)
+    n = len(y)
+    time_X = np.array(X.time)
+    time_y = np.array(y.time)
+    id_vectors_X = np.stack([np.array(X[col]) for col in series_ids], axis=1)
+    id_vectors_y = np.stack([np.array(y[col]) for col in series_ids], axis=1)
+    y_cur_ids = id_vectors_y[0]
+    first_obs = np.zeros(n, dtype='int32')
+    last_obs = np.zeros(n, dtype='int32')
+    i = j = start = end = 0
+    epsilon = np.finfo(np.float32).eps
+    while i < n:
+        if (id_vectors_y[i] != y_cur_ids).any():
+            start = end = j
+            y_cur_ids = id_vectors_y[i]
+        if j == 0 or (j > 0 and (id_vectors_X[j - 1] != y_cur_ids).any()):
+            while j < m and (id_vectors_X[j] != y_cur_ids).any():
+                j += 1
+                start = end = j
+        while j < m and time_X[j] <= (time_y[i] + epsilon) and (id_vectors_X[j] == y_cur_ids).all():
+            j += 1
+            end = j
+        first_obs[i] = start
+        last_obs[i] = end
+        i += 1
+
+    return first_obs, last_obs
+
+
+def test_compute_history_intervals(data_paths):
+    X, y = load(data_paths)
+    for x in X:
+        first_obs, last_obs = compute_history_intervals(x, y, SERIES_IDS, verbose=False)
+        first_obs_ref, last_obs_ref = compute_history_intervals_reference(x, y, SERIES_IDS)
+        np.testing.assert_array_equal(first_obs, first_obs_ref)
+        np.testing.assert_array_equal(last_obs, last_obs_ref)
+
+    # The original implementation does not support series that are missing from the impulse data.
+    # Responses in such series have empty histories at the end of the table, and other series are unaffected.
+    x = X[0][X[0].docid != 'd1'].reset_index(drop=True)
+    first_obs, last_obs = compute_history_intervals(x, y, SERIES_IDS, verbose=False)
+    epsilon = np.finfo(np.float32).eps
+    for i in range(len(y)):
+        rows = np.where((x.subject == y.subject[i]) & (x.docid == y.docid[i]))[0]
+        if len(rows) == 0:
+            assert first_obs[i] == last_obs[i] == len(x)
+        else:
+            assert first_obs[i] == rows[0]
+            assert last_obs[i] == rows[0] + (x.time.values[rows] <= y.time[i] + epsilon).sum()
+
+
+def test_compute_history_intervals_sharded(data_paths):
+    X, y = load(data_paths)
+    for x in X:
+        for history_window in [None, 1.]:
+            expected = compute_history_intervals(x, y, SERIES_IDS, verbose=False, history_window=history_window)
+            out = compute_history_intervals(x, y, SERIES_IDS, verbose=False, n_workers=3, history_window=history_window)
+            for a, b in zip(out, expected):
+                np.testing.assert_array_equal(a, b)
+
+
+def expand_history_reference(X, X_time, first_obs, last_obs, history_length, fill=0.):
+    # Original implementation of expand_history(), with a Python loop over responses
+    last_obs = np.array(last_obs, dtype='int32')
+    first_obs = np.maximum(np.array(first_obs, dtype='int32'), last_obs - history_length)
+    X_time = np.array(X_time, dtype='float32')
+    X = np.array(X)
+    X_2d = np.full((first_obs.shape[0], history_length, X.shape[1]), fill, dtype='float32')
+    time_X_2d = np.zeros_like(X_2d)
+    time_mask = np.zeros_like(X_2d)
+    for i, first, last in zip(np.arange(first_obs.shape[0]), first_obs, last_obs):
+        if first < last:
+            sX = X[first:last]
+            sXt = X_time[first:last]
+            X_2d[i, -sX.shape[0]:] = sX
+            time_X_2d[i][-len(sXt):] = sXt[..., None]
+            time_mask[i][-len(sXt):] = 1
+
+    return X_2d, time_X_2d, time_mask
+
+
+def compute_time_mask_reference(X_time, first_obs, last_obs, history_length):
+    # Original implementation of compute_time_mask()
+    last_obs = np.array(last_obs, dtype='int32')
+    first_obs = np.maximum(np.array(first_obs, dtype='int32'), last_obs - history_length)
+    X_time = np.array(X_time, dtype='float32')
+    time_mask = np.zeros((first_obs.shape[0], history_length), dtype='float32')
+    for i, first, last in zip(np.arange(first_obs.shape[0]), first_obs, last_obs):
+        sXt = X_time[first:last]
+        time_mask[i][-len(sXt):] = 1
+
+    return time_mask
+
+
+def test_expand_history(data_paths):
+    X, y = load(data_paths)
+    first_obs, last_obs = get_intervals(X[:1], y)
+    # Include empty histories
+    first_obs[0][:3] = last_obs[0][:3]
+    cols = ['wlen', 'surp', 'sentpos']
+    for history_length in [1, 4, 64]:
+        expected = expand_history_reference(X[0][cols], X[0].time, first_obs[0], last_obs[0], history_length)
+        out = expand_history(X[0][cols], X[0].time, first_obs[0], last_obs[0], history_length, chunk_size=7)
+        assert out[2].dtype == bool
+        for a, b in zip(out, expected):
+            np.testing.assert_array_equal(a, b)
+
+        mask = compute_time_mask(X[0].time, first_obs[0], last_obs[0], history_length)
+        np.testing.assert_array_equal(mask, compute_time_mask_reference(X[0].time, first_obs[0], last_obs[0], history_length))
+
+
+def get_impulse_inputs(data_paths, history_length=8):
+    X, y = load(data_paths)
+    first_obs, last_obs = get_intervals(X, y)
+    kwargs = dict(
+        time_y=y.time.values,
+        history_length=history_length,
+        X_response_aligned_predictor_names=['sentpos'],
+        X_response_aligned_predictors=y[['sentpos']]
+    )
+
+    return X, y, first_obs, last_obs, ['pupil', 'sentpos', 'surp', 'wlen'], kwargs
+
+
+def test_lazy_impulses(data_paths):
+    X, y, first_obs, last_obs, names, kwargs = get_impulse_inputs(data_paths)
+    for compact_time in [False, True]:
+        expected = build_CDR_impulses(X, first_obs, last_obs, names, compact_time=compact_time, **kwargs)
+        impulses = LazyCDRImpulses(X, first_obs, last_obs, names, compact_time=compact_time, **kwargs)
+        assert len(impulses) == len(y)
+        for ix in [slice(None), slice(10, 20), np.array([3, 1, 50, 2])]:
+            out = impulses[ix]
+            for a, b in zip(out[:3], expected[:3]):
+                np.testing.assert_array_equal(a, b[ix])
+            if compact_time:
+                np.testing.assert_array_equal(out[3], expected[3])
+
+
+def test_compact_time_impulses(data_paths):
+    X, y, first_obs, last_obs, names, kwargs = get_impulse_inputs(data_paths)
+    X_2d, time_X_2d, time_mask = build_CDR_impulses(X, first_obs, last_obs, names, **kwargs)
+    X_2d_c, time_X_2d_c, time_mask_c, time_ix = build_CDR_impulses(X, first_obs, last_obs, names, compact_time=True, **kwargs)
+    # One time slot per predictor file plus one for response-aligned predictors
+    assert time_X_2d_c.shape[-1] == len(X) + 1
+    assert len(time_ix) == len(names)
+    np.testing.assert_array_equal(X_2d_c, X_2d)
+    np.testing.assert_array_equal(time_X_2d_c[..., time_ix], time_X_2d)
+    np.testing.assert_array_equal(time_mask_c[..., time_ix], time_mask)
+
+
+def test_boolean_time_mask(data_paths):
+    X, y, first_obs, last_obs, names, kwargs = get_impulse_inputs(data_paths)
+    first_obs[0][:3] = last_obs[0][:3]
+    history_length = kwargs['history_length']
+    for compact_time in [False, True]:
+        time_mask = build_CDR_impulses(X, first_obs, last_obs, names, compact_time=compact_time, **kwargs)[2]
+        assert time_mask.dtype == bool
+
+    mask = compute_time_mask(X[0].time, first_obs[0], last_obs[0], history_length)
+    expected = compute_time_mask_reference(X[0].time, first_obs[0], last_obs[0], history_length)
+    assert mask.dtype == bool
+    assert mask.nbytes * 4 == expected.nbytes
+    # Casting back recovers the old float32 mask exactly
+    np.testing.assert_array_equal(mask.astype('float32'), expected)
+
+
+def test_compress_history(data_paths):
+    X, y, first_obs, last_obs, names, kwargs = get_impulse_inputs(data_paths)
+    X_2d, time_X_2d, time_mask, time_ix = build_CDR_impulses(X, first_obs, last_obs, names, compact_time=True, **kwargs)
+    X_rows, time_X_rows, time_mask_rows, offsets = compress_history(X_2d, time_X_2d, time_mask)
+    keep = time_mask.any(axis=-1)
+    assert offsets[0] == 0 and offsets[-1] == len(X_rows) == keep.sum()
+
+    # Scattering the rows back into the right-aligned padded layout recovers the padded arrays
+    n = np.diff(offsets)
+    segment_ids = np.repeat(np.arange(len(X_2d)), n)
+    position = X_2d.shape[1] - n[segment_ids] + np.arange(len(X_rows)) - offsets[segment_ids]
+    for rows, padded in zip([X_rows, time_X_rows, time_mask_rows], [X_2d, time_X_2d, time_mask]):
+        out = np.zeros_like(padded)
+        out[segment_ids, position] = rows
+        np.testing.assert_array_equal(out, padded)
+
+    # The segment-sum convolution of centered inputs, plus the contribution of the dropped padding cells
+    # at time offset equal to the response time, matches the padded convolution
+    time_y = kwargs['time_y']
+    irf = lambda t: np.exp(-t / 0.3)
+    mean = X_2d.reshape(-1, X_2d.shape[-1]).mean(axis=0)
+    t_delta = time_y[:, None, None] - time_X_2d[..., time_ix]
+    expected = ((X_2d - mean) * irf(t_delta)).sum(axis=1)
+    t_delta_rows = time_y[segment_ids, None] - time_X_rows[:, time_ix]
+    out = np.zeros_like(expected)
+    np.add.at(out, segment_ids, (X_rows - mean) * irf(t_delta_rows))
+    n_pad = X_2d.shape[1] - n
+    out += n_pad[:, None] * -mean * irf(time_y)[:, None]
+    np.testing.assert_allclose(out, expected, rtol=1e-10, atol=1e-10)
+
+    # The maximum time offset is recovered from the rows and the dropped padding cells
+    t_delta_pad = np.where(n_pad > 0, time_y, -np.inf)
+    assert max(t_delta_rows.max(), t_delta_pad.max()) == t_delta.max()
+
+
+def test_history_lengths(data_paths):
+    X, y, first_obs, last_obs, names, kwargs = get_impulse_inputs(data_paths)
+    X_2d, time_X_2d, time_mask, time_ix = build_CDR_impulses(X, first_obs, last_obs, names, compact_time=True, **kwargs)
+    history_lengths = get_history_lengths(first_obs, last_obs, kwargs['history_length'])
+    # Response-aligned predictors occupy the final cell of every history
+    np.testing.assert_array_equal(np.maximum(history_lengths, 1), time_mask.any(axis=-1).sum(axis=1))
+
+    # Trimming a minibatch to its longest history leaves the (uncentered) convolution unchanged
+    time_y = kwargs['time_y']
+    irf = lambda t: np.exp(-t / 0.3)
+    for indices in np.array_split(np.argsort(history_lengths), 5):
+        n_history = max(history_lengths[indices].max(), 1)
+        X_cur = X_2d[indices]
+        t_delta = time_y[indices, None, None] - time_X_2d[indices][..., time_ix]
+        expected = (X_cur * irf(t_delta)).sum(axis=1)
+        out = (X_cur[:, -n_history:] * irf(t_delta[:, -n_history:])).sum(axis=1)
+        np.testing.assert_allclose(out, expected)
+
+
+def composed_irf_convolution(X_2d, t_delta, t_delta_max, n_interp=64):
+    # Convolution with a composed (exponential * normal) IRF, interpolated over [0, t_delta_max] as in CDR._compose_irf()
+    support = np.linspace(0., t_delta_max, n_interp)
+    f = np.exp(-support / 0.3)
+    g = np.exp(-(support - 0.5) ** 2)
+    seq = np.fft.irfft(np.fft.rfft(f) * np.fft.rfft(g), n=n_interp) * t_delta_max / n_interp
+    ix = np.round(t_delta * (n_interp - 1) / t_delta_max).astype(int)
+
+    return (X_2d * seq[ix]).sum(axis=1)
+
+
+def test_trim_history(data_paths):
+    X, y = load(data_paths)
+    first_obs, last_obs = get_intervals(X[:1], y)
+    # Without response-aligned predictors, which are timestamped at zero in every cell but the last
+    X_2d, time_X_2d, time_mask, time_ix = build_CDR_impulses(X[:1], first_obs, last_obs, ['surp', 'wlen'], history_length=8, compact_time=True)
+    history_lengths = get_history_lengths(first_obs, last_obs, 8)
+    time_y = y.time.values
+    n_trimmed = 0
+    # Batches of equal history length contain no padding once trimmed, and batches of mixed length still do
+    batches = [np.where(history_lengths == n)[0] for n in np.unique(history_lengths)]
+    batches += np.array_split(np.argsort(history_lengths, kind='stable'), 8)
+    for indices in batches:
+        n_history = max(history_lengths[indices].max(), 1)
+        X_cur, time_X_cur, mask_cur, t_delta_max = trim_history(
+            X_2d[indices],
+            time_X_2d[indices],
+            time_mask[indices],
+            time_ix,
+            time_y[indices],
+            n_history
+        )
+        assert X_cur.shape[1] == time_X_cur.shape[1] == mask_cur.shape[1] == n_history
+        np.testing.assert_array_equal(X_cur, X_2d[indices][:, -n_history:])
+        np.testing.assert_array_equal(time_X_cur, time_X_2d[indices][:, -n_history:])
+        np.testing.assert_array_equal(mask_cur, time_mask[indices][:, -n_history:])
+        # Only padding cells are dropped
+        assert not time_mask[indices][:, :-n_history].any()
+
+        t_delta = time_y[indices, None, None] - time_X_2d[indices][..., time_ix]
+        assert t_delta_max == t_delta.max()
+        t_delta_trimmed = t_delta[:, -n_history:]
+        # With the maximum offset of the untrimmed batch, composed IRFs give the same convolution
+        expected = composed_irf_convolution(X_2d[indices], t_delta, t_delta.max())
+        out = composed_irf_convolution(X_cur, t_delta_trimmed, t_delta_max)
+        np.testing.assert_allclose(out, expected)
+        if t_delta_trimmed.max() < t_delta_max:
+            n_trimmed += 1
+            # ... which the maximum of the trimmed batch alone would change
+            out = composed_irf_convolution(X_cur, t_delta_trimmed, t_delta_trimmed.max())
+            assert not np.allclose(out, expected)
+
+    # Trimming changes the maximum offset of some batches, so the check above is not vacuous
+    assert n_trimmed > 0
+
+
+def test_compute_history_intervals_window(data_paths):
+    X, y = load(data_paths)
+    epsilon = np.finfo(np.float32).eps
+    for x in X:
+        # A window longer than any time series recovers the full histories
+        expected = compute_history_intervals(x, y, SERIES_IDS, verbose=False)
+        out = compute_history_intervals(x, y, SERIES_IDS, verbose=False, history_window=1e9)
+        for a, b in zip(out, expected):
+            np.testing.assert_array_equal(a, b)
+
+        for history_window in [0., 0.5, 2.]:
+            first_obs, last_obs = compute_history_intervals(x, y, SERIES_IDS, verbose=False, history_window=history_window)
+            np.testing.assert_array_equal(last_obs, expected[1])
+            for i in range(len(y)):
+                t_delta = y.time[i] - x.time.values[expected[0][i]:expected[1][i]]
+                rows = np.where(t_delta <= history_window + epsilon)[0]
+                if len(rows) == 0:
+                    assert first_obs[i] == last_obs[i]
+                else:
+                    assert first_obs[i] == expected[0][i] + rows[0]
+
+
+def test_memmap_impulses(data_paths, tmp_path):
+    X, y, first_obs, last_obs, names, kwargs = get_impulse_inputs(data_paths)
+    expected = build_CDR_impulses(X, first_obs, last_obs, names, compact_time=True, **kwargs)
+    impulses = build_CDR_impulses_memmap(X, first_obs, last_obs, names, str(tmp_path), chunk_size=7, verbose=False, **kwargs)
+    assert len(impulses) == len(y)
+    for ix in [slice(None), np.array([3, 1, 50, 2])]:
+        out = impulses[ix]
+        for a, b in zip(out[:3], expected[:3]):
+            np.testing.assert_array_equal(a, b[ix])
+        np.testing.assert_array_equal(out[3], expected[3])
+
+    # Identical inputs reuse the saved arrays
+    dirs = os.listdir(str(tmp_path))
+    assert len(dirs) == 1
+    path = os.path.join(str(tmp_path), dirs[0], 'X.npy')
+    mtime = os.path.getmtime(path)
+    os.utime(path, (mtime - 100, mtime - 100))
+    build_CDR_impulses_memmap(X, first_obs, last_obs, names, str(tmp_path), verbose=False, **kwargs)
+    assert os.listdir(str(tmp_path)) == dirs
+    assert os.path.getmtime(path) == mtime - 100
+
+    # New inputs are written to a new directory, and copies for other inputs are removed
+    os.makedirs(os.path.join(str(tmp_path), 'history_' + '0' * 32))
+    os.makedirs(os.path.join(str(tmp_path), 'other'))
+    kwargs['history_length'] = 4
+    impulses = build_CDR_impulses_memmap(X, first_obs, last_obs, names, str(tmp_path), verbose=False, **kwargs)
+    assert impulses[:][0].shape[1] == 4
+    new_dirs = sorted(os.listdir(str(tmp_path)))
+    assert len(new_dirs) == 2 and 'other' in new_dirs and dirs[0] not in new_dirs
+
+
+def corr_cdr_reference(X_2d, impulse_names, impulse_names_2d, time, time_mask):
+    # Original implementation of corr_cdr(), correlating each pair of impulses separately
+    rho = pd.DataFrame(np.zeros((len(impulse_names), len(impulse_names))), index=impulse_names, columns=impulse_names)
+    for i in range(len(impulse_names)):
+        for j in range(i, len(impulse_names)):
+            if impulse_names[i] in impulse_names_2d or impulse_names[j] in impulse_names_2d:
+                x1 = X_2d[..., i]
+                x2 = X_2d[..., j]
+                aligned = np.logical_and(np.logical_and(np.isclose(time[:,:,i], time[:,:,j]), time_mask[:,:,i]), time_mask[:,:,j])
+                n = aligned.sum()
+            else:
+                x1 = X_2d[:, -1, i]
+                x2 = X_2d[:, -1, j]
+                aligned = 1
+                n = X_2d.shape[0]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x1_mean = x1.sum() / n
+                x2_mean = x2.sum() / n
+                cor = ((x1 - x1_mean) * (x2 - x2_mean) * aligned).sum() / \
+                      np.sqrt(((x1 - x1_mean) ** 2 * aligned).sum() * ((x2 - x2_mean) ** 2 * aligned).sum())
+            rho.loc[impulse_names[i], impulse_names[j]] = cor
+            rho.loc[impulse_names[j], impulse_names[i]] = cor
+
+    return rho
+
+
+def test_corr_cdr(data_paths):
+    X, y, first_obs, last_obs, names, kwargs = get_impulse_inputs(data_paths)
+    X_2d, time_X_2d, time_mask = build_CDR_impulses(X, first_obs, last_obs, names, **kwargs)
+    _, time_X_2d_c, time_mask_c, time_ix = build_CDR_impulses(X, first_obs, last_obs, names, compact_time=True, **kwargs)
+    X_2d = X_2d.astype('float64')
+    for names_2d in [[], ['surp']]:
+        expected = corr_cdr_reference(X_2d, names, names_2d, time_X_2d, time_mask)
+        out = corr_cdr(X_2d, names, names_2d, time_X_2d, time_mask)
+        pd.testing.assert_frame_equal(out, expected)
+        out = corr_cdr(X_2d, names, names_2d, time_X_2d_c, time_mask_c, time_ix=time_ix)
+        pd.testing.assert_frame_equal(out, expected)
+
+    # Subsampling is reproducible and leaves the global random state untouched
+    np.random.seed(0)
+    state = np.random.get_state()
+    out = corr_cdr(X_2d, names, [], time_X_2d, time_mask, n_samples=50)
+    assert np.array_equal(np.random.get_state()[1], state[1])
+    sample_ix = np.sort(np.random.RandomState(0).permutation(len(X_2d))[:50])
+    expected = corr_cdr_reference(X_2d[sample_ix], names, [], time_X_2d[sample_ix], time_mask[sample_ix])
+    pd.testing.assert_frame_equal(out, expected)
+    pd.testing.assert_frame_equal(corr_cdr(X_2d, names, [], time_X_2d, time_mask, n_samples=50), out)
+
+
+def test_t_delta_stats(data_paths):
+    X, y = load(data_paths)
+    first_obs, last_obs = get_intervals(X, y)
+    time_X = [x.time.values for x in X]
+    time_y = y.time.values
+    history_length = 8
+    # Original computation in Model._initialize_metadata(), looping over responses
+    t_deltas = []
+    t_delta_maxes = []
+    for time_X_cur, first_obs_cur, last_obs_cur in zip(time_X, first_obs, last_obs):
+        for j, (s, e) in enumerate(zip(first_obs_cur, last_obs_cur)):
+            s = max(s, e - history_length)
+            t_deltas.append(time_y[j] - time_X_cur[s:e])
+            t_delta_maxes.append(time_y[j] - time_X_cur[s])
+    t_deltas = np.concatenate(t_deltas, axis=0)
+    q = np.linspace(0., 1., 11)
+
+    moments, sketch, maxes = get_t_delta_stats(time_X, time_y, first_obs, last_obs, history_length, chunk_size=7)
+    assert moments.n == len(t_deltas)
+    np.testing.assert_allclose(moments.mean, t_deltas.mean())
+    np.testing.assert_allclose(moments.sd, t_deltas.std())
+    assert moments.max == t_deltas.max() and moments.min == t_deltas.min()
+    np.testing.assert_array_equal(maxes, t_delta_maxes)
+    # The sketch retains every offset, so quantiles are exact
+    np.testing.assert_array_equal(sketch.quantile(q), np.quantile(t_deltas, q))
+
+    # Smaller sketches give approximate quantiles, which are reproducible and leave the global random state untouched
+    np.random.seed(0)
+    state = np.random.get_state()
+    _, sketch, _ = get_t_delta_stats(time_X, time_y, first_obs, last_obs, history_length, sketch_size=len(t_deltas) // 2)
+    assert np.array_equal(np.random.get_state()[1], state[1]) and np.random.get_state()[2] == state[2]
+    assert len(sketch.values) == len(t_deltas) // 2
+    assert np.abs(sketch.quantile(0.5) - np.quantile(t_deltas, 0.5)) < t_deltas.std() / 2
+    _, sketch_2, _ = get_t_delta_stats(time_X, time_y, first_obs, last_obs, history_length, sketch_size=len(t_deltas) // 2)
+    np.testing.assert_array_equal(sketch_2.quantile(q), sketch.quantile(q))
+
+
+def test_preprocess_data_transform_cache(data_paths, monkeypatch):
+    formulas = [
+        Formula('fdur ~ C(z.(log(wlen)) + log(surp) + pupil, Gamma()) + (1 | subject)'),
+        Formula('fdur ~ C(z.(log(wlen)) + log(wlen) + log(surp):wlen, Gamma()) + (1 | subject)')
+    ]
+    X, y = load(data_paths)
+    # Each formula applied to its own copy of the data, without sharing transforms
+    expected = [preprocess_data([x.copy() for x in X], y.copy(), [f], SERIES_IDS, history_length=8, verbose=False) for f in formulas]
+
+    n_ops = []
+    apply_op = Formula.apply_op
+    def apply_op_counted(self, op, arr):
+        n_ops.append((op, arr.name))
+        return apply_op(self, op, arr)
+    monkeypatch.setattr(Formula, 'apply_op', apply_op_counted)
+    out = preprocess_data(X, y, formulas, SERIES_IDS, history_length=8, verbose=False)
+
+    for f, expected_cur in zip(formulas, expected):
+        for name in f.t.impulse_names(include_interactions=True):
+            x_out = [x for x in out[0] if name in x.columns][0]
+            x_expected = [x for x in expected_cur[0] if name in x.columns][0]
+            pd.testing.assert_series_equal(x_out[name], x_expected[name])
+        pd.testing.assert_frame_equal(out[1][expected_cur[1].columns], expected_cur[1])
+    # Each transform is computed once, although both formulas use log(wlen), z.(log(wlen)) and log(surp)
+    # (transformed series keep the name of their base column)
+    assert sorted(n_ops) == [('log', 'surp'), ('log', 'wlen'), ('z', 'wlen')]
+
+
+def test_preprocess_data_raw_and_transformed(data_paths):
+    for rhs in ['surp + log(surp)', 'log(surp) + surp']:
+        formula = Formula('fdur ~ C(%s, Gamma()) + (1 | subject)' % rhs)
+        X, y = load(data_paths)
+        surp = X[0].surp.values.copy()
+        surp[:3] = [np.nan, np.inf, np.nan]
+        X[0]['surp'] = surp
+        X_out = preprocess_data(X, y, [formula], SERIES_IDS, history_length=8, verbose=False)[0]
+        x = [x for x in X_out if 'log(surp)' in x.columns][0]
+        # The raw impulse is scrubbed like the input to log(), as the original in-place scrub did
+        expected = np.where(np.isfinite(surp), surp, 0)
+        np.testing.assert_array_equal(x['surp'].values, expected)
+        np.testing.assert_array_equal(x['log(surp)'].values[3:], np.log(expected[3:]))
+
+
+def test_compute_lags(data_paths):
+    X, y, series_index = load(data_paths, return_series_index=True)
+    x = X[0]
+    x['wlen_int'] = x.wlen.round().astype(int)
+    lags = [(col, n) for col in ['wlen', 'surp', 'wlen_int'] for n in [0, 1, 3, 50, 1000]]
+    for series_index_cur in [None, series_index[0][0]]:
+        out = compute_lags(x, SERIES_IDS, lags, series_index=series_index_cur)
+        assert list(out.columns) == ['%sS%d' % lag for lag in lags]
+        for col, n in lags:
+            # Original computation in Formula.apply_formula(), one grouped shift per spillover term
+            expected = x.groupby(SERIES_IDS, observed=True)[col].shift(n, fill_value=0.)
+            np.testing.assert_array_equal(out['%sS%d' % (col, n)].values, expected.values)
+            assert out.index.equals(x.index)
+
+    formula = Formula('fdur ~ C(wlen + wlenS1 + surpS2, Gamma()) + (1 | subject)')
+    X_out = preprocess_data(X, y, [formula], SERIES_IDS, history_length=8, verbose=False)[0]
+    for col, n in [('wlen', 1), ('surp', 2)]:
+        expected = X_out[0].groupby(SERIES_IDS, observed=True)[col].shift(n, fill_value=0.)
+        np.testing.assert_array_equal(X_out[0]['%sS%d' % (col, n)].values, expected.values)
+
+
+def compute_filter_reference(y, field, cond):
+    # Original implementation of compute_filter(), except that ">=" is no longer evaluated as "<="
+    cond = cond.strip()
+    for op in ['<=', '>=', '==', '!=', '<', '>']:
+        if cond.startswith(op):
+            var = cond[len(op):].strip()
+            break
+    try:
+        var = float(var)
+    except ValueError:
+        if var in y and not var in y[field].unique():
+            var = y[var]
+    col = y[field]
+    if op == '<=':
+        out = col <= var
+    elif op == '>=':
+        out = col >= var
+    elif op == '<':
+        out = col < var
+    elif op == '>':
+        out = col > var
+    elif op == '==':
+        out = col == var
+    else:
+        out = col != var
+
+    return ~pd.isna(col) & out
+
+
+def compute_filters_reference(y, filters):
+    # Original implementation of compute_filters(), with one pass over the table per filter
+    select = np.ones(len(y), dtype=bool)
+    for field, cond in filters:
+        if field in y.columns:
+            select &= compute_filter_reference(y, field, cond)
+        elif field.lower().endswith('nunique') and field[:-7] in y.columns:
+            name = field[:-7]
+            vals, counts = np.unique(y[name][select], return_counts=True)
+            y[field] = y[name].map(dict(zip(vals, counts)))
+            select &= compute_filter_reference(y, field, cond)
+
+    return select
+
+
+def test_filter_plan():
+    rng = np.random.RandomState(0)
+    n = 500
+    y = pd.DataFrame({
+        'a': rng.normal(size=n),
+        'b': rng.normal(size=n),
+        'k': rng.randint(0, 10, size=n),
+        'word': rng.choice(['x', 'y', 'z', 'b'], size=n).astype(object),
+        'subject': rng.choice(['s%d' % i for i in range(30)], size=n).astype(object)
+    })
+    y.loc[rng.random_sample(n) < 0.1, 'a'] = np.nan
+    filters_list = [
+        [('a', '> -1'), ('k', '>= 2'), ('b', '<= 1.5'), ('k', '!= 5')],
+        [('a', '< b'), ('word', '== x'), ('k', '<= 8')],
+        # "b" occurs as a value of "word", so it is a literal rather than a column name
+        [('word', '!= b'), ('a', '>= b')],
+        [('k', '> 3'), ('subjectnunique', '> 8'), ('a', '> 0')],
+        [('subjectnunique', '>= 20'), ('wordnunique', '< 200')],
+        [('missing', '> 0'), ('missingnunique', '> 0'), ('a', '< 0.5')]
+    ]
+    for filters in filters_list:
+        y_expected = y.copy()
+        expected = compute_filters_reference(y_expected, filters)
+        plan = FilterPlan(filters)
+        assert len(plan) == len(filters)
+        for i in range(2):
+            y_out = y.copy()
+            # Plans can be evaluated repeatedly
+            out = compute_filters(y_out, plan)
+            assert out.dtype == bool
+            np.testing.assert_array_equal(out, expected)
+        for field, _ in filters:
+            if field.endswith('nunique') and field in y_expected:
+                pd.testing.assert_series_equal(y_out[field], y_expected[field])
+
+    # Unique counts are integers if every value occurs in some selected row, and missing otherwise
+    y_out = y.copy()
+    compute_filters(y_out, [('subjectnunique', '> 0')])
+    assert y_out.subjectnunique.dtype == 'int64'
+    y_out = y.copy()
+    compute_filters(y_out, [('subject', '!= s0'), ('subjectnunique', '> 0')])
+    assert y_out.subjectnunique.isna().sum() == (y.subject == 's0').sum()
+
+    # Missing values are counted as a value of their own
+    y_out = pd.DataFrame({'g': ['u', np.nan, 'u', np.nan, np.nan, 'v']})
+    select = compute_filters(y_out, [('gnunique', '> 1')])
+    np.testing.assert_array_equal(y_out.gnunique.values, [2, 3, 2, 3, 3, 1])
+    np.testing.assert_array_equal(select, [True, True, True, True, True, False])
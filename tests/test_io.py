@@ -0,0 +1,269 @@
+import os
+import pickle
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+
+from cdr.formula import Formula
+from conftest import make_data
+from cdr.io import read_data, get_projection, use_projection, plan_dtypes, merge_sorted, get_bundle_path, save_bundle, load_bundle
+from cdr.data import preprocess_data
+
+
+SERIES_IDS = ['subject', 'docid']
+
+
+def read_data_reference(X_paths, y_paths, series_ids, categorical_columns=None, sep=' '):
+    # Original implementation of read_data(), without caching, projection, filtering, or parallelism
+    if not isinstance(X_paths, list):
+        X_paths = [X_paths]
+    if not isinstance(y_paths, list):
+        y_paths = [y_paths]
+    X = [[pd.read_csv(x, sep=sep, skipinitialspace=True) for x in path.split(';')] for path in X_paths]
+    y = pd.concat([pd.read_csv(path, sep=sep, skipinitialspace=True) for path in y_paths], axis=0)
+    X = [pd.concat([X[i][j] for i in range(len(X))], axis=0) for j in range(len(X[0]))]
+    X = [x.sort_values(series_ids + ['time']).reset_index(drop=True) for x in X]
+    y = y.sort_values(series_ids + ['time']).reset_index(drop=True)
+    if categorical_columns is not None:
+        for col in categorical_columns:
+            for x in X:
+                if col in x.columns:
+                    x[col] = x[col].astype('category')
+            if col in y.columns:
+                y[col] = y[col].astype('category')
+    for x in X:
+        x['rate'] = 1.
+        x['trial'] = x.groupby(series_ids, observed=True).rate.cumsum()
+
+    return X, y
+
+
+def assert_tables_equal(X_a, y_a, X_b, y_b, **kwargs):
+    assert len(X_a) == len(X_b)
+    for x_a, x_b in zip(X_a, X_b):
+        pd.testing.assert_frame_equal(x_a, x_b, **kwargs)
+    pd.testing.assert_frame_equal(y_a, y_b, **kwargs)
+
+
+def test_read_data_matches_reference(data_paths):
+    X1, X2, y = data_paths
+    X, y_new = read_data(['%s;%s' % (X1, X2)], [y], SERIES_IDS, categorical_columns=SERIES_IDS)
+    X_ref, y_ref = read_data_reference(['%s;%s' % (X1, X2)], [y], SERIES_IDS, categorical_columns=SERIES_IDS)
+    assert_tables_equal(X, y_new, X_ref, y_ref)
+
+
+def test_read_data_cache(data_paths, tmp_path):
+    X1, X2, y = data_paths
+    cache_dir = str(tmp_path / 'cache')
+    X_a, y_a = read_data([X1], [y], SERIES_IDS, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+    X_b, y_b = read_data([X1], [y], SERIES_IDS, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+    assert_tables_equal(X_a, y_a, X_b, y_b)
+
+    # Different loading settings get a separate entry
+    read_data([X1], [y], SERIES_IDS, cache_dir=cache_dir, usecols=SERIES_IDS + ['time', 'wlen', 'fdur'])
+    assert len(os.listdir(cache_dir)) == 2
+
+
+def test_read_data_cache_invalidated_by_file_contents(data_paths, tmp_path):
+    X1, _, y = data_paths
+    cache_dir = str(tmp_path / 'cache')
+    y_copy = str(tmp_path / 'y.txt')
+    df = pd.read_csv(y, sep=' ')
+    df.to_csv(y_copy, sep=' ', index=False)
+    _, y_a = read_data([X1], [y_copy], SERIES_IDS, cache_dir=cache_dir)
+
+    df['fdur'] += 1
+    df.to_csv(y_copy, sep=' ', index=False)
+    _, y_b = read_data([X1], [y_copy], SERIES_IDS, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 2
+    np.testing.assert_array_equal(y_b.fdur.values, y_a.fdur.values + 1)
+
+
+def make_config(**kwargs):
+    config = dict(
+        series_ids=SERIES_IDS,
+        split_ids=[],
+        filters=[],
+        models={},
+        project_columns=True
+    )
+    config.update(kwargs)
+
+    return SimpleNamespace(**config)
+
+
+def test_get_projection():
+    formula = Formula('fdur ~ C(wlen + z(surp), Gamma()) + (1 | subject)')
+    config = make_config(
+        filters=[('sentpos', '>= 2'), ('fdur', '< wlen'), ('docid', "!= 'd1'"), ('subjectnunique', '> 5')],
+        models={'CDR_a': {'crossval_factor': 'fold'}}
+    )
+    cols = get_projection([formula], config)
+    # Numeric and quoted filter values are literals, not columns
+    assert cols == sorted({'time', 'subject', 'docid', 'fdur', 'wlen', 'surp', 'sentpos', 'fold', 'subjectnunique'})
+
+
+def test_use_projection():
+    config = make_config()
+    assert use_projection(config, ['CDR_a', 'DTSR_b'])
+    assert not use_projection(config, ['CDR_a', 'LM_b'])
+    assert not use_projection(config, [])
+    assert not use_projection(make_config(project_columns=False), ['CDR_a'])
+
+
+def test_read_data_projection(data_paths):
+    X1, X2, y = data_paths
+    formula = Formula('fdur ~ C(wlen, Gamma()) + (1 | subject)')
+    usecols = get_projection([formula], make_config())
+    X, y_new = read_data(['%s;%s' % (X1, X2)], [y], SERIES_IDS, usecols=usecols)
+    X_ref, y_ref = read_data_reference(['%s;%s' % (X1, X2)], [y], SERIES_IDS)
+    for x, x_ref in zip(X, X_ref):
+        pd.testing.assert_frame_equal(x, x_ref[[col for col in x_ref.columns if col in x.columns]])
+    assert 'surp' not in X[0].columns
+    pd.testing.assert_frame_equal(y_new, y_ref[[col for col in y_ref.columns if col in usecols]])
+
+
+def test_read_data_parallel(data_paths):
+    X1, X2, y = data_paths
+    X_a, y_a = read_data(['%s;%s' % (X1, X2), X1 + ';' + X2], [y, y], SERIES_IDS, n_workers=1)
+    X_b, y_b = read_data(['%s;%s' % (X1, X2), X1 + ';' + X2], [y, y], SERIES_IDS, n_workers=4)
+    assert_tables_equal(X_a, y_a, X_b, y_b)
+
+
+def test_plan_dtypes():
+    df = pd.DataFrame({
+        'a': np.array([1.5, 2.5]),
+        'b': np.array([1, 2], dtype='int64'),
+        'big': np.array([1, 2 ** 40], dtype='int64'),
+        'c': np.array([1.5, 2.5], dtype='float32'),
+        'time': np.array([0., 1.]),
+        's': ['x', 'y']
+    })
+    dtypes = plan_dtypes(df, float_type='float32', int_type='int32', exclude=['time'])
+    # Columns that would overflow, are already compact, are excluded, or are non-numeric keep their types
+    assert dtypes == {'a': np.dtype('float32'), 'b': np.dtype('int32')}
+
+
+def test_read_data_downcast(data_paths):
+    X1, _, y = data_paths
+    X_a, y_a = read_data([X1], [y], SERIES_IDS)
+    X_b, y_b = read_data([X1], [y], SERIES_IDS, float_type='float32', int_type='int32')
+    for x_a, x_b in zip(X_a + [y_a], X_b + [y_b]):
+        # Timestamps keep full precision
+        assert x_b.time.dtype == np.float64
+        for col in x_a.columns:
+            if col == 'time' or not pd.api.types.is_numeric_dtype(x_a[col]):
+                continue
+            if pd.api.types.is_float_dtype(x_a[col]):
+                assert x_b[col].dtype == np.float32
+            else:
+                assert x_b[col].dtype == np.int32
+            np.testing.assert_allclose(x_b[col].values.astype(float), x_a[col].values.astype(float), rtol=1e-6)
+
+
+def test_merge_sorted():
+    keys = SERIES_IDS + ['time']
+    X, _, y = make_data(shuffle=False)
+    X_shuffled, _, _ = make_data(shuffle=True)
+    cases = [
+        [X],  # Already sorted
+        [X.iloc[:50], X.iloc[50:]],  # Sorted runs in order
+        [X.iloc[50:], X.iloc[:50]],  # Sorted runs out of order
+        [X.iloc[:50], X_shuffled],  # Unsorted input
+        [X.iloc[:0], y.iloc[:0]]  # Empty input
+    ]
+    for tables in cases:
+        expected = pd.concat(tables, axis=0).sort_values(keys).reset_index(drop=True)
+        pd.testing.assert_frame_equal(merge_sorted(tables, keys), expected)
+
+    # Ties are broken by input order, as in sort_values()
+    df = pd.DataFrame({'subject': ['a', 'a', 'b'], 'docid': ['d', 'd', 'd'], 'time': [1., 1., 0.], 'x': [1, 2, 3]})
+    expected = pd.concat([df, df], axis=0).sort_values(keys).reset_index(drop=True)
+    pd.testing.assert_frame_equal(merge_sorted([df, df], keys), expected)
+
+
+def test_read_data_filters(data_paths):
+    X1, _, y = data_paths
+    filters = [('sentpos', '> 1'), ('fdur', '<= 300'), ('subjectnunique', '> 10'), ('sentpos', '< 8')]
+    _, y_full = read_data([X1], [y], SERIES_IDS)
+    _, y_filtered = read_data([X1], [y], SERIES_IDS, filters=filters, chunksize=7)
+    # Only the filters preceding the first unique-count filter are applied on read
+    expected = y_full[(y_full.sentpos > 1) & (y_full.fdur <= 300)].reset_index(drop=True)
+    pd.testing.assert_frame_equal(y_filtered, expected)
+
+
+def test_read_data_filters_empty_file(data_paths, tmp_path):
+    X1, _, y = data_paths
+    y_empty = str(tmp_path / 'y.txt')
+    with open(y_empty, 'w') as f:
+        f.write('subject docid time fdur sentpos\n')
+    _, y_new = read_data([X1], [y_empty], SERIES_IDS, filters=[('fdur', '> 100')])
+    assert len(y_new) == 0
+    assert list(y_new.columns) == ['subject', 'docid', 'time', 'fdur', 'sentpos']
+
+
+def test_read_data_filters_column_comparison(tmp_path):
+    X = pd.DataFrame({'subject': 'a', 'docid': 'd', 'time': np.arange(6.), 'x': 1.})
+    y = pd.DataFrame({
+        'subject': 'a',
+        'docid': 'd',
+        'time': np.arange(6.),
+        'word': ['the', 'cat', 'the', 'x', 'x', 'y'],
+        'ref': ['the', 'dog', 'cat', 'x', 'z', 'y'],
+        'other': ['ref', 'ref', 'ref', 'ref', 'b', 'b']
+    })
+    X_path = str(tmp_path / 'X.txt')
+    y_path = str(tmp_path / 'y.txt')
+    X.to_csv(X_path, sep=' ', index=False)
+    y.to_csv(y_path, sep=' ', index=False)
+
+    # Values naming a column are compared against it, unless they occur as values of the filtered column,
+    # and the decision is the same for every chunk
+    filters = [('word', '== ref'), ('other', '== ref')]
+    for chunksize in [1, 2, 100]:
+        _, y_new = read_data([X_path], [y_path], SERIES_IDS, filters=filters, chunksize=chunksize)
+        assert y_new.time.tolist() == [0., 3.]
+
+
+def test_bundle_round_trip(data_paths, tmp_path):
+    X1, X2, y = data_paths
+    config = make_config(
+        sep=' ',
+        filter_on_read=False,
+        history_length=8,
+        history_window=None,
+        project_columns=False,
+        data_float_type=None,
+        data_int_type=None,
+        outdir=str(tmp_path)
+    )
+    formula = Formula('fdur ~ C(wlen + pupil, Gamma()) + (1 | subject)')
+    other_formula = Formula('fdur ~ C(surp, Gamma()) + (1 | subject)')
+    X_paths = ['%s;%s' % (X1, X2)]
+    path = get_bundle_path(X_paths, [y], config)
+    assert load_bundle(path, [formula]) is None
+
+    X, y_df = read_data(X_paths, [y], SERIES_IDS)
+    data = preprocess_data(X, y_df, [formula], SERIES_IDS, history_length=8, verbose=False)
+    save_bundle(path, data, [formula])
+    loaded = load_bundle(path, [formula])
+    for x_a, x_b in zip(loaded[0], data[0]):
+        pd.testing.assert_frame_equal(x_a, x_b)
+    pd.testing.assert_frame_equal(loaded[1], data[1])
+
+    # Bundles are not used for formulae they do not cover
+    assert load_bundle(path, [formula, other_formula]) is None
+
+    # Bundles depend on the preprocessing settings
+    config.history_length = 16
+    assert get_bundle_path(X_paths, [y], config) != path
+
+    # Bundles from other versions are ignored
+    with open(path, 'rb') as f:
+        bundle = pickle.load(f)
+    bundle['version'] = -1
+    with open(path, 'wb') as f:
+        pickle.dump(bundle, f)
+    assert load_bundle(path, [formula]) is None
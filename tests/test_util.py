@@ -0,0 +1,97 @@
+import numpy as np
+
+from cdr.util import get_block_permutation, get_bucketed_minibatches, RunningMoments, QuantileSketch
+
+
+def test_bucketed_minibatches():
+    rng = np.random.RandomState(0)
+    history_lengths = rng.randint(0, 129, size=1000)
+    n_buckets = 8
+    edges = np.quantile(history_lengths, np.linspace(0, 1, n_buckets + 1))
+
+    np.random.seed(0)
+    minibatches = get_bucketed_minibatches(history_lengths, 64, n_buckets)
+    # Minibatches partition the data
+    np.testing.assert_array_equal(np.sort(np.concatenate(minibatches)), np.arange(1000))
+    assert all(len(m) <= 64 for m in minibatches)
+    # Each minibatch spans at most two adjacent buckets
+    for m in minibatches:
+        bucket = np.searchsorted(edges[1:-1], history_lengths[m], side='right')
+        assert bucket.max() - bucket.min() <= 1
+
+    # Composition and order vary across calls
+    minibatches_2 = get_bucketed_minibatches(history_lengths, 64, n_buckets)
+    assert any(not np.array_equal(a, b) for a, b in zip(minibatches, minibatches_2))
+
+    assert get_bucketed_minibatches(np.zeros(0), 64, n_buckets) == []
+
+
+def test_block_permutation():
+    np.random.seed(0)
+    for n in [0, 1, 10, 103]:
+        p, p_inv = get_block_permutation(n, 16)
+        np.testing.assert_array_equal(np.sort(p), np.arange(n))
+        np.testing.assert_array_equal(p[p_inv], np.arange(n))
+        # Each block of the permutation is a contiguous block of the input, in random order
+        block = p // 16
+        runs = np.split(p, np.where(np.diff(block) != 0)[0] + 1) if n > 0 else []
+        assert len(runs) == len(np.unique(block))
+        for run in runs:
+            start = run[0] // 16 * 16
+            np.testing.assert_array_equal(np.sort(run), np.arange(start, min(start + 16, n)))
+
+    assert not np.array_equal(get_block_permutation(103, 16)[0], np.arange(103))
+
+
+def test_running_moments():
+    rng = np.random.RandomState(0)
+    x = rng.normal(loc=1e4, scale=3., size=1000)
+    moments = RunningMoments()
+    for chunk in np.array_split(x, 7):
+        moments.update(chunk)
+    moments.update(np.zeros(0))
+    assert moments.n == len(x)
+    np.testing.assert_allclose(moments.mean, x.mean())
+    np.testing.assert_allclose(moments.sd, x.std())
+    assert moments.min == x.min() and moments.max == x.max()
+
+    # Merging accumulators over parts of the data is equivalent to accumulating over all of it
+    a = RunningMoments()
+    a.update(x[:300])
+    b = RunningMoments()
+    b.update(x[300:])
+    a.merge(b)
+    a.merge(RunningMoments())
+    assert a.n == moments.n
+    np.testing.assert_allclose([a.mean, a.sd], [moments.mean, moments.sd])
+
+    assert np.isnan(RunningMoments().sd)
+
+
+def test_quantile_sketch():
+    # Data are drawn from a different stream than the keys of the sketch (seed 0), to which they would otherwise be tied
+    x = np.random.RandomState(1).exponential(size=10000)
+    q = [0., 0.1, 0.5, 0.9, 1.]
+
+    # Exact while no more than size values have been added, including after merging
+    a = QuantileSketch(size=len(x))
+    a.update(x[:4000])
+    b = QuantileSketch(size=len(x), seed=1)
+    b.update(x[4000:])
+    a.merge(b)
+    np.testing.assert_array_equal(a.quantile(q), np.quantile(x, q))
+
+    sketch = QuantileSketch(size=2000)
+    for chunk in np.array_split(x, 10):
+        sketch.update(chunk)
+    assert len(sketch.values) == 2000
+    assert np.isin(sketch.values, x).all()
+    np.testing.assert_allclose(sketch.quantile([0.1, 0.5, 0.9]), np.quantile(x, [0.1, 0.5, 0.9]), rtol=0.15)
+
+    # Keys come from the sketch's own generator, so sketches are reproducible and the global random state is untouched
+    state = np.random.get_state()
+    sketch_2 = QuantileSketch(size=2000)
+    for chunk in np.array_split(x, 10):
+        sketch_2.update(chunk)
+    assert np.array_equal(np.random.get_state()[1], state[1])
+    np.testing.assert_array_equal(sketch_2.values, sketch.values)